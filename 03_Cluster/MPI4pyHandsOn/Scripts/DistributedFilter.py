@@ -0,0 +1,142 @@
+'''
+Distributed image filtering for any number of ranks.
+
+The image (on root) is split in blocks of rows, one per rank. A filter whose footprint reaches radius pixels from
+the centre needs radius rows of the neighbouring blocks (the halo), so every rank receives its own block
+(Scatterv), gets up to radius rows above and below from its neighbours (Sendrecv, as the halo exchange of
+HeatEq_P.py, and from ranks further away if the halo is deeper than the blocks), filters it and keeps its own rows,
+which are gathered back on root (Gatherv). Uneven row counts are fine, the blocks differ by at most one row.
+
+Any scipy.ndimage filter (or other function filtering a 2D array) can be used, e.g.
+
+    filtered = distributedFilter(image, laplace, mode='constant', cval=0)
+    filtered = distributedFilter(image, gaussian_filter, sigma=3)
+    filtered = distributedFilter(image, convolve, weights=kernel, mode='nearest')
+    filtered = distributedFilter(image, myFilter, radius=2)
+
+The radius is derived from the arguments of the scipy.ndimage filters (see footprintRadius), it must be given for
+other functions.
+'''
+from mpi4py import MPI
+import numpy as np
+from scipy import ndimage
+
+from Partition import balancedCounts
+
+
+def footprintRadius(filterFunction, **filterKwargs):
+    '''Returns the number of rows on each side of a pixel a scipy.ndimage filter uses (None if unknown)'''
+    name = getattr(filterFunction, "__name__", "")
+    if name in ("laplace", "sobel", "prewitt"):
+        return 1
+    if name in ("gaussian_filter", "gaussian_laplace", "gaussian_gradient_magnitude"):
+        sigma = np.max(filterKwargs.get("sigma", 0))
+        radius = filterKwargs.get("radius")
+        if radius is not None:
+            return int(np.max(radius))
+        return int(filterKwargs.get("truncate", 4.0)*sigma + 0.5)
+    #Filters defined by a footprint, kernel or size, taking the origin (shift of the footprint) into account
+    if "footprint" in filterKwargs or "weights" in filterKwargs:
+        rows = np.shape(filterKwargs.get("footprint", filterKwargs.get("weights")))[0]
+    elif "size" in filterKwargs:
+        rows = np.atleast_1d(filterKwargs["size"])[0]
+    else:
+        return None
+    return int(rows//2 + abs(np.atleast_1d(filterKwargs.get("origin", 0))[0]))
+
+
+def distributedFilter(image, filterFunction, radius=None, comm=MPI.COMM_WORLD, root=0, **filterKwargs):
+    '''
+    Filters a 2D image with filterFunction(block, **filterKwargs) in parallel over the ranks of comm and returns
+    the filtered image on root (None on the other ranks). image is only needed on root. radius is the number of
+    rows on each side of a pixel the filter uses (derived with footprintRadius if not given).
+    '''
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    if radius is None:
+        radius = footprintRadius(filterFunction, **filterKwargs)
+        if radius is None:
+            raise ValueError(f"The footprint radius of {filterFunction} is unknown, it must be given")
+
+    if rank == root:
+        image = np.ascontiguousarray(image)
+        shape, dtype = image.shape, image.dtype
+    else:
+        shape, dtype = None, None
+    shape, dtype = comm.bcast((shape, dtype), root=root)
+    numberOfRows, numberOfColumns = shape
+
+    #Own rows of each rank, and the rows it needs (own rows and halo, clipped at the image borders)
+    counts, starts = balancedCounts(numberOfRows, size)
+    stops = starts + counts
+    haloStarts = np.maximum(starts - radius, 0)
+    haloStops = np.minimum(stops + radius, numberOfRows)
+
+    #Each rank receives only its own rows, in the middle of its block
+    block = np.empty((haloStops[rank] - haloStarts[rank], numberOfColumns), dtype=dtype)
+    first = starts[rank] - haloStarts[rank]
+    sendBuffer = [image, (counts*numberOfColumns, starts*numberOfColumns)] if rank == root else None
+    comm.Scatterv(sendBuffer, block[first:first + counts[rank]], root=root)
+
+    def haloRows(source, destination):
+        #Global rows [lo, hi) owned by source that are in the halo of destination (lo == hi if none)
+        if not (0 <= source < size and 0 <= destination < size) or source == destination:
+            return 0, 0
+        lo = max(starts[source], haloStarts[destination])
+        return lo, max(lo, min(stops[source], haloStops[destination]))
+
+    def rankOrNull(r):
+        return r if 0 <= r < size else MPI.PROC_NULL
+
+    #Halo exchange with the ranks at distance 1 (the neighbours), 2, ... as long as some halo reaches that far
+    for distance in range(1, size):
+        if all(np.subtract(*haloRows(r, r + d)) == 0 for r in range(size) for d in (distance, -distance)):
+            break
+        for destination, source in ((rank + distance, rank - distance), (rank - distance, rank + distance)):
+            sendLo, sendHi = haloRows(rank, destination)
+            recvLo, recvHi = haloRows(source, rank)
+            offset = haloStarts[rank]
+            comm.Sendrecv(np.ascontiguousarray(block[sendLo - offset:sendHi - offset]), rankOrNull(destination),
+                          recvbuf=block[recvLo - offset:recvHi - offset], source=rankOrNull(source))
+
+    #The filter sees the true image border (with its boundary mode) at the borders of the image, and the halo rows
+    #everywhere else, so the own rows are the same as when filtering the whole image
+    filtered = filterFunction(block, **filterKwargs)
+    ownRows = np.ascontiguousarray(filtered[first:first + counts[rank]])
+
+    if rank == root:
+        filteredImage = np.empty(shape, dtype=ownRows.dtype)
+        comm.Gatherv(ownRows, [filteredImage, (counts*numberOfColumns, starts*numberOfColumns)], root=root)
+        return filteredImage
+    comm.Gatherv(ownRows, None, root=root)
+    return None
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+
+    #Filters a random image of (default) 4096x4096 pixels with a few filters and compares with the sequential result
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    image = np.random.random((n, n)) if rank == 0 else None
+    filters = [
+        ("laplace", ndimage.laplace, dict(mode='constant', cval=0)),
+        ("gaussian_filter", ndimage.gaussian_filter, dict(sigma=3)),
+        ("median_filter", ndimage.median_filter, dict(size=5)),
+        ("convolve", ndimage.convolve, dict(weights=np.ones((3, 7))/21, mode='nearest')),
+    ]
+    for name, filterFunction, filterKwargs in filters:
+        comm.Barrier()
+        t0 = time.perf_counter()
+        filtered = distributedFilter(image, filterFunction, **filterKwargs)
+        parallelTime = time.perf_counter() - t0
+        if rank == 0:
+            t0 = time.perf_counter()
+            filtered_ref = filterFunction(image, **filterKwargs)
+            sequentialTime = time.perf_counter() - t0
+            print (f"{name}: {comm.Get_size()} ranks {parallelTime:.3f} s, sequential {sequentialTime:.3f} s,",
+                   "parallel computation equals sequential :", np.array_equal(filtered, filtered_ref))
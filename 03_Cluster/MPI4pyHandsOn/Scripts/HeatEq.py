@@ -1,11 +1,16 @@
 '''
 Python code to simulate and animate heat equtaion
+
+Usage:
+$ python HeatEq.py                 #animation
+$ python HeatEq.py headless 1000   #no plotting, saves a snapshot every 1000 steps to HeatEq_snapshots.npy
 '''
 import numpy as np
 from scipy.ndimage import laplace
+import sys
+import time
 
-import pylab as plt
-from matplotlib.animation import FuncAnimation
+from Stencil import HeatStencil
 
 numberOfGridPoints = 50
 dt = 0.1
@@ -18,18 +23,34 @@ u[numberOfGridPoints//2, numberOfGridPoints//2] = 100
 b = 1.0
 
 def update(u, alpha, dt, b):
+    #Reference implementation, the stencil engine gives bitwise identical results without allocating arrays
     return u + dt*alpha*laplace(u, mode='constant', cval=b)
 
-
-#Plotting only
-fig, ax = plt.subplots()
-
-def animate(i):
-    global u
-    u = update(u, alpha, dt, b)
-    ax.imshow(u)
+stencil = HeatStencil(u, dt, alpha, b)
+
+if len(sys.argv) > 1 and sys.argv[1] == "headless":
+    snapshotEvery = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    t0 = time.perf_counter()
+    snapshots = stencil.run(numberOfIterations, snapshotEvery)
+    runTime = time.perf_counter() - t0
+    np.save("HeatEq_snapshots.npy", snapshots)
+    print (f"{numberOfIterations} iterations in {runTime:.2f} s ({runTime/numberOfIterations*1e6:.1f} us/step),",
+           f"{len(snapshots)} snapshots saved to HeatEq_snapshots.npy")
+else:
+    import pylab as plt
+    from matplotlib.animation import FuncAnimation
+
+    #Plotting only
+    fig, ax = plt.subplots()
     ax.set_axis_off()
+    #The image is created once and only its data updated each frame
+    image = ax.imshow(stencil.field)
+
+    def animate(i):
+        image.set_data(stencil.step())
+        image.autoscale()
+        return image,
 
-anim = FuncAnimation(fig, animate, frames=numberOfIterations, interval=10)
+    anim = FuncAnimation(fig, animate, frames=numberOfIterations, interval=10, blit=True)
 
-plt.show()
+    plt.show()
@@ -1,59 +1,244 @@
+'''
+Parallel heat equation solver for any number of ranks.
+
+The grid is split over a 2D Cartesian communicator (Create_cart) and each rank holds its block plus one
+ring of ghost cells (the halo). Every iteration the halos are exchanged with the 4 neighbours using non-blocking
+Isend/Irecv: rows are contiguous in memory, columns are strided and sent with a derived (vector) datatype.
+While the halos are in flight the interior of the block is updated, then the edge cells once they arrived.
+
+For small blocks the run is latency bound, so the halo can be made deeper (temporal blocking): with a halo of depth
+k the ghost cells are exchanged once every k steps, and in between the steps are done locally.
+
+Usage:
+$ mpiexec -n 6 python HeatEq_P.py                    #compare with the sequential solution for several halo depths
+$ mpiexec -n 6 python HeatEq_P.py strong 2000 100      #strong scaling: 2000x2000 grid, 100 iterations
+$ mpiexec -n 6 python HeatEq_P.py weak 500 100 4       #weak scaling: 500x500 grid points per rank, halo depth 4
+$ mpiexec -n 6 python HeatEq_P.py halo 200 1000        #messages and time per step for halo depths 1, 2, 4 and 8
+'''
 from mpi4py import MPI
 import numpy as np
 from scipy.ndimage import laplace
+import sys
+import time
+
+from Partition import balancedCounts
+from Stencil import laplaceUpdate
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-assert size == 2
-
-nr = 220
-nc = 200
-assert nr % 2 == 0
-nh = nr//2
-
 dt = 0.1
 alpha = 1
-bound = 1
-numberOfIterations = 100
-
-doExchangeHalo = True #Set to False to make UT fail
+bound = 1 #Dirichlet boundary condition (value outside the grid)
 
 def update(u):
+    #Sequential reference, laplaceUpdate gives bitwise identical results
     return u + dt*alpha*laplace(u, mode='constant', cval=bound)
 
-u_0 = np.arange(nr*nc, dtype = np.float64).reshape(nr,nc)
 
-if rank == 0:
-    u_upper = u_0[:nh +1, :]
-else:
-    u_lower = u_0[nh -1:, :]
+class HaloExchange:
+    '''
+    Non-blocking exchange of the depth cells wide halo of a local block u of shape (ny+2*depth, nx+2*depth).
 
-for _ in range(numberOfIterations):
-    if rank == 0:
-        u_upper = update(u_upper)
-        if doExchangeHalo:
-            comm.Send(u_upper[-2,:], dest=1, tag=12)
-            comm.Recv(u_upper[-1,:], source=1, tag=13)
-    else:
-        u_lower = update(u_lower)
-        if doExchangeHalo:
-            comm.Recv(u_lower[0,:], source=0, tag=12)
-            comm.Send(u_lower[1,:], dest=0, tag=13)
-
-if rank == 0:
-    u_f_total = np.zeros_like(u_0)
-    u_f_total[:nh, :] = u_upper[:-1, :]
-    comm.Recv(u_f_total[nh:,:], source=1, tag=14)
-else: #<- only since we know that we are running on 2 cores
-    comm.Send(u_lower[1:,:], dest=0, tag=14)
-
-
-if rank == 0:
-    u = u_0
-    for _ in range(numberOfIterations):
-        u = update(u)
-    u_f_total_seq = u
-    print ("Parallel integration equals sequential :", np.allclose(u_f_total, u_f_total_seq))
+    With depth 1 the rows and columns are exchanged at once. Deeper halos also need the corners (the cells of the
+    diagonal neighbours), so the columns are exchanged first and then the full rows including the ghost columns.
+    '''
+
+    def __init__(self, cart, u, depth=1):
+        self.depth = depth
+        self.ny, self.nx = u.shape[0] - 2*depth, u.shape[1] - 2*depth
+        #Neighbours are MPI.PROC_NULL at the border of the grid, sending/receiving from them does nothing,
+        #so the ghost cells there keep the boundary value
+        self.north, self.south = cart.Shift(0, 1)
+        self.west, self.east = cart.Shift(1, 1)
+        self.cart = cart
+        #depth columns of the block: ny times depth doubles, each one row (nx+2*depth doubles) apart
+        self.columnType = MPI.DOUBLE.Create_vector(self.ny, depth, self.nx + 2*depth).Commit()
+        #Number of messages sent to neighbours
+        self.messages = 0
+
+    def _columns(self, u):
+        k, nx, w = self.depth, self.nx, self.nx + 2*self.depth
+        flat = u.reshape(-1) #view, so that columns can be addressed by their first element in the first row
+        col = lambda j: [flat[k*w + j:], 1, self.columnType]
+        self.messages += (self.west != MPI.PROC_NULL) + (self.east != MPI.PROC_NULL)
+        return [
+            self.cart.Irecv(col(0), source=self.west, tag=2),
+            self.cart.Irecv(col(k + nx), source=self.east, tag=3),
+            self.cart.Isend(col(nx), dest=self.east, tag=2),
+            self.cart.Isend(col(k), dest=self.west, tag=3),
+        ]
+
+    def _rows(self, u, ghostColumns):
+        k, ny = self.depth, self.ny
+        cols = slice(None) if ghostColumns else slice(k, -k)
+        self.messages += (self.north != MPI.PROC_NULL) + (self.south != MPI.PROC_NULL)
+        return [
+            self.cart.Irecv(u[0:k, cols], source=self.north, tag=0),
+            self.cart.Irecv(u[k + ny:, cols], source=self.south, tag=1),
+            self.cart.Isend(u[ny:ny + k, cols], dest=self.south, tag=0),
+            self.cart.Isend(u[k:2*k, cols], dest=self.north, tag=1),
+        ]
+
+    def start(self, u):
+        if self.depth == 1:
+            #Single rows are contiguous without the ghost columns
+            return self._columns(u) + self._rows(u, ghostColumns=False)
+        return self._columns(u)
+
+    def finish(self, u, requests):
+        MPI.Request.Waitall(requests)
+        if self.depth > 1:
+            MPI.Request.Waitall(self._rows(u, ghostColumns=True))
+
+    def free(self):
+        self.columnType.Free()
 
+
+def solve(cart, u, numberOfIterations, depth=1):
+    '''
+    Advances the local block u (with its halo of width depth) numberOfIterations steps, returns (u, compute time,
+    wait time, messages sent). The halo is exchanged every depth steps, then the steps are done locally on the valid
+    region, which shrinks by one cell towards the neighbours each step (the cells of the halo are updated exactly as
+    by the neighbours, so the result does not depend on depth).
+    '''
+    k = depth
+    ny, nx = u.shape[0] - 2*k, u.shape[1] - 2*k
+    if cart.allreduce(min(ny, nx), op=MPI.MIN) < k:
+        raise ValueError(f"The halo depth {k} is larger than the smallest block")
+    uNew = u.copy() #the ghost cells at the border keep the boundary value in both buffers
+    halo = HaloExchange(cart, u, k)
+    hasNorth, hasSouth = halo.north != MPI.PROC_NULL, halo.south != MPI.PROC_NULL
+    hasWest, hasEast = halo.west != MPI.PROC_NULL, halo.east != MPI.PROC_NULL
+    scratch = np.empty(2*u.size) #for the stencil kernel, so that no arrays are allocated in the loop
+    stencilUpdate = lambda r0, r1, c0, c1: laplaceUpdate(u, uNew, dt*alpha, (r0, r1, c0, c1), scratch)
+    computeTime = waitTime = 0
+    iteration = 0
+    while iteration < numberOfIterations:
+        steps = min(k, numberOfIterations - iteration)
+        t0 = time.perf_counter()
+        requests = halo.start(u)
+        #Interior (does not need the halo) of the first step while the halos are in flight
+        stencilUpdate(k + 1, k + ny - 1, k + 1, k + nx - 1)
+        t1 = time.perf_counter()
+        halo.finish(u, requests)
+        t2 = time.perf_counter()
+        for step in range(steps):
+            #Valid region of this step, extending into the halo towards the neighbours
+            e = steps - 1 - step
+            r0, r1 = k - e*hasNorth, k + ny + e*hasSouth
+            c0, c1 = k - e*hasWest, k + nx + e*hasEast
+            if step == 0:
+                #Edges around the interior
+                stencilUpdate(r0, k + 1, c0, c1)
+                stencilUpdate(max(k + ny - 1, k + 1), r1, c0, c1)
+                stencilUpdate(k + 1, k + ny - 1, c0, k + 1)
+                stencilUpdate(k + 1, k + ny - 1, max(k + nx - 1, k + 1), c1)
+            else:
+                stencilUpdate(r0, r1, c0, c1)
+            u, uNew = uNew, u
+        iteration += steps
+        computeTime += (t1 - t0) + (time.perf_counter() - t2)
+        waitTime += t2 - t1
+    halo.free()
+    return u, computeTime, waitTime, halo.messages
+
+
+def createDomain(nr, nc):
+    '''Creates the Cartesian communicator and this rank's block (rows, cols) of the nr x nc grid'''
+    dims = MPI.Compute_dims(size, 2)
+    cart = comm.Create_cart(dims, periods=[False, False], reorder=True)
+    coords = cart.Get_coords(cart.Get_rank())
+    #Balanced blocks, the first rows/columns of blocks get one row/column more
+    rowCounts, rowStarts = balancedCounts(nr, dims[0])
+    colCounts, colStarts = balancedCounts(nc, dims[1])
+    rows = int(rowStarts[coords[0]]), int(rowStarts[coords[0]] + rowCounts[coords[0]])
+    cols = int(colStarts[coords[1]]), int(colStarts[coords[1]] + colCounts[coords[1]])
+    return cart, dims, rows, cols
+
+def localBlock(u_0_fn, rows, cols, depth=1):
+    #Local block with depth rings of ghost cells initialised to the boundary value
+    u = np.full((rows[1] - rows[0] + 2*depth, cols[1] - cols[0] + 2*depth), bound, dtype=np.float64)
+    u[depth:-depth, depth:-depth] = u_0_fn(rows, cols)
+    return u
+
+def gatherGrid(cart, u, rows, cols, nr, nc, depth=1):
+    #Collects the blocks on rank 0 (for the unit test only)
+    block = np.ascontiguousarray(u[depth:-depth, depth:-depth])
+    extents = cart.gather((rows, cols), root=0)
+    counts = cart.gather(block.size, root=0)
+    if cart.Get_rank() == 0:
+        recvBuffer = np.empty(sum(counts), dtype=np.float64)
+        cart.Gatherv(block, [recvBuffer, counts], root=0)
+        grid = np.empty((nr, nc), dtype=np.float64)
+        offset = 0
+        for (r0, r1), (c0, c1) in extents:
+            grid[r0:r1, c0:c1] = recvBuffer[offset:offset + (r1 - r0)*(c1 - c0)].reshape(r1 - r0, c1 - c0)
+            offset += (r1 - r0)*(c1 - c0)
+        return grid
+    cart.Gatherv(block, None, root=0)
+    return None
+
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "check"
+
+    if mode == "check":
+        nr = 220
+        nc = 200
+        numberOfIterations = 100
+        depths = [int(d) for d in sys.argv[2:]] or [1, 2, 3, 8]
+        #Each rank initialises its own block of the initial condition
+        initial = lambda rows, cols: (np.arange(rows[0], rows[1])[:, None]*nc + np.arange(cols[0], cols[1])).astype(np.float64)
+
+        if rank == 0:
+            u_ref = np.arange(nr*nc, dtype = np.float64).reshape(nr,nc)
+            for _ in range(numberOfIterations):
+                u_ref = update(u_ref)
+
+        cart, dims, rows, cols = createDomain(nr, nc)
+        if rank == 0:
+            print (f"Process grid {dims[0]}x{dims[1]}")
+        for depth in depths:
+            u, _, _, _ = solve(cart, localBlock(initial, rows, cols, depth), numberOfIterations, depth)
+            u_f_total = gatherGrid(cart, u, rows, cols, nr, nc, depth)
+            if rank == 0:
+                print (f"Halo depth {depth}:")
+                print ("  Parallel integration equals sequential :", np.allclose(u_f_total, u_ref))
+                print ("  Parallel integration is bitwise identical :", np.array_equal(u_f_total, u_ref))
+
+    elif mode in ("strong", "weak", "halo"):
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        numberOfIterations = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+        #strong and weak scaling with the given halo depth, halo compares depths on the strong scaling grid
+        depths = [int(sys.argv[4]) if len(sys.argv) > 4 else 1] if mode != "halo" else [1, 2, 4, 8]
+        dims = MPI.Compute_dims(size, 2)
+        #strong: n x n global grid, weak: n x n grid points per rank
+        nr, nc = (n*dims[0], n*dims[1]) if mode == "weak" else (n, n)
+        initial = lambda rows, cols: np.zeros((rows[1] - rows[0], cols[1] - cols[0]))
+
+        cart, dims, rows, cols = createDomain(nr, nc)
+        if rank == 0:
+            print (f"{mode}: ranks={size} grid={nr}x{nc} process grid={dims[0]}x{dims[1]} iterations={numberOfIterations}")
+        for depth in depths:
+            u = localBlock(initial, rows, cols, depth)
+            solve(cart, u.copy(), 1, depth) #warm up (loads the compiled stencil kernel)
+            cart.Barrier()
+            t0 = time.perf_counter()
+            u, computeTime, waitTime, messages = solve(cart, u, numberOfIterations, depth)
+            wallTime = time.perf_counter() - t0
+
+            #The slowest rank determines the run time
+            times = np.array([wallTime, computeTime, waitTime, messages])
+            maxTimes = np.empty_like(times)
+            cart.Reduce(times, maxTimes, op=MPI.MAX, root=0)
+            if rank == 0:
+                wallTime, computeTime, waitTime, messages = maxTimes
+                print (f"  halo depth {depth}: time/step {wallTime/numberOfIterations*1e3:.3f} ms"
+                       f" (compute {computeTime/numberOfIterations*1e3:.3f} ms, halo wait {waitTime/numberOfIterations*1e3:.3f} ms),"
+                       f" {nr*nc*numberOfIterations/wallTime/1e6:.1f} million cell updates/s,"
+                       f" {messages/numberOfIterations:.2f} messages/step (busiest rank)")
+    else:
+        if rank == 0:
+            print (f"Unknown mode {mode}, should be check, strong, weak or halo")
@@ -1,37 +1,39 @@
+'''
+Parallel Laplace filter of a detector image for any number of ranks.
+
+The rows of the image are split over the ranks, each rank gets its rows plus one row of the neighbouring blocks
+(the halo, the footprint radius of the Laplace filter) and the filtered rows are gathered back on rank 0, see
+DistributedFilter.py (LaplaceFilter_P_Bug.py shows what goes wrong without the halo).
+
+Usage:
+$ mpiexec -n 5 python LaplaceFilter_P.py        #220x200 image
+$ mpiexec -n 5 python LaplaceFilter_P.py 4096   #4096x4096 image
+'''
 from mpi4py import MPI
 import numpy as np
 from scipy.ndimage import laplace
+import sys
+
+from DistributedFilter import distributedFilter
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-assert size == 2
-
-nr = 220
-nc = 200
-nh = nr//2
+nr = int(sys.argv[1]) if len(sys.argv) > 1 else 220
+nc = int(sys.argv[1]) if len(sys.argv) > 1 else 200
 bitDepth = 8
 
-np.random.seed(21) #Commen this line, unit test fails
-detectorImage = np.random.randint(2**bitDepth, size=(nr, nc)).astype(np.float64)
+#Only rank 0 needs the image
+if rank == 0:
+    detectorImage = np.random.randint(2**bitDepth, size=(nr, nc)).astype(np.float64)
+else:
+    detectorImage = None
 
+#The footprint radius (1 row) is known for laplace, any scipy.ndimage filter can be used the same way
+detectorImageFiltered = distributedFilter(detectorImage, laplace, mode='constant', cval=0)
 
 if rank == 0:
-    #Rank zero allocates filtered array of same size as initial size since it will receive lower half
-    detectorImageFiltered = np.zeros_like(detectorImage)
-    #Only calculate the upper half part but make sure that input contains a additional row
-    #at the end of the array, this last row is skipped in the filerted (partial) result
-    #In this case the cval only affects the outer border of the 2d array, not the inner
-    detectorImageFiltered[:nh, :] = laplace(detectorImage[:nh +1, :], mode='constant', cval=0)[:-1, :]
-    comm.Recv(detectorImageFiltered[nh:, :], source=1, tag=12)
     #Unit Test
     detectorImageFiltered_ref = laplace(detectorImage, mode='constant', cval=0)
     print ("Parallel computation equals sequential :", np.allclose(detectorImageFiltered_ref, detectorImageFiltered))
-else: #<- only since we know that we are running on 2 cores
-    #Only calculate the lower half part but make sure that input contains a additional row
-    #at the start of the array, this first row is skipped in the filtered (partial) result
-    #In this case the cval only affects the outer border of the 2d array, not the inner
-    detectorImageFiltered = laplace(detectorImage[nh -1:, :], mode='constant', cval=0)[1:, :]
-    comm.Send(detectorImageFiltered, dest=0, tag=12)
-
@@ -0,0 +1,227 @@
+'''
+Distributed matrix-vector and matrix-matrix products.
+
+The n x n matrix A can be distributed over the p ranks in three ways:
+- RowDistribution: blocks of rows. y = Ax needs all of x on every rank (Allgatherv), O(n) data per rank.
+- ColumnDistribution: blocks of columns. Each rank computes a partial y of length n, which are summed and split
+  over the ranks (Reduce_scatter), O(n) data per rank.
+- BlockCyclic2D: the ranks form a pr x pc grid, and blocks of blockSize x blockSize elements are dealt out
+  cyclically over it (as in ScaLAPACK). For y = Ax the ranks of a grid column gather the part of x they need
+  (Allgatherv on the column communicator) and the partial products are summed over the grid rows (Allreduce on
+  the row communicator), O(n/sqrt(p)) data per rank. C = AB uses SUMMA: for each block column of A (block row of B)
+  the owners broadcast it along the grid rows (columns) and every rank adds the product of the panels to its
+  block of C.
+
+The matrices and vectors are created directly in distributed form from a function of the global indices, so no
+rank ever holds the whole matrix.
+
+Usage:
+$ mpiexec -n 4 python LinearAlgebra_P.py                       #unit tests
+$ mpiexec -n 4 python LinearAlgebra_P.py bench 1000 2000 4000  #time and data received per rank for several n
+'''
+from mpi4py import MPI
+import numpy as np
+
+from Partition import Partition
+
+
+class RowDistribution:
+    '''Blocks of rows of an n x n matrix, x and y are split the same way'''
+
+    def __init__(self, n, comm=MPI.COMM_WORLD):
+        self.n = n
+        self.comm = comm
+        self.partition = Partition(n, comm)
+        self.rows = np.arange(n)[self.partition.localSlice()]
+        self.cols = np.arange(n)
+        #bytes received by this rank in the products
+        self.commBytes = 0
+
+    def localMatrix(self, f):
+        #f(i, j) gives the elements of the matrix for arrays of global row and column indices
+        return f(self.rows[:, None], self.cols[None, :])
+
+    def localVector(self, f):
+        #Part of the vector x held by this rank
+        return f(self.rows)
+
+    def resultIndices(self):
+        #Global indices of the elements of y = Ax held by this rank
+        return self.rows
+
+    def matvec(self, A_local, x_local):
+        x = self.partition.allgather(x_local)
+        self.commBytes += x.nbytes - x_local.nbytes
+        return A_local @ x
+
+
+class ColumnDistribution:
+    '''Blocks of columns of an n x n matrix, x and y are split in blocks the same way'''
+
+    def __init__(self, n, comm=MPI.COMM_WORLD):
+        self.n = n
+        self.comm = comm
+        self.partition = Partition(n, comm)
+        self.rows = np.arange(n)
+        self.cols = np.arange(n)[self.partition.localSlice()]
+        self.commBytes = 0
+
+    def localMatrix(self, f):
+        return f(self.rows[:, None], self.cols[None, :])
+
+    def localVector(self, f):
+        return f(self.cols)
+
+    def resultIndices(self):
+        return self.cols
+
+    def matvec(self, A_local, x_local):
+        #Partial y from the own columns, summed over the ranks and split in blocks
+        y_partial = A_local @ x_local
+        y_local = np.empty(self.partition.localShape(), dtype=y_partial.dtype)
+        self.comm.Reduce_scatter(y_partial, y_local, recvcounts=self.partition.counts, op=MPI.SUM)
+        self.commBytes += y_partial.nbytes
+        return y_local
+
+
+def cyclicIndices(n, blockSize, numberOfProcs, proc):
+    #Global indices held by proc when blocks of blockSize indices are dealt out cyclically over numberOfProcs
+    blocks = np.arange(proc, -(-n//blockSize), numberOfProcs)
+    indices = (blocks[:, None]*blockSize + np.arange(blockSize)[None, :]).ravel()
+    return indices[indices < n]
+
+
+class BlockCyclic2D:
+    '''
+    2D block-cyclic distribution of n x n matrices over a pr x pc grid of the ranks of comm (dims as given, or as
+    square as possible). x is split over all ranks (each grid column holds the elements of its matrix columns),
+    y = Ax is held by the grid rows (each rank has the elements of its matrix rows).
+    '''
+
+    def __init__(self, n, comm=MPI.COMM_WORLD, blockSize=64, dims=None):
+        self.n = n
+        self.blockSize = blockSize
+        self.dims = dims or MPI.Compute_dims(comm.Get_size(), 2)
+        self.cart = comm.Create_cart(self.dims, periods=[False, False], reorder=False)
+        self.gridRow, self.gridCol = self.cart.Get_coords(self.cart.Get_rank())
+        #Ranks of the same grid row (ranked by grid column) and of the same grid column (ranked by grid row)
+        self.rowComm = self.cart.Sub([False, True])
+        self.colComm = self.cart.Sub([True, False])
+        self.rows = cyclicIndices(n, blockSize, self.dims[0], self.gridRow)
+        self.cols = cyclicIndices(n, blockSize, self.dims[1], self.gridCol)
+        #The elements of x of the own columns are split over the ranks of the grid column
+        self.xPartition = Partition(len(self.cols), self.colComm)
+        self.commBytes = 0
+
+    def localMatrix(self, f):
+        return f(self.rows[:, None], self.cols[None, :])
+
+    def localVector(self, f):
+        return f(self.cols[self.xPartition.localSlice()])
+
+    def resultIndices(self):
+        return self.rows
+
+    def matvec(self, A_local, x_local):
+        x_cols = self.xPartition.allgather(x_local)
+        y_partial = A_local @ x_cols
+        y_local = np.empty_like(y_partial)
+        self.rowComm.Allreduce(y_partial, y_local, op=MPI.SUM)
+        self.commBytes += x_cols.nbytes - x_local.nbytes + y_partial.nbytes
+        return y_local
+
+    def matmul(self, A_local, B_local):
+        '''SUMMA: C = AB for A, B and C distributed the same way'''
+        C_local = np.zeros((len(self.rows), len(self.cols)), dtype=np.result_type(A_local, B_local))
+        pr, pc = self.dims
+        nb = self.blockSize
+        for k in range(-(-self.n//nb)):
+            width = min(nb, self.n - k*nb)
+            #Block column k of A is held by grid column k % pc, as its local block k // pc
+            ownerCol, ownerRow = k % pc, k % pr
+            if self.gridCol == ownerCol:
+                A_panel = np.ascontiguousarray(A_local[:, (k//pc)*nb:(k//pc)*nb + width])
+            else:
+                A_panel = np.empty((len(self.rows), width), dtype=A_local.dtype)
+                self.commBytes += A_panel.nbytes
+            if self.gridRow == ownerRow:
+                B_panel = np.ascontiguousarray(B_local[(k//pr)*nb:(k//pr)*nb + width, :])
+            else:
+                B_panel = np.empty((width, len(self.cols)), dtype=B_local.dtype)
+                self.commBytes += B_panel.nbytes
+            self.rowComm.Bcast(A_panel, root=ownerCol)
+            self.colComm.Bcast(B_panel, root=ownerRow)
+            C_local += A_panel @ B_panel
+        return C_local
+
+
+#Test matrices and vector, defined elementwise from the global indices
+matrixA = lambda i, j: np.sin(0.1*i + 0.37*j) + (i == j)
+matrixB = lambda i, j: np.cos(0.05*i - 0.21*j)
+vectorX = lambda j: np.cos(0.3*j)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        sizes = [int(n) for n in sys.argv[2:]] or [500, 1000, 2000, 4000]
+        if rank == 0:
+            print (f"{size} ranks, data received per rank (max over ranks) and time per product")
+        for n in sizes:
+            for name, distribution in (("row", RowDistribution(n)), ("column", ColumnDistribution(n)),
+                                       ("2D block-cyclic", BlockCyclic2D(n))):
+                A_local = distribution.localMatrix(matrixA)
+                x_local = distribution.localVector(vectorX)
+                distribution.matvec(A_local, x_local)
+                distribution.commBytes = 0
+                repeats = 10
+                comm.Barrier()
+                t0 = time.perf_counter()
+                for _ in range(repeats):
+                    distribution.matvec(A_local, x_local)
+                elapsed = comm.reduce(time.perf_counter() - t0, op=MPI.MAX, root=0)
+                commBytes = comm.reduce(distribution.commBytes/repeats, op=MPI.MAX, root=0)
+                if rank == 0:
+                    print (f"  n={n:6d} matvec {name:16s} {commBytes/1024:10.1f} KiB {elapsed/repeats*1e3:8.3f} ms")
+            distribution = BlockCyclic2D(n)
+            A_local, B_local = distribution.localMatrix(matrixA), distribution.localMatrix(matrixB)
+            comm.Barrier()
+            t0 = time.perf_counter()
+            distribution.matmul(A_local, B_local)
+            elapsed = comm.reduce(time.perf_counter() - t0, op=MPI.MAX, root=0)
+            commBytes = comm.reduce(distribution.commBytes, op=MPI.MAX, root=0)
+            if rank == 0:
+                print (f"  n={n:6d} matmul SUMMA           {commBytes/1024:10.1f} KiB {elapsed*1e3:8.3f} ms")
+        sys.exit()
+
+    #Unit tests, rank 0 computes the products sequentially
+    n = 203
+    i = np.arange(n)
+    if rank == 0:
+        A = matrixA(i[:, None], i[None, :])
+        B = matrixB(i[:, None], i[None, :])
+        x = vectorX(i)
+    for name, distribution in (("row", RowDistribution(n)), ("column", ColumnDistribution(n)),
+                               ("2D block-cyclic", BlockCyclic2D(n, blockSize=16))):
+        y_local = distribution.matvec(distribution.localMatrix(matrixA), distribution.localVector(vectorX))
+        pieces = comm.gather((distribution.resultIndices(), y_local), root=0)
+        if rank == 0:
+            y = np.empty(n)
+            for indices, values in pieces:
+                y[indices] = values
+            print (f"matvec ({name}): Parallel computation equals sequential :", np.allclose(A @ x, y))
+
+    distribution = BlockCyclic2D(n, blockSize=16)
+    C_local = distribution.matmul(distribution.localMatrix(matrixA), distribution.localMatrix(matrixB))
+    pieces = comm.gather((distribution.rows, distribution.cols, C_local), root=0)
+    if rank == 0:
+        C = np.empty((n, n))
+        for rows, cols, values in pieces:
+            C[np.ix_(rows, cols)] = values
+        print ("matmul (SUMMA): Parallel computation equals sequential :", np.allclose(A @ B, C))
@@ -1,21 +1,39 @@
 '''
 Parallel (row-wise) Matrix times vector multiplication Ax = b
+
+Usage:
+$ mpiexec -n 3 python MatrixVector.py                  #4x4 matrix created on rank 0
+$ mpiexec -n 3 python MatrixVector.py A.npy x.npy b.npy  #each rank reads its rows of A and writes its part of b
 '''
 from mpi4py import MPI
 import numpy as np
+import sys
+
+from Partition import Partition
+from ParallelIO import arrayShape, readRows, writeRows
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
+if len(sys.argv) > 3:
+    #Parallel I/O: the rows of A are read by the ranks that need them instead of being scattered from rank 0
+    partition = Partition(arrayShape(sys.argv[1]))
+    A_local = readRows(sys.argv[1], partition)
+    x = readRows(sys.argv[2], Partition(arrayShape(sys.argv[2]), MPI.COMM_SELF)) #every rank needs all of x
+    writeRows(sys.argv[3], np.dot(A_local, x), Partition(partition.shape[0]))
+    if rank == 0:
+        #Unit test, rank 0 reads the whole files (a partition over COMM_SELF has all the rows)
+        A = readRows(sys.argv[1], Partition(partition.shape, MPI.COMM_SELF))
+        b = readRows(sys.argv[3], Partition(partition.shape[0], MPI.COMM_SELF))
+        print ("Parallel computation equals sequential :", np.allclose(np.dot(A, x), b))
+    sys.exit()
+
 matrixSize = 4 #Square matrix
-matrixRowsPerRank = matrixSize//size
 vectorLength = matrixSize #Mandatory for well defined multiplication
 
-if matrixSize % size != 0:
-    if rank == 0:
-        print ("WARNING: Number of matrix rows is not multiple of number of cores")
-        comm.Abort(1)
+#The rows are split as evenly as possible over the ranks (matrixSize needs not be a multiple of size)
+partition = Partition((matrixSize, matrixSize))
 
 #Allocate and/or initialize/define data (rank dependent)
 #--------------------------------------------------------
@@ -30,8 +48,7 @@ else:
 
 # Scatter Matrix
 # --------------
-A_local = np.empty((matrixRowsPerRank, matrixSize), dtype=np.float64)
-comm.Scatter(A, A_local, root=0)
+A_local = partition.scatter(A, dtype=np.float64)
 
 # Broadcast vector
 # ----------------
@@ -43,7 +60,7 @@ b_local = np.dot(A_local, x)
 
 # Gather local results
 # --------------------
-comm.Gather(b_local, b, root=0)
+Partition(vectorLength).gather(b_local, out=b)
 
 # Unit Test (Possible since process 0 holds entire A in memory)
 # -------------------------------------------------------------
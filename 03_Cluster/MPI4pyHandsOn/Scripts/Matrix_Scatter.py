@@ -1,15 +1,14 @@
 from mpi4py import MPI
 import numpy as np
 
+from Partition import Partition
+
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
 matrixSize = 6 #Square matrix
 
-if matrixSize % size != 0:
-    print ("Warning, number of rows is not multiple of number of cores")
-
 # Only rank 0 creates the full array
 if rank == 0:
     A = np.arange(matrixSize**2, dtype=np.float64).reshape(matrixSize, matrixSize)
@@ -18,13 +17,12 @@ else:
     A = None #This declaration is mandatory
 
 # Scatter the rows
-# Calculate how many rows each process gets (above we made sure that no remainder)
-MatrixRowsPerProcess = matrixSize//size
-#Allocate memory for row-slices (also for process 0)
-A_rows = np.empty((MatrixRowsPerProcess, matrixSize), dtype=np.float64)
+# Calculate how many rows each process gets (the first matrixSize % size processes get one row more)
+partition = Partition((matrixSize, matrixSize))
+print(f"Process {rank} gets rows {partition.localSlice()}")
 
-# Scatter the rows (collective operation)
-comm.Scatter(A, A_rows, root=0)
+# Scatter the rows (collective operation), allocates the row-slices (also for process 0)
+A_rows = partition.scatter(A, dtype=np.float64)
 
 # Print the result on each process
 print(f"Process {rank} received:\n{A_rows}")
@@ -3,39 +3,59 @@ import numpy as np
 import sys
 import time
 
+from Partition import Partition
+from ParallelIO import arrayShape, readRows
+from Reductions import reduceArray
+
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-# Ensure we are using 4 processes
-assert size == 4, "This script is designed for exactly 4 MPI processes."
-
-global_size = int(sys.argv[1])
 global_array = None
 
-if rank == 0:
-    # Root process creates the array (random int values)
-    global_array = np.random.randint(low=0, high=10*global_size, size=global_size)
-    #print (global_array)
-    start_time = time.time()
+#Either the size of a random array created on root, or a .npy/.h5 file each process reads its own part of
+if sys.argv[1].isdigit():
+    global_size = int(sys.argv[1])
 
-# Split the array into 4 chunks (one per process)
-local_size = global_size // size
-local_array = np.empty(local_size, dtype=np.int64)
+    if rank == 0:
+        # Root process creates the array (random int values)
+        global_array = np.random.randint(low=0, high=10*global_size, size=global_size).astype(np.int64)
+        #print (global_array)
+        start_time = time.time()
 
-# Scatter the array to all processes
-comm.Scatter(global_array, local_array, root=0)
+    # Split the array into balanced chunks (one per process), works for any number of processes
+    partition = Partition(global_size)
 
-#if rank == 0:   start_time = time.time() #Computation only (no IPC)
-# Compute the local maximum
-local_max = np.max(local_array)
-print(f"Process {rank}: Local max = {local_max}")
+    # Scatter the array to all processes
+    local_array = partition.scatter(global_array, dtype=np.int64)
+else:
+    # Each process reads its chunk from the file, the whole array is never in the memory of one process
+    if rank == 0:
+        start_time = time.time()
+    partition = Partition(arrayShape(sys.argv[1]))
+    local_array = readRows(sys.argv[1], partition)
 
-# Reduce all local maxima to find the global maximum
-global_max = comm.reduce(local_max, op=MPI.MAX, root=0)
+#if rank == 0:   start_time = time.time() #Computation only (no IPC)
+# Compute the local maximum (as a 1 element array, so that it can be reduced without pickling)
+compute_start = time.time()
+#With more processes than elements some processes have none, their maximum is the lowest value of the dtype
+lowest = np.iinfo(local_array.dtype).min if np.issubdtype(local_array.dtype, np.integer) else -np.inf
+local_max = np.array([np.max(local_array, initial=lowest)], dtype=local_array.dtype)
+compute_time = time.time() - compute_start
+if local_array.size > 0:
+    print(f"Process {rank}: Local max = {local_max[0]}")
+
+# Reduce all local maxima to find the global maximum (buffer based Reduce)
+communication_start = time.time()
+global_max = reduceArray(local_max, op=MPI.MAX, root=0)
+communication_time = time.time() - communication_start
 
 # Print the global maximum on the root process
 if rank == 0:
     end_time = time.time()
-    print(f"Time to find maximum: {end_time - start_time} sec")
+    print(f"Time to find maximum: {end_time - start_time} sec"
+          f" (local maximum {compute_time} sec, reduction {communication_time} sec on rank 0)")
+    global_max = global_max[0]
     print(f"Global maximum: {global_max:}")
+    if global_array is not None:
+        print ("Parallel computation equals sequential :", global_max == np.max(global_array))
@@ -1,5 +1,14 @@
+'''
+Usage:
+$ mpiexec -n 4 python NormalizeImage_P.py                              #random image created on rank 0
+$ mpiexec -n 4 python NormalizeImage_P.py image.npy normalized.npy     #each rank reads/writes its rows (.npy or .h5)
+'''
 from mpi4py import MPI
 import numpy as np
+import sys
+
+from Partition import Partition
+from ParallelIO import arrayShape, readRows, writeRows
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
@@ -9,27 +18,32 @@ numberOfRows = 220
 numberOfColumns = 200
 bitDepth = 8
 
+if len(sys.argv) > 2:
+    #Parallel I/O: each rank reads its rows of the image and writes its normalized rows, nothing goes through rank 0
+    partition = Partition(arrayShape(sys.argv[1]))
+    detectorImageSlice = readRows(sys.argv[1], partition)
+    writeRows(sys.argv[2], detectorImageSlice / 2**bitDepth, partition)
+    if rank == 0:
+        #Unit test, rank 0 reads the whole files (a partition over COMM_SELF has all the rows)
+        wholeImage = Partition(partition.shape, MPI.COMM_SELF)
+        detectorImage = readRows(sys.argv[1], wholeImage)
+        detectorImageNormalized = readRows(sys.argv[2], wholeImage)
+        print ("Parallel computation equals sequential :", np.allclose(detectorImage/2**bitDepth, detectorImageNormalized))
+    sys.exit()
+
 if rank == 0:
     detectorImage = np.random.randint(2**bitDepth, size=(numberOfRows,numberOfColumns)).astype(np.float64)
 else:
     detectorImage = None
 
-numberOfRowsPerCore = numberOfRows//size
+#The rows are split as evenly as possible (numberOfRows needs not be a multiple of size)
+partition = Partition((numberOfRows, numberOfColumns))
 
-detectorImageSlice = np.empty((numberOfRowsPerCore, numberOfColumns), dtype=np.float64)
-
-comm.Scatter(detectorImage, detectorImageSlice, root=0)
+detectorImageSlice = partition.scatter(detectorImage, dtype=np.float64)
 
 detectorImageSliceNormalized = detectorImageSlice / 2**bitDepth
 
-if rank == 0:
-    detectorImageNormalized = np.empty((numberOfRows,numberOfColumns) , dtype=np.float64)
-else:
-    detectorImageNormalized = None
-
-comm.Gather(detectorImageSliceNormalized, detectorImageNormalized, root=0)
+detectorImageNormalized = partition.gather(detectorImageSliceNormalized)
 
 if rank == 0:
     print ("Parallel computation equals sequential :", np.allclose(detectorImage/2**bitDepth, detectorImageNormalized))
-
-
@@ -0,0 +1,175 @@
+'''
+Parallel reading and writing of the rows of an array, each rank accessing only its own slice of the file.
+
+Loading the whole array on root and scattering it limits the problem size to the memory of root, and all the
+data goes through root. Here each rank reads (and writes) the rows given by a Partition (see Partition.py)
+directly from (to) the file:
+- .npy files with MPI-IO (collective Read_at_all/Write_at_all at the offset of the rows), or with a memory map
+- HDF5 datasets by reading/writing a hyperslab, with the MPI driver if h5py was built with it (otherwise the
+  reads are independent and the writes are done one rank after the other)
+
+Usage:
+    partition = Partition(arrayShape("image.npy"))
+    localRows = readRows("image.npy", partition)
+    writeRows("normalized.npy", localRows / 256, partition)
+
+$ mpiexec -n 4 python ParallelIO.py 4096   #compares with reading on root and scattering for a 4096x4096 image
+'''
+from mpi4py import MPI
+import numpy as np
+
+from Partition import Partition
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def _isHdf5(path):
+    return str(path).endswith((".h5", ".hdf5"))
+
+def _h5pyParallel():
+    return h5py.get_config().mpi
+
+def _npyHeader(path):
+    #Returns (shape, dtype, offset of the data) of a .npy file
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+        if fortranOrder:
+            raise ValueError(f"{path} is in Fortran order, only C order .npy files can be read by rows")
+        return shape, dtype, f.tell()
+
+
+def arrayShape(path, dataset="data"):
+    '''Returns the shape of the array in a .npy file or of dataset in an HDF5 file'''
+    if _isHdf5(path):
+        with h5py.File(path, "r") as f:
+            return f[dataset].shape
+    return _npyHeader(path)[0]
+
+
+def readRows(path, partition, dataset="data", method="mpiio"):
+    '''
+    Reads the rows of the array in path given to this rank by partition. For .npy files method is "mpiio"
+    (collective read, all the ranks of partition.comm must call it) or "memmap".
+    '''
+    rows = partition.localSlice()
+    if _isHdf5(path):
+        if _h5pyParallel():
+            with h5py.File(path, "r", driver="mpio", comm=partition.comm) as f:
+                return f[dataset][rows]
+        with h5py.File(path, "r") as f:
+            return f[dataset][rows]
+
+    shape, dtype, offset = _npyHeader(path)
+    if method == "memmap":
+        return np.array(np.load(path, mmap_mode="r")[rows])
+    local = np.empty(partition.localShape(), dtype=dtype)
+    fh = MPI.File.Open(partition.comm, str(path), MPI.MODE_RDONLY)
+    #The data is read as bytes, so that any dtype (and byte order) is supported
+    fh.Read_at_all(offset + rows.start*partition.rowSize*dtype.itemsize, [local, MPI.BYTE])
+    fh.Close()
+    return local
+
+
+def writeRows(path, local, partition, dataset="data"):
+    '''
+    Writes the rows of this rank to the array in path (created with the shape of partition and the dtype of local).
+    All the ranks of partition.comm must call it.
+    '''
+    comm = partition.comm
+    rows = partition.localSlice()
+    local = np.ascontiguousarray(local)
+    if _isHdf5(path):
+        if _h5pyParallel():
+            with h5py.File(path, "w", driver="mpio", comm=comm) as f:
+                f.create_dataset(dataset, shape=partition.shape, dtype=local.dtype)[rows] = local
+            return
+        if comm.Get_rank() == 0:
+            with h5py.File(path, "w") as f:
+                f.create_dataset(dataset, shape=partition.shape, dtype=local.dtype)
+        #Without the MPI driver the file can only be open for writing by one rank at a time
+        for writer in range(comm.Get_size()):
+            if comm.Get_rank() == writer:
+                with h5py.File(path, "r+") as f:
+                    f[dataset][rows] = local
+            comm.Barrier()
+        return
+
+    #Root writes the header (and sizes the file), then all ranks write their rows at their offset
+    if comm.Get_rank() == 0:
+        np.lib.format.open_memmap(path, mode="w+", dtype=local.dtype, shape=partition.shape).flush()
+    comm.Barrier()
+    _, dtype, offset = _npyHeader(path)
+    fh = MPI.File.Open(comm, str(path), MPI.MODE_WRONLY)
+    fh.Write_at_all(offset + rows.start*partition.rowSize*dtype.itemsize, [local, MPI.BYTE])
+    fh.Close()
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    import time
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    directory = comm.bcast(tempfile.mkdtemp() if rank == 0 else None, root=0)
+    paths = [os.path.join(directory, "image.npy")] + ([os.path.join(directory, "image.h5")] if h5py else [])
+    if rank == 0:
+        image = np.random.random((n, n))
+        np.save(paths[0], image)
+        if h5py:
+            with h5py.File(paths[1], "w") as f:
+                f["data"] = image
+    comm.Barrier()
+
+    for path in paths:
+        partition = Partition(arrayShape(path))
+        methods = ["mpiio", "memmap"] if not _isHdf5(path) else ["hyperslab"]
+        for method in methods:
+            comm.Barrier()
+            t0 = time.perf_counter()
+            local = readRows(path, partition, method=method)
+            readTime = comm.reduce(time.perf_counter() - t0, op=MPI.MAX, root=0)
+
+            #Reference: root loads everything and scatters
+            comm.Barrier()
+            t0 = time.perf_counter()
+            if rank == 0:
+                if _isHdf5(path):
+                    with h5py.File(path, "r") as f:
+                        image = f["data"][()]
+                else:
+                    image = np.load(path)
+            else:
+                image = None
+            local_ref = partition.scatter(image, dtype=local.dtype)
+            scatterTime = comm.reduce(time.perf_counter() - t0, op=MPI.MAX, root=0)
+
+            outPath = path.replace("image", "out")
+            comm.Barrier()
+            t0 = time.perf_counter()
+            writeRows(outPath, local*2, partition)
+            writeTime = comm.reduce(time.perf_counter() - t0, op=MPI.MAX, root=0)
+
+            if rank == 0:
+                print (f"{os.path.basename(path)} ({method}): read {readTime:.3f} s (root + scatter {scatterTime:.3f} s),"
+                       f" write {writeTime:.3f} s")
+            readBack = readRows(outPath, partition)
+            equal = comm.allreduce(np.array_equal(local, local_ref) and np.array_equal(readBack, local*2), op=MPI.LAND)
+            if rank == 0:
+                print ("  Parallel I/O equals sequential :", equal)
+
+    comm.Barrier()
+    if rank == 0:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
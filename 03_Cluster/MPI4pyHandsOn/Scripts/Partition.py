@@ -0,0 +1,84 @@
+'''
+Balanced partitioning of NumPy arrays over MPI ranks.
+
+Scatter/Gather need the array to split evenly over the ranks (the remainder rows are silently dropped otherwise).
+A Partition splits the first axis of an array of any shape over any number of ranks, the first ranks getting one
+row more than the others, and wraps Scatterv/Gatherv/Allgatherv with the matching counts and displacements. The
+buffers are passed to MPI directly, so contiguous arrays are not copied.
+
+Usage:
+    partition = Partition((numberOfRows, numberOfColumns))
+    localRows = partition.scatter(image)           #image only needed on root
+    image = partition.gather(localRows)            #on root, None on the other ranks
+    image = partition.allgather(localRows)         #on all ranks
+'''
+from mpi4py import MPI
+import numpy as np
+
+
+def balancedCounts(n, size):
+    '''Splits n items over size ranks, returns the (counts, displacements) arrays'''
+    counts = np.full(size, n//size)
+    counts[:n % size] += 1
+    displacements = np.zeros(size, dtype=counts.dtype)
+    displacements[1:] = np.cumsum(counts)[:-1]
+    return counts, displacements
+
+
+class Partition:
+    '''Split of the first axis of an array of the given shape over the ranks of comm'''
+
+    def __init__(self, shape, comm=MPI.COMM_WORLD):
+        self.shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        #rows (along the first axis) of each rank
+        self.counts, self.displacements = balancedCounts(self.shape[0], comm.Get_size())
+        #number of elements in a row
+        self.rowSize = int(np.prod(self.shape[1:], dtype=np.int64))
+
+    def localShape(self, rank=None):
+        rank = self.rank if rank is None else rank
+        return (int(self.counts[rank]),) + self.shape[1:]
+
+    def localSlice(self, rank=None):
+        #The rows of the global array held by rank
+        rank = self.rank if rank is None else rank
+        start = int(self.displacements[rank])
+        return slice(start, start + int(self.counts[rank]))
+
+    def _vectorBuffer(self, array):
+        #Buffer with the element counts and displacements of the ranks, for the v-variants of the collectives
+        return [array, (self.counts*self.rowSize, self.displacements*self.rowSize)]
+
+    def scatter(self, array, root=0, out=None, dtype=None):
+        '''
+        Scatters array (only needed on root) and returns the local rows. The dtype of array is broadcast from root
+        unless dtype or a preallocated out is given.
+        '''
+        if out is None:
+            if dtype is None:
+                dtype = self.comm.bcast(array.dtype if self.rank == root else None, root=root)
+            out = np.empty(self.localShape(), dtype=dtype)
+        sendBuffer = self._vectorBuffer(np.ascontiguousarray(array)) if self.rank == root else None
+        self.comm.Scatterv(sendBuffer, out, root=root)
+        return out
+
+    def gather(self, local, root=0, out=None):
+        '''Gathers the local rows of all ranks on root and returns the global array there (None on the other ranks)'''
+        local = np.ascontiguousarray(local)
+        if self.rank == root:
+            if out is None:
+                out = np.empty(self.shape, dtype=local.dtype)
+            self.comm.Gatherv(local, self._vectorBuffer(out), root=root)
+            return out
+        self.comm.Gatherv(local, None, root=root)
+        return None
+
+    def allgather(self, local, out=None):
+        '''Gathers the local rows of all ranks on all ranks and returns the global array'''
+        local = np.ascontiguousarray(local)
+        if out is None:
+            out = np.empty(self.shape, dtype=local.dtype)
+        self.comm.Allgatherv(local, self._vectorBuffer(out))
+        return out
@@ -1,50 +1,147 @@
+'''
+Distributed random forest training.
+
+Each rank reads only its shard of the training set (see ParallelIO.py), trains its share of the trees on it, and
+the fitted trees are merged into one RandomForestClassifier on rank 0. For inference the merged forest is sent to
+all ranks and each rank predicts its shard of the test set.
+
+Alternatively the trees stay on the ranks that trained them: every rank computes the class probabilities of its
+trees for a batch of test samples, and the (tree weighted) probabilities are summed on rank 0 with a buffer based
+Reduce into a preallocated array. The test set is streamed in batches, so the memory of rank 0 stays bounded.
+
+Usage:
+$ mpiexec -n 4 python RandomForest_P.py               #synthetic dataset written by rank 0 to a temporary directory
+$ mpiexec -n 4 python RandomForest_P.py dataDir 500   #dataDir holds X_train.npy, y_train.npy, X_test.npy, y_test.npy,
+                                                      #test batches of 500 samples
+'''
 from mpi4py import MPI
 import numpy as np
 from sklearn.datasets import make_classification
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
+import copy
+import os
+import sys
+import tempfile
+import time
+
+from Partition import Partition, balancedCounts
+from ParallelIO import arrayShape, readRows
 
 # Initialize MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-#Generate or load your dataset (a synthetic dataset). Every process holds all data which is
-#clearly inefficient, in a productive application, each rank would reads its share from e.g a hdf5 file
-X, y = make_classification(n_samples=1000, n_features=20, random_state=42)
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-print ("Train", X_train.shape, y_train.shape)
-print ("Test", X_test.shape, y_test.shape)
+numberOfTrees = max(100, size)
+
+
+def readShard(dataDir, name):
+    #Rows of dataDir/name.npy of this rank, and the partition of the rows
+    path = os.path.join(dataDir, name + ".npy")
+    partition = Partition(arrayShape(path))
+    return readRows(path, partition), partition
+
+def mergeForests(forests):
+    #One forest with the trees of all forests (predict_proba averages over the trees, so every tree counts the same)
+    merged = copy.copy(forests[0])
+    merged.estimators_ = list(forests[0].estimators_)
+    for forest in forests[1:]:
+        if not np.array_equal(forest.classes_, merged.classes_):
+            raise ValueError("The forests were trained on different classes")
+        merged.estimators_ += forest.estimators_
+    merged.n_estimators = len(merged.estimators_)
+    return merged
 
-# Split training data across processes (in a module fashion)
-X_train_local = X_train[rank::size]
-y_train_local = y_train[rank::size]
+def streamProba(model, weight, X, batchSize, root=0):
+    '''
+    Yields (rows, probabilities) for consecutive batches of the samples X (e.g. a memory map) on root (None on the
+    other ranks): the sum over the ranks of weight times the predict_proba of model. All ranks must iterate.
+    '''
+    numberOfClasses = len(model.classes_)
+    #Buffers allocated once, the last (smaller) batch uses the first rows
+    localProba = np.empty((batchSize, numberOfClasses))
+    proba = np.empty((batchSize, numberOfClasses)) if rank == root else None
+    for start in range(0, len(X), batchSize):
+        n = min(batchSize, len(X) - start)
+        np.multiply(model.predict_proba(X[start:start + n]), weight, out=localProba[:n])
+        comm.Reduce(localProba[:n], proba[:n] if rank == root else None, op=MPI.SUM, root=root)
+        yield slice(start, start + n), (proba[:n] if rank == root else None)
 
-print ("Local Train", X_train_local.shape, y_train_local.shape)
 
-# Train a local model
-model = RandomForestClassifier(n_estimators=10, random_state=42)
-model.fit(X_train_local, y_train_local)
+if len(sys.argv) > 1:
+    dataDir = sys.argv[1]
+else:
+    #Rank 0 generates a synthetic dataset and writes it, every rank then reads only its shard
+    dataDir = None
+    if rank == 0:
+        dataDir = tempfile.mkdtemp()
+        X, y = make_classification(n_samples=10000, n_features=20, random_state=42)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        for name, array in (("X_train", X_train), ("y_train", y_train), ("X_test", X_test), ("y_test", y_test)):
+            np.save(os.path.join(dataDir, name + ".npy"), array)
+    dataDir = comm.bcast(dataDir, root=0)
 
-# Make local predictions (on full test set)
-y_pred_local = model.predict(X_test)
-print ("Local Test", X_test.shape, y_pred_local.shape)
+X_train_local, _ = readShard(dataDir, "X_train")
+y_train_local, _ = readShard(dataDir, "y_train")
+print ("Rank", rank, "Local Train", X_train_local.shape, y_train_local.shape)
 
-# Gather predictions from all processes to rank 0
-all_preds = comm.gather(y_pred_local, root=0)
+# The trees of a forest must all know all the classes
+classes = np.unique(np.concatenate(comm.allgather(np.unique(y_train_local))))
+#The decision is collective, so that all the ranks stop rather than some of them waiting in the gather forever
+missing = comm.allgather(len(np.unique(y_train_local)) != len(classes))
+if any(missing):
+    raise ValueError(f"The training shards of ranks {[r for r in range(size) if missing[r]]} miss some of the classes"
+                     f" {classes}, shuffle the data")
 
+# Train this rank's share of the trees on the local shard
+comm.Barrier()
+start_time = time.time()
+treeCounts, _ = balancedCounts(numberOfTrees, size)
+localModel = RandomForestClassifier(n_estimators=int(treeCounts[rank]), random_state=42 + rank)
+localModel.fit(X_train_local, y_train_local)
+
+# Merge the trees on rank 0 (the fitted trees are pickled)
+forests = comm.gather(localModel, root=0)
+model = mergeForests(forests) if rank == 0 else None
 if rank == 0:
-    print ("Rank 0 gathered a", type(all_preds)) #Above syntax returns a list
-    # Stack predictions and compute ensemble prediction
-    all_preds = np.vstack(all_preds)
-    print (all_preds.dtype, all_preds.shape)
-    # For classification: majority vote
-    y_pred_ensemble = np.round(np.mean(all_preds, axis=0)).astype(int)
-    print (y_pred_ensemble)
-    # For regression: average
-    #y_pred_ensemble = np.mean(all_preds, axis=0)
+    print (f"Trained {model.n_estimators} trees on {size} ranks in {time.time() - start_time:.2f} sec")
+
+# Distributed inference: all ranks get the merged forest and predict their shard of the test set
+model = comm.bcast(model, root=0)
+X_test_local, testPartition = readShard(dataDir, "X_test")
+y_pred_local = model.predict(X_test_local)
+y_pred = Partition(testPartition.shape[0]).gather(y_pred_local)
 
+if rank == 0:
+    X_test = np.load(os.path.join(dataDir, "X_test.npy"))
+    y_test = np.load(os.path.join(dataDir, "y_test.npy"))
+    print ("Parallel computation equals sequential :", np.array_equal(model.predict(X_test), y_pred))
     # Evaluate ensemble performance
-    accuracy = np.mean(y_pred_ensemble == y_test)
+    accuracy = np.mean(y_pred == y_test)
     print(f"Ensemble accuracy: {accuracy:.2f}")
 
+# Probability averaging inference: the trees stay on their ranks, each rank weights the mean probability of its
+# trees by its share of the trees, and the sum over the ranks is the mean over all the trees
+batchSize = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+X_test = np.load(os.path.join(dataDir, "X_test.npy"), mmap_mode="r")
+if rank == 0:
+    y_test = np.load(os.path.join(dataDir, "y_test.npy"))
+    numberCorrect = 0
+    probaEqual = True
+for rows, proba in streamProba(localModel, treeCounts[rank]/numberOfTrees, X_test, batchSize):
+    if rank == 0:
+        #Only one batch of probabilities is in memory at a time
+        numberCorrect += np.sum(localModel.classes_[np.argmax(proba, axis=1)] == y_test[rows])
+        probaEqual &= np.allclose(proba, model.predict_proba(X_test[rows]))
+if rank == 0:
+    print ("Probability averaging equals merged forest :", probaEqual)
+    print(f"Ensemble accuracy (probability averaging): {numberCorrect/len(y_test):.2f}")
+
+if len(sys.argv) == 1:
+    #Remove the synthetic dataset
+    comm.Barrier()
+    if rank == 0:
+        for name in os.listdir(dataDir):
+            os.remove(os.path.join(dataDir, name))
+        os.rmdir(dataDir)
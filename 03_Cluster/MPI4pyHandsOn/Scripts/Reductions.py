@@ -0,0 +1,178 @@
+'''
+Parallel reductions of NumPy arrays.
+
+- reduceArray/allreduceArray: buffer based Reduce/Allreduce of arrays (no pickling, the result goes into a
+  preallocated array)
+- statistics: min, max, sum, sum of squares, count and the maximum with its global index of distributed data in a
+  single pass and a single message, combined by the custom operation STATISTICS
+- argmax: elementwise maximum and its location over the ranks with the custom operation ARGMAX (ties go to the
+  smaller index)
+The custom operations reduce whole records, one element of the datatypes STATISTICS_TYPE and ARGMAX_TYPE each
+
+Usage:
+$ mpiexec -n 4 python Reductions.py                   #unit tests
+$ mpiexec -n 4 python Reductions.py bench 1e6 1e7 1e8  #compute and communication times for several global sizes
+'''
+from mpi4py import MPI
+import numpy as np
+
+from Partition import Partition
+
+#Fields of the statistics buffer
+MIN, MAX, SUM, SUMSQ, COUNT, ARGMAX_VALUE, ARGMAX_INDEX = range(7)
+NUMBER_OF_STATISTICS = 7
+
+
+def reduceArray(local, op=MPI.SUM, root=0, comm=MPI.COMM_WORLD, out=None, datatype=None):
+    '''
+    Elementwise reduction of the arrays local of all ranks, returned on root (in out if given). If datatype is
+    given the elements reduced are the records of that MPI datatype (e.g. a row of STATISTICS_TYPE doubles)
+    '''
+    local = np.ascontiguousarray(local)
+    if comm.Get_rank() == root and out is None:
+        out = np.empty_like(local)
+    if datatype is None:
+        comm.Reduce(local, out if comm.Get_rank() == root else None, op=op, root=root)
+    else:
+        comm.Reduce([local, datatype], [out, datatype] if comm.Get_rank() == root else None, op=op, root=root)
+    return out if comm.Get_rank() == root else None
+
+def allreduceArray(local, op=MPI.SUM, comm=MPI.COMM_WORLD, out=None, datatype=None):
+    '''Elementwise reduction of the arrays local of all ranks, returned on all ranks (in out if given)'''
+    local = np.ascontiguousarray(local)
+    if out is None:
+        out = np.empty_like(local)
+    if datatype is None:
+        comm.Allreduce(local, out, op=op)
+    else:
+        comm.Allreduce([local, datatype], [out, datatype], op=op)
+    return out
+
+
+def _combineStatistics(inBuffer, inoutBuffer, datatype):
+    a = np.frombuffer(inBuffer, dtype=np.float64).reshape(-1, NUMBER_OF_STATISTICS)
+    b = np.frombuffer(inoutBuffer, dtype=np.float64).reshape(-1, NUMBER_OF_STATISTICS)
+    np.minimum(a[:, MIN], b[:, MIN], out=b[:, MIN])
+    np.maximum(a[:, MAX], b[:, MAX], out=b[:, MAX])
+    b[:, SUM:COUNT + 1] += a[:, SUM:COUNT + 1]
+    _combineArgmax(a[:, ARGMAX_VALUE:], b[:, ARGMAX_VALUE:])
+
+def _combineArgmax(a, b):
+    #a and b are (n, 2) arrays of (value, index), the result goes into b
+    better = (a[:, 0] > b[:, 0]) | ((a[:, 0] == b[:, 0]) & (a[:, 1] < b[:, 1]))
+    b[better] = a[better]
+
+def _argmaxOperation(inBuffer, inoutBuffer, datatype):
+    _combineArgmax(np.frombuffer(inBuffer, dtype=np.float64).reshape(-1, 2),
+                   np.frombuffer(inoutBuffer, dtype=np.float64).reshape(-1, 2))
+
+STATISTICS = MPI.Op.Create(_combineStatistics, commute=True)
+ARGMAX = MPI.Op.Create(_argmaxOperation, commute=True)
+
+#The operations are applied to whole records: MPI may split a reduction into pieces of any number of elements,
+#so each record is one element of a contiguous datatype rather than several MPI.DOUBLE
+STATISTICS_TYPE = MPI.DOUBLE.Create_contiguous(NUMBER_OF_STATISTICS).Commit()
+ARGMAX_TYPE = MPI.DOUBLE.Create_contiguous(2).Commit()
+
+
+def localStatistics(local, offset=0, out=None):
+    '''The statistics buffer of the local data, whose first element has the global index offset'''
+    local = np.ravel(local)
+    if out is None:
+        out = np.empty(NUMBER_OF_STATISTICS)
+    if local.size == 0:
+        #Neutral element
+        out[:] = (np.inf, -np.inf, 0, 0, 0, -np.inf, np.inf)
+        return out
+    i = np.argmax(local)
+    out[:] = (local.min(), local[i], local.sum(dtype=np.float64), np.dot(local, local), local.size, local[i], offset + i)
+    return out
+
+def statistics(local, offset=0, root=0, comm=MPI.COMM_WORLD):
+    '''
+    Global statistics of data distributed over the ranks (local holds the elements with global indices offset,
+    offset + 1, ...) as a dict on root (None on the other ranks): min, max, sum, sumsq, count, mean, std, argmax
+    '''
+    result = reduceArray(localStatistics(local, offset), op=STATISTICS, root=root, comm=comm,
+                         datatype=STATISTICS_TYPE)
+    if result is None:
+        return None
+    mean = result[SUM]/result[COUNT]
+    return dict(min=result[MIN], max=result[MAX], sum=result[SUM], sumsq=result[SUMSQ], count=int(result[COUNT]),
+                mean=mean, std=np.sqrt(max(result[SUMSQ]/result[COUNT] - mean**2, 0)), argmax=int(result[ARGMAX_INDEX]))
+
+def argmax(local, root=0, comm=MPI.COMM_WORLD):
+    '''
+    Elementwise maximum over the ranks of the arrays local and the rank holding it, returns (max, rank) on root
+    (None on the other ranks)
+    '''
+    pairs = np.empty((np.size(local), 2))
+    pairs[:, 0] = np.ravel(local)
+    pairs[:, 1] = comm.Get_rank()
+    result = reduceArray(pairs, op=ARGMAX, root=root, comm=comm, datatype=ARGMAX_TYPE)
+    if result is None:
+        return None
+    return result[:, 0].reshape(np.shape(local)), result[:, 1].astype(np.int64).reshape(np.shape(local))
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        #Each rank creates its part of the array, so global_size is only limited by the memory of all the ranks
+        for global_size in [int(float(n)) for n in sys.argv[2:]] or [10**6, 10**7]:
+            partition = Partition(global_size)
+            local_array = np.random.random(partition.localShape())
+            offset = partition.localSlice().start
+            results = []
+            for name, compute, communicate in (
+                ("max, pickled reduce", lambda: np.max(local_array), lambda v: comm.reduce(v, op=MPI.MAX, root=0)),
+                ("max, Reduce", lambda: np.max(local_array, keepdims=True), lambda v: reduceArray(v, op=MPI.MAX)),
+                ("max, Allreduce", lambda: np.max(local_array, keepdims=True), lambda v: allreduceArray(v, op=MPI.MAX)),
+                ("statistics, one message", lambda: localStatistics(local_array, offset),
+                 lambda v: reduceArray(v, op=STATISTICS, datatype=STATISTICS_TYPE)),
+            ):
+                computeTime = communicationTime = 0
+                repeats = 5
+                for _ in range(repeats):
+                    comm.Barrier()
+                    t0 = time.perf_counter()
+                    value = compute()
+                    t1 = time.perf_counter()
+                    communicate(value)
+                    computeTime += t1 - t0
+                    communicationTime += time.perf_counter() - t1
+                times = np.array([computeTime, communicationTime])/repeats
+                maxTimes = reduceArray(times, op=MPI.MAX)
+                if rank == 0:
+                    results.append((name, maxTimes))
+            if rank == 0:
+                print (f"global_size={global_size} ranks={size}")
+                for name, (computeTime, communicationTime) in results:
+                    print (f"  {name:24s} compute {computeTime*1e3:9.3f} ms, communication {communicationTime*1e3:9.3f} ms")
+        sys.exit()
+
+    #Unit tests, every rank holds its part of a global array known on rank 0
+    global_size = 100003
+    global_array = np.random.default_rng(1).normal(size=global_size)
+    partition = Partition(global_size)
+    local_array = global_array[partition.localSlice()]
+
+    total = allreduceArray(np.array([local_array.sum()]))
+    stats = statistics(local_array, offset=partition.localSlice().start)
+    perRank = np.arange(5.0) * (rank % 3) - rank
+    maxima = argmax(perRank)
+    if rank == 0:
+        print ("Allreduce equals sequential :", np.allclose(total[0], global_array.sum()))
+        print ("Statistics equal sequential :", np.allclose(
+            [stats["min"], stats["max"], stats["sum"], stats["mean"], stats["std"]],
+            [global_array.min(), global_array.max(), global_array.sum(), global_array.mean(), global_array.std()])
+            and stats["count"] == global_size and stats["argmax"] == np.argmax(global_array))
+        allPerRank = np.array([np.arange(5.0) * (r % 3) - r for r in range(size)])
+        print ("Argmax equals sequential :", np.array_equal(maxima[0], allPerRank.max(axis=0))
+               and np.array_equal(maxima[1], allPerRank.argmax(axis=0)))
@@ -0,0 +1,142 @@
+'''
+Allocation-free stencil engine for the heat equation u <- u + dt*alpha*laplace(u) with Dirichlet boundaries.
+
+update() in HeatEq.py allocates several full size temporaries every iteration. Here the grid is stored with a ring
+of ghost cells holding the boundary value (the cval of laplace), two buffers are swapped between iterations and
+the kernel writes into the preallocated output, either with NumPy slice arithmetic into scratch buffers or with a
+Numba loop (if Numba is installed).
+
+Both kernels do exactly the same floating point operations as u + dt*alpha*laplace(u, mode='constant', cval=b)
+(laplace computes -2u + (up + down) per axis and adds the axes), so the results are bitwise identical to it.
+
+Usage:
+$ python Stencil.py   #time per step of update() and of the kernels
+'''
+import numpy as np
+import time
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _laplaceUpdateNumpy(u, uNew, coef, r0, r1, c0, c1, scratch):
+    shape = (r1 - r0, c1 - c0)
+    n = shape[0]*shape[1]
+    if scratch is None or scratch.size < 2*n:
+        scratch = np.empty(2*n)
+    t1 = scratch[:n].reshape(shape)
+    t2 = scratch[n:2*n].reshape(shape)
+    c = u[r0:r1, c0:c1]
+    out = uNew[r0:r1, c0:c1]
+    #t1 = -2u + (up + down)
+    np.add(u[r0-1:r1-1, c0:c1], u[r0+1:r1+1, c0:c1], out=t1)
+    np.multiply(c, -2, out=t2)
+    np.add(t2, t1, out=t1)
+    #t2 = -2u + (left + right)
+    np.add(u[r0:r1, c0-1:c1-1], u[r0:r1, c0+1:c1+1], out=t2)
+    np.multiply(c, -2, out=out)
+    np.add(out, t2, out=t2)
+    #out = u + coef*(t1 + t2)
+    np.add(t1, t2, out=t1)
+    np.multiply(t1, coef, out=t1)
+    np.add(c, t1, out=out)
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _laplaceUpdateNumba(u, uNew, coef, r0, r1, c0, c1):
+        for i in range(r0, r1):
+            for j in range(c0, c1):
+                c = u[i, j]
+                lap = (c*-2.0 + (u[i-1, j] + u[i+1, j])) + (c*-2.0 + (u[i, j-1] + u[i, j+1]))
+                uNew[i, j] = c + coef*lap
+
+else:
+    _laplaceUpdateNumba = None
+
+
+def laplaceUpdate(u, uNew, coef, region=None, scratch=None, useNumba=None):
+    '''
+    Writes uNew[r0:r1, c0:c1] = u + coef*laplace(u) for the cells of region = (r0, r1, c0, c1) of u, which must be
+    surrounded by ghost (or neighbouring) cells. By default the region is everything but the outer ring of cells.
+    scratch is a float64 array of at least twice the size of the region, used by the NumPy kernel (allocated if
+    not given). The Numba kernel is used if Numba is installed and useNumba is not False.
+    '''
+    r0, r1, c0, c1 = region if region is not None else (1, u.shape[0] - 1, 1, u.shape[1] - 1)
+    if r0 >= r1 or c0 >= c1:
+        return
+    if useNumba is None:
+        useNumba = numba is not None
+    if useNumba:
+        _laplaceUpdateNumba(u, uNew, float(coef), r0, r1, c0, c1)
+    else:
+        _laplaceUpdateNumpy(u, uNew, coef, r0, r1, c0, c1, scratch)
+
+
+class HeatStencil:
+    '''Double-buffered heat equation integrator on a grid with a Dirichlet boundary b'''
+
+    def __init__(self, u0, dt, alpha, b, useNumba=None):
+        ny, nx = u0.shape
+        #Both buffers have a ring of ghost cells holding the boundary value, which the kernel never overwrites
+        self.u = np.full((ny + 2, nx + 2), b, dtype=np.float64)
+        self.u[1:-1, 1:-1] = u0
+        self.uNew = self.u.copy()
+        self.coef = dt*alpha
+        self.useNumba = useNumba
+        self.scratch = np.empty(2*ny*nx)
+        self.iteration = 0
+
+    @property
+    def field(self):
+        #View of the current solution (without the ghost cells)
+        return self.u[1:-1, 1:-1]
+
+    def step(self, numberOfIterations=1):
+        for _ in range(numberOfIterations):
+            laplaceUpdate(self.u, self.uNew, self.coef, scratch=self.scratch, useNumba=self.useNumba)
+            self.u, self.uNew = self.uNew, self.u
+        self.iteration += numberOfIterations
+        return self.field
+
+    def run(self, numberOfIterations, snapshotEvery):
+        '''
+        Advances numberOfIterations steps without any plotting, and returns the snapshots of the solution every
+        snapshotEvery steps (including the initial state) in a (numberOfSnapshots, ny, nx) array
+        '''
+        snapshots = np.empty((numberOfIterations//snapshotEvery + 1,) + self.field.shape)
+        snapshots[0] = self.field
+        for i in range(1, len(snapshots)):
+            snapshots[i] = self.step(snapshotEvery)
+        self.step(numberOfIterations % snapshotEvery)
+        return snapshots
+
+
+if __name__ == "__main__":
+    from scipy.ndimage import laplace
+
+    dt = 0.1
+    alpha = 1
+    b = 1.0
+    for n, numberOfIterations in ((50, 2000), (1000, 50)):
+        u0 = np.random.random((n, n))
+
+        u = u0
+        t0 = time.perf_counter()
+        for _ in range(numberOfIterations):
+            u = u + dt*alpha*laplace(u, mode='constant', cval=b)
+        print (f"{n}x{n} update():        {(time.perf_counter() - t0)/numberOfIterations*1e6:9.1f} us/step")
+
+        for name, useNumba in (("numpy", False), ("numba", True)):
+            if useNumba and numba is None:
+                continue
+            stencil = HeatStencil(u0, dt, alpha, b, useNumba)
+            stencil.step() #compiles the Numba kernel
+            stencil = HeatStencil(u0, dt, alpha, b, useNumba)
+            t0 = time.perf_counter()
+            stencil.step(numberOfIterations)
+            print (f"{n}x{n} {name} kernel: {(time.perf_counter() - t0)/numberOfIterations*1e6:9.1f} us/step,",
+                   "bitwise identical :", np.array_equal(stencil.field, u))
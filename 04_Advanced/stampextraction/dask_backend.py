@@ -0,0 +1,244 @@
+#
+# Copyright (C) 2012-2025 Euclid Science Ground Segment
+#
+# This library is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3.0 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""
+:file: python/SHE_PPT/she_io/dask_backend.py
+
+:date: 2025-10-03
+
+"""
+
+import contextlib
+import inspect
+import logging
+import threading
+from collections import OrderedDict
+from itertools import repeat
+
+import numpy as np
+
+from stampextraction.object_index import build_object_index
+from stampextraction.stamps import cut_detector_stamps
+from stampextraction.vis_exposures import ExposureHandlePool
+
+logger = logging.getLogger(__name__)
+
+# NOTE dask is an optional dependency, so it is only imported by the functions that need it
+
+# target size of the chunks of the Dask arrays
+DASK_CHUNK_BYTES = 16 * 1024**2
+
+# the number of exposures kept open in each process, the least recently used are closed beyond it
+MAX_OPEN_EXPOSURES = 64
+
+# the number of files kept open by the exposures opened in each process (for the classes that take a pool)
+MAX_OPEN_FILES = 256
+
+# exposures known to this process, least recently used first, by ExposureRef key: (exposure, lock, opened here)
+_OPEN_EXPOSURES = OrderedDict()
+_OPEN_LOCK = threading.Lock()
+_HANDLE_POOL = None
+
+
+class ExposureRef:
+    """
+    A picklable reference to a VisExposure, used in place of the exposure in Dask graphs. The exposure is opened
+    (from VisExposure.get_open_args) at most once in each process that uses it, through the process's
+    ExposureHandlePool where the exposure class supports one. At most MAX_OPEN_EXPOSURES exposures are kept per
+    process: the least recently used exposure opened here is closed (and reopened if it is used again).
+    """
+
+    def __init__(self, exposure_class, open_args):
+        self.exposure_class = exposure_class
+        self.open_args = open_args
+        self.key = (
+            exposure_class.__module__,
+            exposure_class.__qualname__,
+            tuple(sorted((name, str(value)) for name, value in open_args.items())),
+        )
+
+    @classmethod
+    def from_exposure(cls, exposure):
+        ref = cls(type(exposure), exposure.get_open_args())
+        # this process already has the exposure open, but it belongs to the caller, so it is never closed here
+        with _OPEN_LOCK:
+            if ref.key not in _OPEN_EXPOSURES:
+                _remember_exposure(ref.key, exposure, opened_here=False)
+        return ref
+
+    def open(self):
+        """Returns the exposure, and a lock to hold while reading from it"""
+        with _OPEN_LOCK:
+            if self.key in _OPEN_EXPOSURES:
+                _OPEN_EXPOSURES.move_to_end(self.key)
+            else:
+                open_args = dict(self.open_args)
+                if "pool" in inspect.signature(self.exposure_class).parameters:
+                    open_args["pool"] = _handle_pool()
+                _remember_exposure(self.key, self.exposure_class(**open_args), opened_here=True)
+            exposure, lock, _ = _OPEN_EXPOSURES[self.key]
+            return exposure, lock
+
+
+def _handle_pool():
+    global _HANDLE_POOL
+    if _HANDLE_POOL is None:
+        _HANDLE_POOL = ExposureHandlePool(MAX_OPEN_FILES)
+    return _HANDLE_POOL
+
+
+def _remember_exposure(key, exposure, opened_here):
+    # call with _OPEN_LOCK held
+    _OPEN_EXPOSURES[key] = (exposure, _exposure_lock(exposure), opened_here)
+    while len(_OPEN_EXPOSURES) > MAX_OPEN_EXPOSURES:
+        _, (lru, _, lru_opened_here) = _OPEN_EXPOSURES.popitem(last=False)
+        if lru_opened_here:
+            # reads in progress are safe: a pooled exposure is only closed once they finish
+            lru.close()
+
+
+def _exposure_lock(exposure):
+    # exposures that can't be read from several threads at once are read by one Dask thread at a time
+    return contextlib.nullcontext() if exposure.thread_safe else threading.Lock()
+
+
+class _DetectorPlane:
+    """A picklable array-like for one plane of a detector, which reads from the exposure in the process it's in"""
+
+    def __init__(self, ref, det_num, plane, shape, dtype):
+        self.ref = ref
+        self.det_num = det_num
+        self.plane = plane
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = len(shape)
+
+    def __getitem__(self, inds):
+        exposure, lock = self.ref.open()
+        with lock:
+            return getattr(exposure[self.det_num], self.plane)[inds]
+
+
+def native_tile_shape(array):
+    """
+    Returns the shape of the tiles a DetectorArray is stored in: the compression tiles of tile-compressed FITS
+    images, the chunks of HDF5 datasets, and rows for uncompressed FITS images
+    """
+    tile_shape = getattr(array.reader, "tile_shape", None) or getattr(array.reader, "chunks", None)
+    if tile_shape is None:
+        return (1, array.shape[1])
+    return tuple(tile_shape)
+
+
+def tile_aligned_chunks(shape, tile_shape, itemsize, chunk_bytes=None):
+    """
+    Returns a chunk shape of about chunk_bytes (default DASK_CHUNK_BYTES) made of whole tiles, growing along the
+    rows first so that chunks of row-ordered images are contiguous
+    """
+    chunk_bytes = chunk_bytes or DASK_CHUNK_BYTES
+    (ny, nx), (ty, tx) = shape, tile_shape
+    tile_bytes = ty * tx * itemsize
+    n_x = min(-(-nx // tx), max(1, chunk_bytes // tile_bytes))
+    n_y = max(1, chunk_bytes // (tile_bytes * n_x))
+    return (min(n_y * ty, ny), min(n_x * tx, nx))
+
+
+def detector_to_dask(exposure, det_num, plane="sci", chunk_bytes=None, ref=None):
+    """Returns a plane of a detector as a Dask array, with chunks made of whole tiles of the file"""
+    import dask.array as da
+    from dask.base import tokenize
+
+    array = getattr(exposure[det_num], plane)
+    if array is None:
+        raise ValueError(f"Exposure has no {plane} plane")
+
+    ref = ref or ExposureRef.from_exposure(exposure)
+    chunks = tile_aligned_chunks(array.shape, native_tile_shape(array), array.dtype.itemsize, chunk_bytes)
+    proxy = _DetectorPlane(ref, det_num, plane, array.shape, array.dtype)
+    name = f"{plane}-{det_num}-" + tokenize(ref.key, det_num, plane, chunks)
+    return da.from_array(proxy, chunks=chunks, name=name, lock=False, meta=np.empty((0, 0), dtype=array.dtype))
+
+
+def exposure_to_dask(exposure, plane="sci", chunk_bytes=None):
+    """Returns a plane of all the detectors of an exposure as a Dask array of shape (n_detectors, ny, nx)"""
+    import dask.array as da
+
+    ref = ExposureRef.from_exposure(exposure)
+    return da.stack(
+        [detector_to_dask(exposure, det_num, plane, chunk_bytes, ref) for det_num in range(len(exposure))]
+    )
+
+
+def _extract_detector_stamps(ref, exp_num, det_num, objects, x, y, size):
+    exposure, lock = ref.open()
+    with lock:
+        stamps = cut_detector_stamps(exposure[det_num], exposure.get_wcs_list()[det_num], x, y, size)
+    return list(zip(objects.tolist(), repeat(exp_num), stamps))
+
+
+def stamp_jobs(exposures, ra, dec, size, x_buffer=0, y_buffer=0, index=None):
+    """
+    Builds the stamp extraction of a catalogue (e.g. the RIGHT_ASCENSION and DECLINATION columns of a MER
+    catalogue) over a list of exposures as dask.delayed jobs, one per detector with objects on it. The objects are
+    located with an ObjectIndex (built here if not given), so no job is made for an object/exposure pair with no
+    stamp.
+
+    Inputs:
+      - exposures: a list of VisExposure objects (or subclasses of) supporting get_open_args
+      - ra, dec: arrays of the positions of the objects (degrees)
+      - size: the size of the stamps in pixels
+      - x_buffer, y_buffer: see extract_exposure_stamp
+      - index: the ObjectIndex of the catalogue over the exposures, if already built
+
+    Returns:
+      - jobs: a dict mapping (exposure number, detector number) to a dask.delayed computing a list of
+        (object row, exposure number, Stamp) tuples
+    """
+    import dask
+
+    if index is None:
+        index = build_object_index(exposures, ra, dec, x_buffer, y_buffer)
+    refs = [ExposureRef.from_exposure(exposure) for exposure in exposures]
+
+    extract = dask.delayed(_extract_detector_stamps, pure=True)
+    return {
+        (exp_num, det_num): extract(
+            refs[exp_num], exp_num, det_num, index.objects[rows], index.x[rows], index.y[rows], size
+        )
+        for exp_num, det_num, rows in index.groups()
+    }
+
+
+def stamp_bag(exposures, ra, dec, size, x_buffer=0, y_buffer=0, index=None):
+    """As stamp_jobs, but returns a dask.bag of (object row, exposure number, Stamp) tuples, one partition per job"""
+    import dask.bag as db
+
+    return db.from_delayed(list(stamp_jobs(exposures, ra, dec, size, x_buffer, y_buffer, index).values()))
+
+
+def submit_stamp_jobs(client, jobs):
+    """
+    Submits the jobs from stamp_jobs to a dask.distributed Client, preferring to run all the jobs of an exposure on
+    the same worker, so that it is opened once and its tile caches are shared (the scheduler may still move jobs to
+    idle workers). Returns a dict of Futures with the same keys as jobs.
+    """
+    workers = sorted(client.scheduler_info()["workers"])
+    return {
+        key: client.compute(job, workers=[workers[key[0] % len(workers)]], allow_other_workers=True)
+        for key, job in jobs.items()
+    }
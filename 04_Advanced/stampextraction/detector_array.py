@@ -0,0 +1,162 @@
+#
+# Copyright (C) 2012-2025 Euclid Science Ground Segment
+#
+# This library is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3.0 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""
+:file: python/SHE_PPT/she_io/detector_array.py
+
+:date: 2025-09-16
+
+"""
+
+import logging
+
+import numpy as np
+
+from astropy.nddata.utils import Cutout2D
+
+from stampextraction.profiling import phase
+from stampextraction.tracing import TRACER
+
+logger = logging.getLogger(__name__)
+
+
+class FullReadError(RuntimeError):
+    """Raised when a DetectorArray is converted to a full ndarray and on_full_read is "raise" """
+
+
+class DetectorArray:
+    """
+    A lazy, read-only 2D array giving access to one plane of a detector, used by all the VisExposure backends.
+
+    Indexing the array (e.g. det.sci[100:200, 300:400]) reads only the requested pixels from the underlying
+    reader (an astropy HDU's data, a fitsio ImageHDU or an h5py Dataset). Converting the array to an ndarray
+    (np.asarray, or any NumPy operation applied to it) reads the whole plane. Such full reads are counted in
+    DetectorArray.full_reads, and depending on DetectorArray.on_full_read are allowed silently ("allow"), logged
+    ("warn", the default) or refused with a FullReadError ("raise").
+
+    Use cutout() rather than astropy's Cutout2D, which would read the whole plane.
+    """
+
+    full_reads = 0
+    on_full_read = "warn"
+
+    __slots__ = ("reader", "shape", "dtype", "source")
+
+    def __init__(self, reader, shape, dtype, source):
+        self.reader = reader
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.source = source
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f"DetectorArray(shape={self.shape}, dtype={self.dtype}, source={self.source})"
+
+    def __getitem__(self, inds):
+        with phase("read"):
+            return TRACER.read(self.reader, self.source, self.shape, inds)
+
+    def __array__(self, dtype=None, copy=None):
+        DetectorArray.full_reads += 1
+        if DetectorArray.on_full_read == "raise":
+            raise FullReadError(f"Refusing to read the whole of {self!r}")
+        elif DetectorArray.on_full_read == "warn":
+            logger.warning("Reading the whole of %r", self)
+
+        data = self[:, :]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    def cutout(self, position, size, wcs=None, mode="partial", fill_value=0):
+        """
+        Equivalent to Cutout2D(self, position, size, wcs=wcs, mode=mode, fill_value=fill_value, copy=True), but
+        only reads the pixels that overlap the cutout.
+        """
+        # Let Cutout2D do the geometry (slices, positions, WCS) on a zero-strided array of the right shape,
+        # which takes no memory, then fill in the data from the overlapping region only
+        cutout = Cutout2D(
+            np.broadcast_to(np.zeros((), dtype=self.dtype), self.shape),
+            position,
+            size,
+            wcs=wcs,
+            mode=mode,
+            fill_value=fill_value,
+        )
+        pixels = self[cutout.slices_original]
+        with phase("copy"):
+            data = np.full(cutout.shape, fill_value, dtype=self.dtype)
+            data[cutout.slices_cutout] = pixels
+        cutout.data = data
+
+        return cutout
+
+    def window(self, slices):
+        """
+        Reads the block slices (a (y, x) tuple of slices) of the array into memory, returning a DetectorWindow
+        that can be indexed and cut out from like this array, without reading again within the block.
+        """
+        return DetectorWindow(self, slices)
+
+
+class DetectorWindow(DetectorArray):
+    """
+    A DetectorArray with one block of it held in memory. Indexing a region within the block is served from
+    memory; any other index is read from the underlying reader as usual.
+    """
+
+    __slots__ = ("data", "offset")
+
+    def __init__(self, array, slices):
+        super().__init__(array.reader, array.shape, array.dtype, array.source)
+        ys, xs = (slice(*s.indices(n)[:2]) for s, n in zip(slices, self.shape))
+        self.offset = (ys.start, xs.start)
+        self.data = array[ys, xs]
+
+    def __getitem__(self, inds):
+        if isinstance(inds, tuple) and len(inds) == 2 and all(
+            isinstance(s, slice) and s.step in (None, 1) for s in inds
+        ):
+            (y0, y1, _), (x0, x1, _) = (s.indices(n) for s, n in zip(inds, self.shape))
+            oy, ox = self.offset
+            ny, nx = self.data.shape
+            if oy <= y0 and y1 <= oy + ny and ox <= x0 and x1 <= ox + nx:
+                return self.data[y0 - oy:y1 - oy, x0 - ox:x1 - ox].copy()
+        return super().__getitem__(inds)
+
+
+def cutout(array, position, size, wcs=None, mode="partial", fill_value=0):
+    """Extracts a (copied) Cutout2D from a DetectorArray or any array-like"""
+    if isinstance(array, DetectorArray):
+        return array.cutout(position, size, wcs=wcs, mode=mode, fill_value=fill_value)
+    with phase("copy"):
+        return Cutout2D(array, position, size, wcs=wcs, mode=mode, fill_value=fill_value, copy=True)
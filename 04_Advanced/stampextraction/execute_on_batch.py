@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import deque
 from pathlib import Path
 import json
 import time
@@ -7,9 +7,13 @@ import logging
 import sys
 import os
 
+import numpy as np
+
 from stampextraction.vis_exposures import VisExposureFitsIO, VisExposureHDF5
 from stampextraction.stamps import extract_exposure_stamp
-from stampextraction.profiling import PROFILING_QUEUE as profiling_queue
+from stampextraction.profiling import PROFILER, PROCESS_STATS, PHASES, pack, unpack, percentiles
+from stampextraction.tracing import TRACER
+from stampextraction.node_cache import NodeTileCache, set_node_cache
 
 logger = logging.getLogger(__name__)
 
@@ -25,39 +29,146 @@ datafiles["MER"] = "EUC_SHE_MER-CAT_00_20250701T085255.628039Z_09.10.fits"
 datafiles["HDF5"] = "image_data.hdf5"
 
 
-def process_profiling(comm, file_type, sorting_type, tick, size):
-    prof = defaultdict(float)
-    # Process local profiling data
-    while not profiling_queue.empty():
-        tmp = profiling_queue.get_nowait()
-        for key in tmp:
-            prof[key] += tmp[key]
-        prof["count"] += 1
-    
-    if comm is None:
-        prof = [prof]
-    else:
-        prof = comm.gather(prof, root=0)
-
-    if prof is None:
-        return  # Rank > 0
-    
-    #process gathered profiling data
-    all_prof = defaultdict(float)
-    for tmp in prof:
-        for key in tmp:
-            all_prof[key] += tmp[key]
-    
-    for key, val in all_prof.items():
-        if key != "count":
-            all_prof[key] = val / all_prof["count"]
-    all_prof["tick"] = tick
-    all_prof["file_type"] = file_type
-    all_prof["sorting_type"] = sorting_type
-
-    with open(f"profiling/profiling_{file_type}_{sorting_type}_{size}.json", "a") as f:
-        json.dump(all_prof, f)
-        f.write("\n")
+PERCENTILES = (50, 95, 99)
+
+
+class ProfilingAggregator:
+    """
+    Aggregates the profiling data of all ranks on rank 0, once per tick.
+
+    Each tick, the fixed-size PROFILER arrays are combined with non-blocking reductions (Ireduce) and the
+    per-rank walltimes are gathered with Igather, so the ranks never wait for each other in the stamp loop.
+    Completed reductions are written out by rank 0 as they arrive, both as JSON lines (one record per tick)
+    and as a CSV file with one column per quantity.
+    """
+
+    def __init__(self, comm, file_type, sorting_type, size):
+        self.comm = comm
+        self.rank = comm.Get_rank() if comm is not None else 0
+        self.size = size
+        self.file_type = file_type
+        self.sorting_type = sorting_type
+        self.path = f"profiling/profiling_{file_type}_{sorting_type}_{size}"
+        self.tick = 0
+        self._pending = deque()
+        self._index = {name: i for i, name in enumerate(PROFILER.channels)}
+
+    def process(self):
+        """Starts the aggregation of the data profiled since the last tick, and writes out any completed ticks"""
+        if PROFILER.enabled:
+            # the aggregated io_stats don't count the open files (it is too slow per call), so sample them per tick
+            PROFILER.record("open_files", PROCESS_STATS.open_files())
+        hist, sums, counts, maxs = PROFILER.snapshot()
+        wall = self._index["walltime"]
+        # per-rank totals, used to spot stragglers
+        rank_stats = np.array([sums[wall], counts[wall]], dtype=np.float64)
+
+        if self.comm is None:
+            self._write(self.tick, pack(hist, sums, counts), maxs, rank_stats.reshape(1, -1))
+        else:
+            from mpi4py import MPI
+
+            buf = pack(hist, sums, counts)
+            if self.rank == 0:
+                all_buf = np.empty_like(buf)
+                all_maxs = np.empty_like(maxs)
+                all_rank_stats = np.empty((self.size, rank_stats.size), dtype=np.float64)
+            else:
+                all_buf = all_maxs = all_rank_stats = None
+
+            requests = [
+                self.comm.Ireduce(buf, all_buf, op=MPI.SUM, root=0),
+                self.comm.Ireduce(maxs, all_maxs, op=MPI.MAX, root=0),
+                self.comm.Igather(rank_stats, all_rank_stats, root=0),
+            ]
+            # the send buffers must be kept alive until the requests complete
+            self._pending.append(
+                (self.tick, requests, (buf, maxs, rank_stats), (all_buf, all_maxs, all_rank_stats))
+            )
+            self._progress()
+
+        self.tick += 1
+
+    def finish(self):
+        """Completes all outstanding ticks. Must be called by all ranks"""
+        if self.comm is not None:
+            from mpi4py import MPI
+
+            # ranks with shorter batches contribute empty ticks so that every rank posts the same collectives
+            n_ticks = np.array(self.tick)
+            self.comm.Allreduce(MPI.IN_PLACE, n_ticks, op=MPI.MAX)
+            while self.tick < n_ticks:
+                self.process()
+        self._progress(wait=True)
+
+    def _progress(self, wait=False):
+        if not self._pending:
+            return
+
+        from mpi4py import MPI
+
+        while self._pending:
+            tick, requests, _, results = self._pending[0]
+            if wait:
+                MPI.Request.Waitall(requests)
+            elif not MPI.Request.Testall(requests):
+                break
+            self._pending.popleft()
+            if self.rank == 0:
+                self._write(tick, *results)
+
+    def _write(self, tick, buf, maxs, rank_stats):
+        hist, sums, counts = unpack(buf, len(PROFILER.channels))
+        wall = self._index["walltime"]
+        if counts[wall] == 0:
+            return
+
+        def mean(name, scale=1):
+            i = self._index[name]
+            return sums[i] / counts[i] / scale if counts[i] > 0 else 0.0
+
+        prof = {
+            "tick": tick,
+            "file_type": self.file_type,
+            "sorting_type": self.sorting_type,
+            "count": int(counts[wall]),
+            "read_ops": mean("read_ops"),
+            "read": mean("read_bytes", 1024),
+            # per rank, sampled once per tick
+            "open_files": mean("open_files"),
+            "rss": mean("rss", 1024**2),
+            "vms": mean("vms", 1024**2),
+            "walltime": mean("walltime", 1e9),
+        }
+        for name, scale in (("walltime", 1e9), ("read_ops", 1)):
+            i = self._index[name]
+            for q, val in zip(PERCENTILES, percentiles(hist[i], PERCENTILES)):
+                prof[f"{name}_p{q}"] = val / scale
+            prof[f"{name}_max"] = maxs[i] / scale
+        for name in PHASES:
+            prof[f"t_{name}"] = mean(name, 1e9)
+
+        # stragglers: the rank with the largest mean walltime this tick, relative to the median rank
+        active = rank_stats[:, 1] > 0
+        rank_means = np.zeros(len(rank_stats))
+        rank_means[active] = rank_stats[active, 0] / rank_stats[active, 1] / 1e9
+        slowest = int(np.argmax(rank_means))
+        median = np.median(rank_means[active])
+        prof["slowest_rank"] = slowest
+        prof["slowest_walltime"] = rank_means[slowest]
+        prof["straggler_ratio"] = rank_means[slowest] / median if median > 0 else 0.0
+
+        prof = {key: val.item() if isinstance(val, np.generic) else val for key, val in prof.items()}
+
+        with open(f"{self.path}.json", "a") as f:
+            json.dump(prof, f)
+            f.write("\n")
+
+        new_file = not os.path.exists(f"{self.path}.csv")
+        with open(f"{self.path}.csv", "a") as f:
+            if new_file:
+                f.write(",".join(prof) + "\n")
+            f.write(",".join(str(val) for val in prof.values()) + "\n")
 
 
 def extract_stamps(workdir, sorting_type, batch_number, file_type, comm=None, size=1):
@@ -84,16 +195,18 @@ def extract_stamps(workdir, sorting_type, batch_number, file_type, comm=None, si
             workdir/datafiles["DET"], workdir/datafiles["BKG"], workdir/datafiles["WGT"], workdir/datafiles["SEG"]
         )
 
+    profiling = ProfilingAggregator(comm, file_type, sorting_type, size)
+
     # loop over objects in batch, extract stamps
-    tick = 0
     for i, row in enumerate(batch_t):
         stamp = extract_exposure_stamp(exposure, row["RIGHT_ASCENSION"], row["DECLINATION"], size=400)
         # pretend we do something with the exposure stamp (e.g. this mimics compute)
         time.sleep(0.5)
         
         if i % 10 == 0 and i > 0:
-            process_profiling(comm, file_type, sorting_type, tick, size)
-            tick += 1
+            profiling.process()
+
+    profiling.finish()
 
 
 if __name__ == "__main__":
@@ -104,6 +217,9 @@ if __name__ == "__main__":
     file_type = "fits"
     sorting_type = "shuffled"
     size=1
+    sample_every = 1
+    trace = False
+    node_cache_mb = 0
     try:
         from mpi4py import MPI
 
@@ -118,11 +234,30 @@ if __name__ == "__main__":
         sorting_type = sys.argv[1]
     if len(sys.argv) > 2:
         file_type = sys.argv[2].lower()
+    if len(sys.argv) > 3:
+        sample_every = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        trace = sys.argv[4].lower() == "trace"
+    if len(sys.argv) > 5:
+        node_cache_mb = int(sys.argv[5])
     file_type = "hdf5" if file_type == "hdf5" else "fits"
     sorting_type = "shuffled" if sorting_type == "shuffled" else "sorted"
     if rank == 0:
-        if os.path.exists(f"profiling/profiling_{file_type}_{sorting_type}_{size}.json"):
-            os.remove(f"profiling/profiling_{file_type}_{sorting_type}_{size}.json")
+        for ext in ("json", "csv"):
+            if os.path.exists(f"profiling/profiling_{file_type}_{sorting_type}_{size}.{ext}"):
+                os.remove(f"profiling/profiling_{file_type}_{sorting_type}_{size}.{ext}")
+
+    # profile one in every sample_every stamps
+    PROFILER.enable(sample_every=sample_every)
+    if trace:
+        TRACER.enable()
+
+    # share the detector tiles read by the ranks of each node
+    node_cache = None
+    if comm is not None and node_cache_mb > 0:
+        slot_bytes = 512 * 1024
+        node_cache = NodeTileCache(comm, n_slots=node_cache_mb * 1024**2 // slot_bytes, slot_bytes=slot_bytes)
+        set_node_cache(node_cache)
 
     extract_stamps(
         "/shared-scratch/hpcp/data",
@@ -132,3 +267,11 @@ if __name__ == "__main__":
         comm=comm,
         size=size
     )
+
+    if node_cache is not None:
+        logger.info("Node cache: %d hits, %d misses", node_cache.hits, node_cache.misses)
+        set_node_cache(None)
+        node_cache.free()
+
+    if trace:
+        TRACER.save(f"profiling/trace_{file_type}_{sorting_type}_{size}_{rank}.npy")
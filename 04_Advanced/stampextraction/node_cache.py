@@ -0,0 +1,183 @@
+#
+# Copyright (C) 2012-2025 Euclid Science Ground Segment
+#
+# This library is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3.0 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""
+:file: python/SHE_PPT/she_io/node_cache.py
+
+:date: 2025-09-19
+
+"""
+
+import hashlib
+import logging
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _key_hash(key):
+    """A 64 bit hash of a key that (unlike hash()) is the same in every process"""
+    h = int.from_bytes(hashlib.blake2b(repr(key).encode(), digest_size=8).digest(), "little", signed=True)
+    # 0 marks an empty slot
+    return h or 1
+
+
+class NodeTileCache:
+    """
+    A cache of image tiles shared by all the ranks of a node, held in an MPI-3 shared memory window.
+
+    The cache is direct-mapped: it has n_slots slots of slot_bytes each, and a tile can only be stored in the slot
+    given by the hash of its key. Each slot is guarded by a sequence number (a seqlock) that is odd while the slot is
+    being written: the first rank needing a tile claims its slot with an atomic compare-and-swap, reads the tile from
+    the filesystem and publishes it. Other ranks wanting the same tile wait for it to be published rather than read
+    it themselves, so each node reads each tile once (as long as it is not evicted by another tile).
+
+    Creating and freeing the cache are collective over comm.
+
+    Inputs:
+      - comm: the communicator of all the ranks using the cache. Ranks are grouped into nodes with Split_type
+      - n_slots: the number of tiles the cache can hold
+      - slot_bytes: the maximum size of a tile. Larger tiles are read but not cached
+      - wait_timeout: how long (in s) to wait for another rank to publish a tile before reading it directly
+    """
+
+    def __init__(self, comm, n_slots=1024, slot_bytes=512 * 1024, wait_timeout=10.0):
+        from mpi4py import MPI
+
+        self._MPI = MPI
+        self.n_slots = n_slots
+        self.slot_bytes = slot_bytes
+        self.wait_timeout = wait_timeout
+        self.hits = 0
+        self.misses = 0
+
+        self.node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        is_root = self.node_comm.Get_rank() == 0
+
+        # slot headers: n_slots sequence numbers followed by n_slots key hashes
+        self._hdr_win = MPI.Win.Allocate_shared(2 * n_slots * 8 if is_root else 0, 8, comm=self.node_comm)
+        self._data_win = MPI.Win.Allocate_shared(n_slots * slot_bytes if is_root else 0, 1, comm=self.node_comm)
+
+        buf, _ = self._hdr_win.Shared_query(0)
+        hdr = np.ndarray(buffer=buf, dtype=np.int64, shape=(2, n_slots))
+        self._seq = hdr[0]
+        self._keys = hdr[1]
+        buf, _ = self._data_win.Shared_query(0)
+        self._data = np.ndarray(buffer=buf, dtype=np.uint8, shape=(n_slots, slot_bytes))
+
+        if is_root:
+            hdr[...] = 0
+        self.node_comm.Barrier()
+
+        # RMA calls are serialised, so that tiles can be read from several threads
+        self._lock = threading.Lock()
+        self._hdr_win.Lock_all(MPI.MODE_NOCHECK)
+
+    def free(self):
+        """Frees the shared memory. Collective over the communicator the cache was created with"""
+        self._hdr_win.Unlock_all()
+        self.node_comm.Barrier()
+        self._seq = self._keys = self._data = None
+        self._hdr_win.Free()
+        self._data_win.Free()
+
+    def _load_seq(self, slot):
+        result = np.zeros(1, dtype=np.int64)
+        with self._lock:
+            self._hdr_win.Fetch_and_op(np.zeros(1, dtype=np.int64), result, 0, slot, op=self._MPI.NO_OP)
+            self._hdr_win.Flush(0)
+        return int(result[0])
+
+    def _compare_and_swap(self, slot, compare, value):
+        result = np.zeros(1, dtype=np.int64)
+        with self._lock:
+            self._hdr_win.Compare_and_swap(
+                np.array([value], dtype=np.int64), np.array([compare], dtype=np.int64), result, 0, slot
+            )
+            self._hdr_win.Flush(0)
+        return int(result[0]) == compare
+
+    def _store_seq(self, slot, value):
+        with self._lock:
+            self._hdr_win.Sync()  # make the data written to the slot visible before publishing it
+            self._hdr_win.Accumulate(np.array([value], dtype=np.int64), 0, slot, op=self._MPI.REPLACE)
+            self._hdr_win.Flush(0)
+
+    def get_or_load(self, key, shape, dtype, load):
+        """Returns the tile for key from the cache, or calls load() to read it and stores it in the cache"""
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if nbytes > self.slot_bytes:
+            return load()
+
+        key_hash = _key_hash(key)
+        slot = key_hash % self.n_slots
+        t_start = None
+
+        while True:
+            seq = self._load_seq(slot)
+
+            if seq % 2 == 0:
+                if self._keys[slot] == key_hash:
+                    tile = self._data[slot, :nbytes].view(dtype).reshape(shape).copy()
+                    # the tile is only valid if the slot was not rewritten while copying it
+                    if self._load_seq(slot) == seq:
+                        self.hits += 1
+                        return tile
+                    continue
+
+                # not cached: claim the slot, read the tile and publish it
+                if not self._compare_and_swap(slot, seq, seq + 1):
+                    continue
+                self.misses += 1
+                self._keys[slot] = key_hash
+                try:
+                    tile = np.ascontiguousarray(load(), dtype=dtype)
+                    self._data[slot, :nbytes] = tile.reshape(-1).view(np.uint8)
+                except BaseException:
+                    self._keys[slot] = 0
+                    raise
+                finally:
+                    self._store_seq(slot, seq + 2)
+                return tile
+
+            # the slot is being written. Wait if it is our tile, otherwise don't bother
+            if self._keys[slot] != key_hash:
+                return load()
+            if t_start is None:
+                t_start = time.monotonic()
+            elif time.monotonic() - t_start > self.wait_timeout:
+                logger.warning("Timed out waiting for tile %s from another rank", key)
+                return load()
+            time.sleep(1e-4)
+
+
+NODE_CACHE = None
+
+
+def set_node_cache(cache):
+    """Sets the node cache consulted by the VisExposure backends before reading from the filesystem (None to disable)"""
+    global NODE_CACHE
+    NODE_CACHE = cache
+
+
+def get_node_cache():
+    return NODE_CACHE
@@ -0,0 +1,168 @@
+#
+# Copyright (C) 2012-2025 Euclid Science Ground Segment
+#
+# This library is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3.0 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""
+:file: python/SHE_PPT/she_io/object_index.py
+
+:date: 2025-09-24
+
+"""
+
+from dataclasses import dataclass
+from typing import List
+import logging
+
+import numpy as np
+
+from stampextraction.vis_exposures import VisExposure
+from stampextraction.stamps import locate_objects
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ObjectIndex:
+    """
+    A sparse table of which exposure/detector each object of a catalogue falls on, and where. There is one row
+    per (object, exposure) pair for which the object lies on a detector of the exposure, and the rows are sorted
+    by exposure, then detector, then object, so that a reading plan can be built by walking through the table.
+    """
+
+    objects: np.ndarray  # row of the object in the catalogue
+    exposures: np.ndarray  # index of the exposure in the list the index was built from
+    detectors: np.ndarray  # detector number within the exposure
+    x: np.ndarray  # (0-based) pixel coordinates of the object on the detector
+    y: np.ndarray
+    n_objects: int  # number of objects in the catalogue
+    exposure_names: np.ndarray  # a name for each exposure (e.g. its file name)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def save(self, filename):
+        """Saves the index to a .npz file"""
+        np.savez(
+            filename,
+            objects=self.objects,
+            exposures=self.exposures,
+            detectors=self.detectors,
+            x=self.x,
+            y=self.y,
+            n_objects=self.n_objects,
+            exposure_names=self.exposure_names,
+        )
+
+    @classmethod
+    def load(cls, filename):
+        """Loads an index saved with ObjectIndex.save"""
+        with np.load(filename) as f:
+            return cls(
+                f["objects"],
+                f["exposures"],
+                f["detectors"],
+                f["x"],
+                f["y"],
+                int(f["n_objects"]),
+                f["exposure_names"],
+            )
+
+    def exposures_per_object(self):
+        """Returns the number of exposures each object of the catalogue falls on"""
+        return np.bincount(self.objects, minlength=self.n_objects)
+
+    def for_objects(self, objects):
+        """Returns the index restricted to the rows of the given objects (e.g. one batch of the catalogue)"""
+        rows = np.isin(self.objects, objects)
+        return ObjectIndex(
+            self.objects[rows],
+            self.exposures[rows],
+            self.detectors[rows],
+            self.x[rows],
+            self.y[rows],
+            self.n_objects,
+            self.exposure_names,
+        )
+
+    def groups(self):
+        """
+        Iterates over the detectors that have objects on them, yielding (exposure, detector, rows) where rows
+        is the slice of the table for that detector. This is the order in which to read the pixel data.
+        """
+        if len(self) == 0:
+            return
+        key = self.exposures.astype(np.int64) * (self.detectors.max() + 1) + self.detectors
+        starts = np.flatnonzero(np.diff(key, prepend=-1))
+        ends = np.append(starts[1:], len(key))
+        for start, end in zip(starts, ends):
+            yield int(self.exposures[start]), int(self.detectors[start]), slice(start, end)
+
+
+def build_object_index(
+    exposures: List[VisExposure], ra, dec, x_buffer=0, y_buffer=0, exposure_names=None
+) -> ObjectIndex:
+    """
+    Builds the ObjectIndex of a catalogue over a list of exposures. Only the WCSs of the exposures are used, so
+    no pixel data is read. As with extract_exposure_stamp, an object in the overlap of two detectors of the same
+    exposure is assigned to the first of them.
+
+    Inputs:
+      - exposures: a list of VisExposure objects (or subclasses of)
+      - ra: array of the right ascensions of the objects (degrees)
+      - dec: array of the declinations of the objects (degrees)
+      - x_buffer, y_buffer: see extract_exposure_stamp
+      - exposure_names: optional list of names of the exposures, stored with the index
+
+    Returns:
+      - index: the ObjectIndex
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+
+    if exposure_names is None:
+        exposure_names = [str(i) for i in range(len(exposures))]
+    elif len(exposure_names) != len(exposures):
+        raise ValueError("There must be one exposure name per exposure")
+
+    objects, exp_nums, det_nums, xs, ys = [], [], [], [], []
+
+    for exp_num, exposure in enumerate(exposures):
+        dets, x, y = locate_objects(exposure, ra, dec, x_buffer, y_buffer)
+        found = np.flatnonzero(dets >= 0)
+        # sort by detector, keeping the objects of each detector in catalogue order
+        found = found[np.argsort(dets[found], kind="stable")]
+
+        objects.append(found)
+        exp_nums.append(np.full(len(found), exp_num, dtype=np.int32))
+        det_nums.append(dets[found].astype(np.int16))
+        xs.append(x[found])
+        ys.append(y[found])
+
+        logger.debug("Exposure %d: %d of %d objects on a detector", exp_num, len(found), len(ra))
+
+    def join(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+
+    return ObjectIndex(
+        join(objects, np.int64),
+        join(exp_nums, np.int32),
+        join(det_nums, np.int16),
+        join(xs, np.float64),
+        join(ys, np.float64),
+        len(ra),
+        np.array(exposure_names, dtype=str),
+    )
@@ -28,56 +28,298 @@ import logging
 import os
 import psutil
 import time
-from queue import Queue
+
+import numpy as np
 
 logger = logging.getLogger(__name__)
 LOG_LEVEL = logging.INFO
-PROFILING_QUEUE = Queue()
 
-def io_stats(f=None, prof_queue=None):
-    """A decorator that will print some IO statistics for the function to be called"""
+# The quantities tracked by the profiler. Timers (walltime and the per-phase timers) are stored in nanoseconds,
+# read_bytes/rss/vms in bytes, and read_ops/open_files as plain counts.
+PHASES = ("lookup", "wcs", "detector", "read", "copy", "sci", "rms", "flg", "wgt", "bkg", "seg")
+IO_CHANNELS = ("read_ops", "read_bytes", "open_files", "rss", "vms")
+CHANNELS = ("walltime",) + PHASES + IO_CHANNELS
+
+# Values are binned into log-linear buckets (as in HDR histograms): each power of two is split into
+# _SUB_BUCKETS linear buckets, giving a relative bin width of at most 1/_SUB_BUCKETS. Histograms from
+# different calls, processes or ranks can be merged by simply adding them.
+_SUB_BITS = 4
+_SUB_BUCKETS = 1 << (_SUB_BITS - 1)
+N_BINS = (64 - _SUB_BITS + 2) * _SUB_BUCKETS
+
+
+def bin_index(value):
+    """Returns the histogram bucket for a non-negative integer value"""
+    value = int(value)
+    if value < 2 * _SUB_BUCKETS:
+        return max(value, 0)
+    shift = value.bit_length() - _SUB_BITS
+    return shift * _SUB_BUCKETS + (value >> shift)
+
+
+def bin_edges():
+    """Returns the lower edge of every histogram bucket (the upper edge is the next bucket's lower edge)"""
+    edges = np.zeros(N_BINS + 1, dtype=np.float64)
+    edges[: 2 * _SUB_BUCKETS] = np.arange(2 * _SUB_BUCKETS)
+    for i in range(2 * _SUB_BUCKETS, N_BINS + 1):
+        shift, mantissa = divmod(i, _SUB_BUCKETS)
+        edges[i] = float((mantissa + _SUB_BUCKETS) << (shift - 1))
+    return edges
+
+
+_EDGES = bin_edges()
+# representative value of each bucket: exact in the linear range, the bucket centre above it
+_CENTRES = np.where(
+    np.arange(N_BINS) < 2 * _SUB_BUCKETS, _EDGES[:-1], 0.5 * (_EDGES[:-1] + _EDGES[1:])
+)
+
+
+def percentiles(hist, qs):
+    """Estimates the percentiles qs (0-100) of the values in a histogram row"""
+    cumulative = np.cumsum(hist)
+    total = cumulative[-1]
+    if total == 0:
+        return np.zeros(len(qs))
+    targets = np.maximum(np.ceil(np.asarray(qs, dtype=np.float64) / 100 * total), 1)
+    return _CENTRES[np.searchsorted(cumulative, targets, side="left")]
+
+
+def pack(hist, sums, counts):
+    """Packs a profiler snapshot into one flat float64 array, so it can be summed with a single reduction"""
+    return np.concatenate([hist.ravel(), sums, counts]).astype(np.float64)
+
+
+def unpack(buf, n_channels):
+    """Inverse of pack: returns (hist, sums, counts)"""
+    n_hist = n_channels * N_BINS
+    hist = buf[:n_hist].astype(np.int64).reshape(n_channels, N_BINS)
+    sums = buf[n_hist: n_hist + n_channels]
+    counts = buf[n_hist + n_channels:].astype(np.int64)
+    return hist, sums, counts
+
+
+class _NullPhase:
+    """Context manager returned when a phase is not being timed"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _PhaseTimer:
+    """Context manager timing a single phase with perf_counter_ns"""
+
+    __slots__ = ("profiler", "channel", "t0")
+
+    def __init__(self, profiler, channel):
+        self.profiler = profiler
+        self.channel = channel
+
+    def __enter__(self):
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.channel, time.perf_counter_ns() - self.t0)
+        return False
+
+
+class Profiler:
+    """
+    Aggregates profiling data into fixed-size NumPy arrays.
+
+    For every channel in CHANNELS the profiler keeps a histogram (N_BINS log-linear buckets), the sum, the number
+    of samples and the maximum. Nothing is allocated per call, so the arrays can be merged across processes with
+    a plain element-wise sum (max for the maxima).
+
+    When disabled, or when the current call is not sampled, phase() returns a shared no-op context manager so
+    that instrumented code pays only for a method call.
+    """
+
+    def __init__(self, channels=CHANNELS, sample_every=1, enabled=False):
+        self.channels = tuple(channels)
+        self._index = {name: i for i, name in enumerate(self.channels)}
+        self.hist = np.zeros((len(self.channels), N_BINS), dtype=np.int64)
+        self.sums = np.zeros(len(self.channels), dtype=np.float64)
+        self.counts = np.zeros(len(self.channels), dtype=np.int64)
+        self.maxs = np.zeros(len(self.channels), dtype=np.int64)
+        self.enabled = enabled
+        self.sample_every = sample_every
+        self.calls = 0
+        self.active = False
+
+    def enable(self, sample_every=1):
+        """Enables profiling, recording one in every sample_every calls"""
+        if sample_every < 1:
+            raise ValueError(f"sample_every must be at least 1, not {sample_every}")
+        self.sample_every = sample_every
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.active = False
+
+    def begin(self):
+        """Marks the start of a profiled call. Returns True if this call is sampled"""
+        if not self.enabled:
+            return False
+        self.calls += 1
+        self.active = self.calls % self.sample_every == 0
+        return self.active
+
+    def end(self):
+        self.active = False
+
+    def phase(self, name):
+        """Returns a context manager timing the named phase (a no-op unless the current call is sampled)"""
+        if not self.active:
+            return _NULL_PHASE
+        return _PhaseTimer(self, self._index[name])
+
+    def record(self, channel, value):
+        """Records a value for a channel, given either by its name or index"""
+        if isinstance(channel, str):
+            channel = self._index[channel]
+        value = int(value)
+        self.hist[channel, min(bin_index(value), N_BINS - 1)] += 1
+        self.sums[channel] += value
+        self.counts[channel] += 1
+        if value > self.maxs[channel]:
+            self.maxs[channel] = value
+
+    def reset(self):
+        self.hist[...] = 0
+        self.sums[...] = 0
+        self.counts[...] = 0
+        self.maxs[...] = 0
+
+    def snapshot(self, reset=True):
+        """Returns a copy of (hist, sums, counts, maxs), optionally resetting the profiler"""
+        snap = (self.hist.copy(), self.sums.copy(), self.counts.copy(), self.maxs.copy())
+        if reset:
+            self.reset()
+        return snap
+
+    def means(self):
+        """Returns a dict of the mean value of each channel that has samples"""
+        return {
+            name: self.sums[i] / self.counts[i] for i, name in enumerate(self.channels) if self.counts[i] > 0
+        }
+
+
+PROFILER = Profiler()
+
+
+def phase(name):
+    """Times a phase of the current profiled call, e.g. `with phase("wcs"): ...`"""
+    return PROFILER.phase(name)
+
+
+class _ProcessStats:
+    """
+    Wraps the psutil calls used by io_stats. The process handle is created once, and the read ops/bytes used by
+    psutil itself to query the counters are measured at start-up rather than hard-coded.
+    """
+
+    def __init__(self):
+        self._process = None
+        self.read_ops_overhead = 0
+        self.read_bytes_overhead = 0
+
+    @property
+    def process(self):
+        if self._process is None or self._process.pid != os.getpid():
+            # (re)create the handle, e.g. on first use or after a fork
+            self._process = psutil.Process(os.getpid())
+            self._calibrate()
+        return self._process
+
+    def _calibrate(self, n=8):
+        # the counters are read twice per call, so the overhead is the cost of one read between them
+        c0 = self._process.io_counters()
+        for _ in range(n):
+            c1 = self._process.io_counters()
+        self.read_ops_overhead = (c1.read_count - c0.read_count) // n
+        self.read_bytes_overhead = (c1.read_chars - c0.read_chars) // n
+
+    def io_counters(self):
+        return self.process.io_counters()
+
+    def memory_info(self):
+        return self.process.memory_info()
+
+    def open_files(self):
+        return len(self.process.open_files())
+
+
+PROCESS_STATS = _ProcessStats()
+
+
+def io_stats(f=None, aggregate=False, open_files=None):
+    """
+    A decorator that will collect some IO statistics for the function to be called.
+
+    With aggregate=False (the default) the statistics are logged for every call. With aggregate=True they are
+    recorded into PROFILER, and the function is only instrumented when the profiler is enabled and the call is
+    sampled. Counting the open files is comparatively expensive, so by default (open_files=None) it is only done
+    when the statistics are logged for every call, not when they are aggregated.
+    """
+    if open_files is None:
+        open_files = not aggregate
+
     def decorator(func):
         def profile(*args, **kwargs):
-            p = psutil.Process(os.getpid())
-            c0 = p.io_counters()
-            m = p.memory_info()
-            read0 = c0.read_count
-            bytes0 = c0.read_chars
-
-            t0 = time.time()
-            ret = func(*args, **kwargs)
-            t1 = time.time()
-
-            c1 = p.io_counters()
-            read1 = c1.read_count - 2  # 2 read ops used in getting the read count twice
-            bytes1 = c1.read_chars - 97  # 97 bytes used in getting the bytes read
-
-            open_files = len(p.open_files())
-
-            prof = {"read_ops": read1 - read0,
-                    "read": (bytes1 - bytes0) // 1024,
-                    "open_files": open_files,
-                    "rss": m.rss / 1024**2,
-                    "vms": m.vms / 1024**2,
-                    "walltime": t1 - t0}
-
-            if prof_queue is not None:
-                PROFILING_QUEUE.put(prof)
+            if aggregate and not PROFILER.begin():
+                return func(*args, **kwargs)
+
+            c0 = PROCESS_STATS.io_counters()
+            m = PROCESS_STATS.memory_info()
+
+            t0 = time.perf_counter_ns()
+            try:
+                ret = func(*args, **kwargs)
+            finally:
+                t1 = time.perf_counter_ns()
+                if aggregate:
+                    PROFILER.end()
+
+            c1 = PROCESS_STATS.io_counters()
+
+            prof = {
+                "walltime": t1 - t0,
+                "read_ops": max(c1.read_count - c0.read_count - PROCESS_STATS.read_ops_overhead, 0),
+                "read_bytes": max(c1.read_chars - c0.read_chars - PROCESS_STATS.read_bytes_overhead, 0),
+                "rss": m.rss,
+                "vms": m.vms,
+            }
+            if open_files:
+                prof["open_files"] = PROCESS_STATS.open_files()
+
+            if aggregate:
+                for key, val in prof.items():
+                    PROFILER.record(key, val)
             else:
                 logger.info(
                     "IOSTATS: %s: read_ops = %d, read = %d kB, open_files = %d, rss = %i, vms = %i, walltime = %fs",
                     func.__qualname__,
                     prof["read_ops"],
-                    prof["read"],
-                    prof["open_files"],
-                    prof["rss"],
-                    prof["vms"],
-                    prof["walltime"],
+                    prof["read_bytes"] // 1024,
+                    prof.get("open_files", -1),
+                    prof["rss"] / 1024**2,
+                    prof["vms"] / 1024**2,
+                    prof["walltime"] / 1e9,
                 )
             return ret
         return profile
 
     if callable(f):  # used as @io_stats
         return decorator(f)
-    else:            # used as @io_stats(queue="...")
+    else:            # used as @io_stats(aggregate=True)
         return decorator
@@ -0,0 +1,252 @@
+#
+# Copyright (C) 2012-2025 Euclid Science Ground Segment
+#
+# This library is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3.0 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""
+:file: python/SHE_PPT/she_io/resampling.py
+
+:date: 2025-10-07
+
+"""
+
+import logging
+import time
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+logger = logging.getLogger(__name__)
+
+# number of kernel taps per axis for each method
+METHODS = {"bilinear": 2, "lanczos3": 6}
+
+# fill values of the planes for pixels shifted in from outside the stamp (as for the cutouts)
+FILL_VALUES = {"sci": 0, "rms": 0, "flg": 1, "wgt": 0, "bkg": 0, "seg": 0}
+
+
+def kernel_weights(t, method="lanczos3"):
+    """
+    Returns the (n, n_taps) interpolation weights for sampling at fractional offsets t (0 <= t < 1) from pixels
+    -(n_taps // 2 - 1) ... n_taps // 2 relative to the pixel below the sample. The weights are normalised to sum to
+    1, so the shifts conserve flux.
+    """
+    n_taps = METHODS[method]
+    k = np.arange(-(n_taps // 2) + 1, n_taps // 2 + 1)
+    d = t[:, None] - k[None, :]
+    if method == "bilinear":
+        weights = np.maximum(1 - np.abs(d), 0)
+    else:
+        a = n_taps // 2
+        weights = np.sinc(d) * np.sinc(d / a) * (np.abs(d) < a)
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+def _shift_axis(images, offsets, method, fill_value, axis):
+    """Samples each image of the (n, ny, nx) stack at pixel + offsets[i] along axis (1 or 2)"""
+    n_taps = METHODS[method]
+    base = np.floor(offsets).astype(np.int64)
+    weights = kernel_weights(offsets - base, method).astype(images.dtype)
+
+    length = images.shape[axis]
+    lo = n_taps // 2 - 1 - min(base.min(), 0)
+    hi = n_taps // 2 + max(base.max(), 0)
+    pad = [(0, 0)] * 3
+    pad[axis] = (lo, hi)
+    padded = np.pad(images, pad, constant_values=fill_value)
+
+    # the shifts are (nearly) all less than a pixel, so there are only a few distinct integer parts: each is
+    # applied to all its stamps at once with slices
+    out = np.zeros_like(images)
+    for b in np.unique(base):
+        inds = np.flatnonzero(base == b)
+        for j, k in enumerate(range(-(n_taps // 2) + 1, n_taps // 2 + 1)):
+            start = lo + b + k
+            taps = padded[inds, :, start:start + length] if axis == 2 else padded[inds, start:start + length, :]
+            out[inds] += weights[inds, j, None, None] * taps
+    return out
+
+
+def shift_stamps(images, dx, dy, method="lanczos3", fill_value=0, use_numba=None):
+    """
+    Resamples a stack of stamps (n, ny, nx) so that out[i, y, x] = images[i, y + dy[i], x + dx[i]], with separable
+    bilinear or Lanczos (a = 3) interpolation. Pixels outside the stamps are taken to be fill_value.
+
+    Uses Numba (parallel over the stamps) if it is available and use_numba is not False, otherwise NumPy.
+    """
+    images = np.asarray(images)
+    dtype = images.dtype.newbyteorder("=") if images.dtype.kind == "f" else np.dtype(np.float64)
+    images = images.astype(dtype, copy=False)
+    dx = np.broadcast_to(np.asarray(dx, dtype=np.float64), len(images))
+    dy = np.broadcast_to(np.asarray(dy, dtype=np.float64), len(images))
+
+    if use_numba is None:
+        use_numba = numba is not None
+    if use_numba:
+        n_taps = METHODS[method]
+        x_base, y_base = np.floor(dx).astype(np.int64), np.floor(dy).astype(np.int64)
+        x_weights = kernel_weights(dx - x_base, method).astype(dtype)
+        y_weights = kernel_weights(dy - y_base, method).astype(dtype)
+        return _shift_stamps_numba(
+            images, x_base, x_weights, y_base, y_weights, n_taps // 2 - 1, dtype.type(fill_value)
+        )
+
+    return _shift_axis(_shift_axis(images, dx, method, fill_value, axis=2), dy, method, fill_value, axis=1)
+
+
+def shift_stamps_nearest(images, dx, dy, fill_value=0):
+    """As shift_stamps, but taking the nearest pixel, e.g. for flag and segmentation maps"""
+    images = np.asarray(images)
+    n, ny, nx = images.shape
+    x_shift = np.round(np.asarray(dx, dtype=np.float64)).astype(np.int64)
+    y_shift = np.round(np.asarray(dy, dtype=np.float64)).astype(np.int64)
+    x = np.arange(nx)[None, :] + np.broadcast_to(x_shift, n)[:, None]
+    y = np.arange(ny)[None, :] + np.broadcast_to(y_shift, n)[:, None]
+    inside = ((y >= 0) & (y < ny))[:, :, None] & ((x >= 0) & (x < nx))[:, None, :]
+    out = images[np.arange(n)[:, None, None], np.clip(y, 0, ny - 1)[:, :, None], np.clip(x, 0, nx - 1)[:, None, :]]
+    out[~inside] = fill_value
+    return out
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def _shift_stamps_numba(images, x_base, x_weights, y_base, y_weights, k0, fill_value):
+        n, ny, nx = images.shape
+        n_taps = x_weights.shape[1]
+        out = np.empty_like(images)
+        for i in numba.prange(n):
+            # shift along x into a temporary, then along y into the output
+            tmp = np.empty((ny, nx), dtype=images.dtype)
+            for y in range(ny):
+                for x in range(nx):
+                    value = 0.0
+                    for j in range(n_taps):
+                        xs = x + x_base[i] + j - k0
+                        pixel = images[i, y, xs] if 0 <= xs < nx else fill_value
+                        value += x_weights[i, j] * pixel
+                    tmp[y, x] = value
+            for y in range(ny):
+                for x in range(nx):
+                    value = 0.0
+                    for j in range(n_taps):
+                        ys = y + y_base[i] + j - k0
+                        pixel = tmp[ys, x] if 0 <= ys < ny else fill_value
+                        value += y_weights[i, j] * pixel
+                    out[i, y, x] = value
+        return out
+
+else:
+    _shift_stamps_numba = None
+
+
+def recentre_stamps(stamps, x, y, wcs_list, method="lanczos3", use_numba=None):
+    """
+    Resamples stamps in place so that the object positions (x, y) on their detectors are exactly at the stamp
+    centres, and updates their WCSs to match.
+
+    The sci and bkg planes are resampled with method (bilinear or lanczos3), the rms and wgt planes bilinearly (so
+    they stay non-negative), and the flg and seg planes by taking the nearest pixel.
+
+    Inputs:
+      - stamps: list of Stamp objects (None entries are skipped)
+      - x, y: the (0-based) pixel coordinates of the objects on their detectors
+      - wcs_list: the WCSs of the detectors the stamps were cut from
+      - method: "bilinear" or "lanczos3"
+      - use_numba: see shift_stamps
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown resampling method {method}. Should be one of {list(METHODS)}")
+
+    # the stamps are resampled in stacks of the same shape
+    groups = {}
+    for i, stamp in enumerate(stamps):
+        if stamp is not None:
+            groups.setdefault(stamp.sci.shape, []).append(i)
+
+    for (ny, nx), inds in groups.items():
+        # the position of each object within its stamp, from the offset between the stamp and detector WCSs
+        offsets = np.array([wcs_list[i].wcs.crpix - stamps[i].wcs.wcs.crpix for i in inds])
+        dx = x[inds] - offsets[:, 0] - (nx - 1) / 2
+        dy = y[inds] - offsets[:, 1] - (ny - 1) / 2
+
+        for plane, plane_method in (("sci", method), ("bkg", method), ("rms", "bilinear"), ("wgt", "bilinear")):
+            if getattr(stamps[inds[0]], plane) is None:
+                continue
+            shifted = shift_stamps(
+                np.stack([getattr(stamps[i], plane) for i in inds]),
+                dx,
+                dy,
+                plane_method,
+                FILL_VALUES[plane],
+                use_numba,
+            )
+            for i, data in zip(inds, shifted):
+                setattr(stamps[i], plane, data)
+
+        for plane in ("flg", "seg"):
+            if getattr(stamps[inds[0]], plane) is None:
+                continue
+            shifted = shift_stamps_nearest(
+                np.stack([getattr(stamps[i], plane) for i in inds]), dx, dy, FILL_VALUES[plane]
+            )
+            for i, data in zip(inds, shifted):
+                setattr(stamps[i], plane, data)
+
+        for i, sx, sy in zip(inds, dx, dy):
+            wcs = stamps[i].wcs.deepcopy()
+            wcs.wcs.crpix -= (sx, sy)
+            stamps[i].wcs = wcs
+
+
+def benchmark(n_stamps=2000, size=64, method="lanczos3"):
+    """Compares the throughput (stamps/s) of shift_stamps with shifting each stamp with scipy.ndimage.shift"""
+    from scipy import ndimage
+
+    rng = np.random.default_rng(0)
+    images = rng.random((n_stamps, size, size), dtype=np.float32)
+    dx, dy = rng.uniform(-0.5, 0.5, n_stamps), rng.uniform(-0.5, 0.5, n_stamps)
+
+    results = {}
+    order = 1 if method == "bilinear" else 3
+    start = time.perf_counter()
+    for image, sx, sy in zip(images, dx, dy):
+        ndimage.shift(image, (-sy, -sx), order=order, mode="constant", cval=0)
+    results[f"scipy (order {order})"] = n_stamps / (time.perf_counter() - start)
+
+    for name, use_numba in (("numpy", False), ("numba", True)):
+        if use_numba and numba is None:
+            continue
+        # the first call compiles the Numba kernel
+        shift_stamps(images[:2], dx[:2], dy[:2], method, use_numba=use_numba)
+        start = time.perf_counter()
+        shift_stamps(images, dx, dy, method, use_numba=use_numba)
+        results[name] = n_stamps / (time.perf_counter() - start)
+
+    for name, rate in results.items():
+        logger.info("%s: %.0f stamps/s", name, rate)
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for method in METHODS:
+        logger.info("Shifting 64x64 stamps with %s", method)
+        benchmark(method=method)
@@ -0,0 +1,383 @@
+#
+# Copyright (C) 2012-2025 Euclid Science Ground Segment
+#
+# This library is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3.0 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""
+:file: python/SHE_PPT/she_io/stamp_service.py
+
+:date: 2025-09-30
+
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from stampextraction.vis_exposures import VisExposure
+from stampextraction.stamps import Stamp, locate_objects, cut_detector_stamps
+from stampextraction.profiling import N_BINS, bin_index, percentiles
+
+logger = logging.getLogger(__name__)
+
+PLANES = ("sci", "rms", "flg", "wgt", "bkg", "seg")
+
+
+class StampService:
+    """
+    Serves stamps from a VisExposure to many concurrent (asyncio) consumers.
+
+    Requests made with get_stamp are queued. A batching task gathers the requests arriving within batch_window
+    seconds of each other (up to max_batch_size), locates them on the detectors in one vectorised lookup, and
+    cuts the stamps of each detector together (so stamps close together on a detector share their reads, see
+    cut_detector_stamps). The work is done on a thread executor of max_workers threads, with at most max_workers
+    batches in flight. Backends whose reads are not thread-safe (VisExposure.thread_safe is False) are only ever
+    accessed by one thread at a time.
+
+    The service can be used in-process (async with StampService(exposure) as service: ...) or over a local socket
+    (see serve_unix and StampClient). metrics() returns the latency and queue-depth statistics.
+
+    Inputs:
+      - exposure: a VisExposure object (or subclass of)
+      - batch_window: how long (in s) to wait for more requests after the first request of a batch
+      - max_batch_size: the maximum number of requests in a batch
+      - max_workers: the number of executor threads
+      - x_buffer, y_buffer: see extract_exposure_stamp
+    """
+
+    def __init__(
+        self, exposure: VisExposure, batch_window=0.002, max_batch_size=256, max_workers=4, x_buffer=0, y_buffer=0
+    ):
+        self.exposure = exposure
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_workers = max_workers
+        self.x_buffer = x_buffer
+        self.y_buffer = y_buffer
+
+        self._queue = None
+        self._batcher = None
+        self._executor = None
+        self._slots = None
+        self._tasks = set()
+        self._lock = threading.Lock() if not exposure.thread_safe else contextlib.nullcontext()
+
+        # metrics
+        self.n_requests = 0
+        self.n_failed = 0
+        self.n_batches = 0
+        self.max_queue_depth = 0
+        self.in_flight = 0
+        self.largest_batch = 0
+        self._latencies = np.zeros(N_BINS, dtype=np.int64)
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stamp-service")
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._batcher = asyncio.create_task(self._run_batcher())
+
+    async def stop(self):
+        """Stops accepting requests, finishes the batches in flight, and shuts down the executor"""
+        if self._batcher is None:
+            return
+        self._batcher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._batcher
+        self._batcher = None
+
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        # fail any requests that never made it into a batch
+        while not self._queue.empty():
+            *_, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Stamp service stopped"))
+
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def get_stamp(self, ra, dec, size):
+        """
+        Returns the stamp of size pixels centred on (ra, dec) (in degrees), or None if (ra, dec) is not on a
+        detector of the exposure
+        """
+        if self._batcher is None:
+            raise RuntimeError("Stamp service is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((float(ra), float(dec), int(size), future, time.perf_counter_ns()))
+        self.n_requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return await future
+
+    def metrics(self):
+        """
+        Returns a dict of the service's metrics. Latencies (from request to response) are in ms. The latencies,
+        n_served, n_batches and mean_batch_size only cover the batches that were served, the requests of failed
+        batches are counted in n_failed
+        """
+        p50, p95, p99 = (float(p) / 1e6 for p in percentiles(self._latencies, (50, 95, 99)))
+        n_served = int(self._latencies.sum())
+        return {
+            "n_requests": self.n_requests,
+            "n_served": n_served,
+            "n_failed": self.n_failed,
+            "n_batches": self.n_batches,
+            "mean_batch_size": n_served / self.n_batches if self.n_batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "in_flight": self.in_flight,
+            "latency_p50": p50,
+            "latency_p95": p95,
+            "latency_p99": p99,
+        }
+
+    async def _run_batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # don't take more requests off the queue than can be worked on, so the queue depth shows the backlog
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+
+            deadline = loop.time() + self.batch_window
+            try:
+                while len(batch) < self.max_batch_size:
+                    if not self._queue.empty():
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # stopped while gathering a batch: serve it before stopping
+                task = asyncio.create_task(self._serve_batch(batch))
+                self._tasks.add(task)
+                raise
+
+            task = asyncio.create_task(self._serve_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _serve_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        self.in_flight += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+
+        ra, dec, sizes, futures, starts = zip(*batch)
+        try:
+            det_nums, x, y = await loop.run_in_executor(
+                self._executor, self._locate, np.array(ra), np.array(dec)
+            )
+
+            # cut the stamps of each detector as one job
+            groups = [np.flatnonzero(det_nums == det_num) for det_num in np.unique(det_nums[det_nums >= 0])]
+            jobs = [
+                loop.run_in_executor(
+                    self._executor, self._cut, int(det_nums[inds[0]]), x[inds], y[inds], np.array(sizes)[inds]
+                )
+                for inds in groups
+            ]
+            results = [None] * len(batch)
+            for inds, stamps in zip(groups, await asyncio.gather(*jobs)):
+                for i, stamp in zip(inds, stamps):
+                    results[i] = stamp
+
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            logger.exception("Failed to serve a batch of %d stamps", len(batch))
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            self.n_failed += len(batch)
+        else:
+            end = time.perf_counter_ns()
+            self.n_batches += 1
+            for start in starts:
+                self._latencies[bin_index(end - start)] += 1
+        finally:
+            self.in_flight -= len(batch)
+            self._slots.release()
+
+    def _locate(self, ra, dec):
+        with self._lock:
+            return locate_objects(self.exposure, ra, dec, self.x_buffer, self.y_buffer)
+
+    def _cut(self, det_num, x, y, sizes):
+        with self._lock:
+            det = self.exposure[det_num]
+            wcs = self.exposure.get_wcs_list()[det_num]
+            return cut_detector_stamps(det, wcs, x, y, sizes)
+
+    async def serve_unix(self, path):
+        """
+        Serves stamps over a unix socket at path (see StampClient for the protocol), returning the asyncio Server.
+        The service must be running.
+        """
+        return await asyncio.start_unix_server(self._handle_connection, path=path)
+
+    async def _handle_connection(self, reader, writer):
+        # requests are served concurrently, so responses carry the id of their request and may arrive out of order
+        write_lock = asyncio.Lock()
+        pending = set()
+
+        async def respond(request):
+            if request.get("op") == "metrics":
+                message, payload = {"id": request["id"], "metrics": self.metrics()}, b""
+            else:
+                try:
+                    stamp = await self.get_stamp(request["ra"], request["dec"], request["size"])
+                    message, payload = _encode_stamp(stamp)
+                except Exception as e:
+                    message, payload = {"error": repr(e)}, b""
+                message["id"] = request["id"]
+            message["nbytes"] = len(payload)
+            async with write_lock:
+                writer.write(json.dumps(message).encode() + b"\n" + payload)
+                await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(respond(json.loads(line)))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+
+class StampClient:
+    """
+    Client for a StampService served over a unix socket.
+
+    Each request is a line of JSON, {"id": n, "ra": ra, "dec": dec, "size": size} or {"id": n, "op": "metrics"}.
+    Each response is a line of JSON with the id of its request and the number of bytes (nbytes) following it. For
+    stamps, the JSON lists the dtypes and shapes of the planes, which follow in that order as raw bytes. Many
+    requests can be in flight on one connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._futures = {}
+        self._next_id = 0
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._receiver = asyncio.create_task(self._receive())
+
+    async def close(self):
+        self._writer.close()
+        with contextlib.suppress(ConnectionError):
+            await self._writer.wait_closed()
+        self._receiver.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._receiver
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def get_stamp(self, ra, dec, size):
+        message, payload = await self._request({"ra": float(ra), "dec": float(dec), "size": int(size)})
+        if "error" in message:
+            raise RuntimeError(f"Stamp service error: {message['error']}")
+        return _decode_stamp(message, payload)
+
+    async def metrics(self):
+        message, _ = await self._request({"op": "metrics"})
+        return message["metrics"]
+
+    async def _request(self, request):
+        request["id"] = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._futures[request["id"]] = future
+        self._writer.write(json.dumps(request).encode() + b"\n")
+        await self._writer.drain()
+        return await future
+
+    async def _receive(self):
+        try:
+            while line := await self._reader.readline():
+                message = json.loads(line)
+                payload = await self._reader.readexactly(message["nbytes"])
+                self._futures.pop(message["id"]).set_result((message, payload))
+        finally:
+            for future in self._futures.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to the stamp service closed"))
+
+
+def _encode_stamp(stamp):
+    """Encodes a Stamp as a JSON-able dict and the raw bytes of its planes"""
+    if stamp is None:
+        return {"found": False}, b""
+    planes = [(name, getattr(stamp, name)) for name in PLANES if getattr(stamp, name) is not None]
+    message = {
+        "found": True,
+        "header": stamp.header.tostring(),
+        "wcs": stamp.wcs.to_header_string(relax=True),
+        "planes": [[name, data.dtype.str, data.shape] for name, data in planes],
+    }
+    return message, b"".join(np.ascontiguousarray(data).tobytes() for _, data in planes)
+
+
+def _decode_stamp(message, payload):
+    """Decodes a Stamp encoded by _encode_stamp. The stamp's dpd is not transferred"""
+    if not message["found"]:
+        return None
+    planes = dict.fromkeys(PLANES)
+    offset = 0
+    for name, dtype, shape in message["planes"]:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        planes[name] = np.frombuffer(payload, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+    header = fits.Header.fromstring(message["header"])
+    wcs = WCS(fits.Header.fromstring(message["wcs"]))
+    return Stamp(header, wcs, dpd=None, **planes)
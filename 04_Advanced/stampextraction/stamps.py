@@ -24,7 +24,7 @@
 
 """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from typing import List
 import numpy as np
 
@@ -32,16 +32,23 @@ from astropy.coordinates import SkyCoord
 from astropy.units import degree
 from astropy.io import fits
 from astropy.wcs import WCS
-from astropy.nddata.utils import Cutout2D
 
 import logging as log
 
 from stampextraction.vis_exposures import VisExposure
-from stampextraction.profiling import io_stats
+from stampextraction.detector_array import cutout
+from stampextraction.profiling import io_stats, phase
+from stampextraction.resampling import recentre_stamps
 
 
 logger = log.getLogger(__name__)
 
+# number of objects located at once by locate_objects
+LOCATE_CHUNK_SIZE = 65536
+
+# stamps on a detector are read as one block per plane if the block is at most this many times their total area
+COALESCE_MAX_AREA_RATIO = 4
+
 
 @dataclass
 class Stamp:
@@ -83,7 +90,7 @@ def extract_stamps_from_exposures(exposures: List[VisExposure], ra, dec, size, x
     return stamps
 
 
-@io_stats(prof_queue=True)
+@io_stats(aggregate=True)
 def extract_exposure_stamp(exposure: VisExposure, ra, dec, size, x_buffer=0, y_buffer=0):
     """
     Extracts a stamp from a VisExposure object
@@ -107,69 +114,237 @@ def extract_exposure_stamp(exposure: VisExposure, ra, dec, size, x_buffer=0, y_b
     wcs = None
     det_id = None
 
-    if "LINEAR" in exposure.get_wcs_list()[0].wcs.ctype:
-        # fudge for the static test data which use a linear WCS
-        skycoord = (ra, dec)
+    with phase("wcs"):
+        wcs_list = exposure.get_wcs_list()
+
+    with phase("lookup"):
+        if "LINEAR" in wcs_list[0].wcs.ctype:
+            # fudge for the static test data which use a linear WCS
+            skycoord = (ra, dec)
+
+            for i, w in enumerate(wcs_list):
+
+                nx, ny = w.pixel_shape
+                x, y = w.all_world2pix([ra], [dec], 0)
+                if (x_buffer < x <= nx - x_buffer) and (y_buffer < y <= ny - y_buffer):
+                    wcs = w
+                    det_id = i
+                    break
+
+        else:
+            # The proper way
+            skycoord = SkyCoord(ra, dec, unit=degree)
+
+            # only test the detectors whose bounding caps contain the object
+            caps = exposure.get_detector_caps()
+            if caps is not None:
+                candidates = caps.candidates(ra, dec, margin_pixels=max(0, -x_buffer, -y_buffer))[0]
+            else:
+                candidates = np.ones(len(wcs_list), dtype=bool)
+
+            # determine which detector this object is in
+            for i in map(int, np.flatnonzero(candidates)):
+                w = wcs_list[i]
+                if wcs_with_buffer(w, x_buffer, y_buffer).footprint_contains(skycoord):
+                    wcs = w
+                    det_id = i
+                    break
 
-        for i, w in enumerate(exposure.get_wcs_list()):
+    if wcs is None:
+        logger.warning("Object not in observation")
+        return None
 
-            nx, ny = w.pixel_shape
-            x, y = w.all_world2pix([ra], [dec], 0)
-            if (x_buffer < x <= nx - x_buffer) and (y_buffer < y <= ny - y_buffer):
-                wcs = w
-                det_id = i
-                break
+    with phase("detector"):
+        det = exposure[det_id]
 
-    else:
-        # The proper way
-        skycoord = SkyCoord(ra, dec, unit=degree)
+    return _cut_stamp(det, wcs, skycoord, size)
 
-        # determine which detector this object is in
-        wcs = None
-        det_id = None
-        for i, w in enumerate(exposure.get_wcs_list()):
-            if wcs_with_buffer(w, x_buffer, y_buffer).footprint_contains(skycoord):
-                wcs = w
-                det_id = i
-                break
 
-    if wcs is None:
-        logger.warning("Object not in observation")
-        return None
+@io_stats(aggregate=True)
+def extract_exposure_stamps(
+    exposure: VisExposure, ra, dec, size, x_buffer=0, y_buffer=0, recentre=None
+) -> List[Stamp]:
+    """
+    Extracts the stamps for a batch of objects from a VisExposure object. For celestial WCSs this is equivalent
+    to calling extract_exposure_stamp for each object, but the objects are located on the detectors with one
+    vectorised WCS transformation per detector rather than building a SkyCoord per object. The RA/Dec are assumed
+    to be in the frame of the WCS (e.g. ICRS).
+
+    For the LINEAR WCSs of the static test data the stamps differ: extract_exposure_stamp uses (ra, dec) directly
+    as the pixel position of the cutout, whereas here the stamps are cut around the pixel position given by the WCS.
+
+    Inputs:
+      - exposure: a VisExposure object (or subclass of)
+      - ra: array of the right ascensions of the objects (degrees)
+      - dec: array of the declinations of the objects (degrees)
+      - size: the size of the stamps in pixels
+      - x_buffer, y_buffer: see extract_exposure_stamp
+      - recentre: if "bilinear" or "lanczos3", the stamps are resampled so that the objects are exactly at their
+        centres (see resampling.recentre_stamps). Otherwise the stamps are aligned to the detector pixels
+
+    Returns:
+      - stamps: a list of Stamp objects, one per object. None is returned for objects for which no stamp can
+        be extracted (e.g. the input coords are outside the FOV of the exposure).
+    """
+    det_nums, x, y = locate_objects(exposure, ra, dec, x_buffer, y_buffer)
+
+    stamps = [None] * len(det_nums)
+    wcs_list = exposure.get_wcs_list()
 
-    det = exposure[det_id]
+    # extract the stamps detector by detector
+    for det_num in np.unique(det_nums[det_nums >= 0]):
+        inds = np.flatnonzero(det_nums == det_num)
+        det_stamps = cut_detector_stamps(exposure[int(det_num)], wcs_list[det_num], x[inds], y[inds], size)
+        for i, stamp in zip(inds, det_stamps):
+            stamps[i] = stamp
 
+    if recentre:
+        recentre_stamps(stamps, x, y, [wcs_list[det_num] if det_num >= 0 else None for det_num in det_nums], recentre)
+
+    return stamps
+
+
+def cut_detector_stamps(det, wcs, x, y, size):
+    """
+    Cuts stamps centred on the pixel positions (x, y) out of all the planes of a detector. If the stamps are close
+    together, the region covering all of them is read once per plane (see COALESCE_MAX_AREA_RATIO) rather than
+    reading each stamp separately.
+
+    Inputs:
+      - det: the Detector
+      - wcs: the detector's WCS
+      - x, y: arrays of the (0-based) pixel coordinates of the stamp centres
+      - size: the size of the stamps in pixels (a scalar, or an array with one size per stamp)
+
+    Returns:
+      - stamps: a list of Stamp objects
+    """
+    x, y = np.atleast_1d(x), np.atleast_1d(y)
+    sizes = np.broadcast_to(size, x.shape)
+
+    if len(x) > 1:
+        # bounding box of all the stamps (with a pixel to spare for rounding), clipped to the detector
+        ny, nx = det.sci.shape
+        half = sizes / 2 + 1
+        x0, x1 = max(int(np.floor((x - half).min())), 0), min(int(np.ceil((x + half).max())) + 1, nx)
+        y0, y1 = max(int(np.floor((y - half).min())), 0), min(int(np.ceil((y + half).max())) + 1, ny)
+        if 0 < (x1 - x0) * (y1 - y0) <= COALESCE_MAX_AREA_RATIO * np.sum(np.square(sizes, dtype=np.float64)):
+            block = (slice(y0, y1), slice(x0, x1))
+            planes = {
+                plane: getattr(det, plane).window(block)
+                for plane in ("sci", "rms", "flg", "wgt", "bkg", "seg")
+                if getattr(det, plane) is not None
+            }
+            det = replace(det, **planes)
+
+    return [_cut_stamp(det, wcs, (xi, yi), si) for xi, yi, si in zip(x, y, sizes)]
+
+
+def locate_objects(exposure: VisExposure, ra, dec, x_buffer=0, y_buffer=0):
+    """
+    Finds the detector each object falls on, and its pixel position on that detector.
+
+    Inputs:
+      - exposure: a VisExposure object (or subclass of)
+      - ra: array of the right ascensions of the objects (degrees)
+      - dec: array of the declinations of the objects (degrees)
+      - x_buffer, y_buffer: see extract_exposure_stamp
+
+    Returns:
+      - det_nums: array of the detector numbers, -1 for objects outside the exposure
+      - x, y: arrays of the (0-based) pixel coordinates of the objects on their detectors (nan if outside)
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+
+    det_nums = np.full(ra.shape, -1, dtype=np.int64)
+    x = np.full(ra.shape, np.nan)
+    y = np.full(ra.shape, np.nan)
+
+    with phase("wcs"):
+        wcs_list = exposure.get_wcs_list()
+        caps = exposure.get_detector_caps()
+
+    linear = "LINEAR" in wcs_list[0].wcs.ctype
+
+    with phase("lookup"):
+        # work through the objects in chunks, to bound the size of the (object, detector) candidate matrix
+        for start in range(0, len(ra), LOCATE_CHUNK_SIZE):
+            chunk = slice(start, start + LOCATE_CHUNK_SIZE)
+            chunk_ra, chunk_dec = ra[chunk], dec[chunk]
+            unassigned = np.ones(len(chunk_ra), dtype=bool)
+
+            # rule out most (object, detector) pairs with one dot product against the detectors' bounding caps
+            if caps is not None:
+                candidates = caps.candidates(chunk_ra, chunk_dec, margin_pixels=max(0, -x_buffer, -y_buffer))
+            else:
+                candidates = np.ones((len(chunk_ra), len(wcs_list)), dtype=bool)
+
+            for i in range(len(wcs_list)):
+                test = np.flatnonzero(unassigned & candidates[:, i])
+                if len(test) == 0:
+                    continue
+
+                # only the WCSs of detectors with candidate objects are built
+                w = wcs_list[i]
+                nx, ny = w.pixel_shape
+                xi, yi = w.all_world2pix(chunk_ra[test], chunk_dec[test], 0)
+
+                if linear:
+                    # same test as for the static test data in extract_exposure_stamp
+                    inside = (x_buffer < xi) & (xi <= nx - x_buffer) & (y_buffer < yi) & (yi <= ny - y_buffer)
+                else:
+                    # same test as WCS.footprint_contains on wcs_with_buffer(w, x_buffer, y_buffer)
+                    inside = (x_buffer < xi) & (xi < nx - x_buffer) & (y_buffer < yi) & (yi < ny - y_buffer)
+
+                found = test[inside]
+                unassigned[found] = False
+                det_nums[start + found] = i
+                x[start + found] = xi[inside]
+                y[start + found] = yi[inside]
+
+    return det_nums, x, y
+
+
+def _cut_stamp(det, wcs, position, size):
+    """Cuts a stamp centred on position (a SkyCoord or a pixel position (x, y)) out of all the planes of a detector"""
     header = det.header
 
-    sci_cutout = Cutout2D(det.sci, skycoord, size, wcs=wcs, mode="partial", fill_value=0, copy=True)
+    with phase("sci"):
+        sci_cutout = cutout(det.sci, position, size, wcs=wcs, mode="partial", fill_value=0)
     sci = sci_cutout.data
     centred_wcs = sci_cutout.wcs
 
-    rms = (
-        Cutout2D(det.rms, skycoord, size, wcs=wcs, mode="partial", fill_value=0, copy=True).data
-        if det.rms is not None
-        else None
-    )
-    flg = (
-        Cutout2D(det.flg, skycoord, size, wcs=wcs, mode="partial", fill_value=1, copy=True).data
-        if det.flg is not None
-        else None
-    )
-    bkg = (
-        Cutout2D(det.bkg, skycoord, size, wcs=wcs, mode="partial", fill_value=0, copy=True).data
-        if det.bkg is not None
-        else None
-    )
-    wgt = (
-        Cutout2D(det.wgt, skycoord, size, wcs=wcs, mode="partial", fill_value=0, copy=True).data
-        if det.wgt is not None
-        else None
-    )
-    seg = (
-        Cutout2D(det.seg, skycoord, size, wcs=wcs, mode="partial", fill_value=0, copy=True).data
-        if det.seg is not None
-        else None
-    )
+    with phase("rms"):
+        rms = (
+            cutout(det.rms, position, size, wcs=wcs, mode="partial", fill_value=0).data
+            if det.rms is not None
+            else None
+        )
+    with phase("flg"):
+        flg = (
+            cutout(det.flg, position, size, wcs=wcs, mode="partial", fill_value=1).data
+            if det.flg is not None
+            else None
+        )
+    with phase("bkg"):
+        bkg = (
+            cutout(det.bkg, position, size, wcs=wcs, mode="partial", fill_value=0).data
+            if det.bkg is not None
+            else None
+        )
+    with phase("wgt"):
+        wgt = (
+            cutout(det.wgt, position, size, wcs=wcs, mode="partial", fill_value=0).data
+            if det.wgt is not None
+            else None
+        )
+    with phase("seg"):
+        seg = (
+            cutout(det.seg, position, size, wcs=wcs, mode="partial", fill_value=0).data
+            if det.seg is not None
+            else None
+        )
 
     stamp = Stamp(header, centred_wcs, sci, rms, flg, wgt, bkg, seg, det.dpd)
 
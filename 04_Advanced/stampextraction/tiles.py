@@ -0,0 +1,232 @@
+#
+# Copyright (C) 2012-2025 Euclid Science Ground Segment
+#
+# This library is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3.0 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""
+:file: python/SHE_PPT/she_io/tiles.py
+
+:date: 2025-09-18
+
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from stampextraction.node_cache import get_node_cache
+
+logger = logging.getLogger(__name__)
+
+
+class TileCache:
+    """A thread-safe LRU cache of decompressed tiles, limited to max_bytes"""
+
+    def __init__(self, max_bytes=64 * 1024**2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        if tile.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self.nbytes += tile.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+
+TILE_CACHE = TileCache()
+
+_executor = None
+_n_threads = min(8, os.cpu_count() or 1)
+
+
+def set_decompression_threads(n_threads):
+    """Sets the number of threads used to decompress tiles in parallel (1 disables threading)"""
+    global _executor, _n_threads
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+    _n_threads = n_threads
+
+
+def _get_executor():
+    global _executor
+    if _executor is None and _n_threads > 1:
+        _executor = ThreadPoolExecutor(max_workers=_n_threads, thread_name_prefix="tile-decompression")
+    return _executor
+
+
+def _normalise_index(inds, shape):
+    """
+    Converts a basic index into the 2D box to be read, (y0, y1, x0, x1), plus the index to apply to that box to get
+    the requested result
+    """
+    if not isinstance(inds, tuple):
+        inds = (inds,)
+    if Ellipsis in inds:
+        i = inds.index(Ellipsis)
+        inds = inds[:i] + (slice(None),) * (len(shape) - len(inds) + 1) + inds[i + 1:]
+    inds = inds + (slice(None),) * (len(shape) - len(inds))
+    if len(inds) != 2:
+        raise IndexError(f"Invalid index {inds} for a 2D image")
+
+    box = []
+    local = []
+    for ind, n in zip(inds, shape):
+        if isinstance(ind, (int, np.integer)):
+            i = int(ind) + n if ind < 0 else int(ind)
+            if not 0 <= i < n:
+                raise IndexError(f"Index {ind} is out of bounds for axis with size {n}")
+            box.extend((i, i + 1))
+            local.append(0)
+        elif isinstance(ind, slice):
+            start, stop, step = ind.indices(n)
+            if step < 0:
+                raise IndexError("Negative steps are not supported when reading tiled images")
+            stop = max(stop, start)
+            box.extend((start, stop))
+            local.append(slice(None, None, step))
+        else:
+            raise IndexError(f"Only integers and slices are supported when reading tiled images, not {ind}")
+
+    return tuple(box), tuple(local)
+
+
+class TiledReader:
+    """
+    Reads regions of a tile-compressed 2D image one tile at a time.
+
+    A read is mapped to the minimal set of tiles overlapping it. Tiles already in the cache are reused, and the
+    missing ones are read (and so decompressed) from the underlying reader, in parallel threads if parallel=True.
+    The reader only needs to support 2D slicing, e.g. an astropy CompImageHDU.section or a fitsio ImageHDU.
+
+    Inputs:
+      - reader: the object to read the tiles from
+      - shape: the shape of the image
+      - tile_shape: the shape of the compression tiles (in numpy order)
+      - dtype: the dtype of the image
+      - key: a hashable uniquely identifying the image in the cache (e.g. its DataSource)
+      - cache: the TileCache to use (defaults to the global TILE_CACHE)
+      - parallel: whether several tiles can be read at once from the reader
+    """
+
+    def __init__(self, reader, shape, tile_shape, dtype, key, cache=None, parallel=True):
+        self.reader = reader
+        self.shape = tuple(shape)
+        self.tile_shape = tuple(min(t, n) for t, n in zip(tile_shape, shape))
+        self.dtype = np.dtype(dtype)
+        self.key = key
+        self.cache = cache if cache is not None else TILE_CACHE
+        self.parallel = parallel
+
+    def _read_tile(self, tile):
+        ty, tx = tile
+        th, tw = self.tile_shape
+        ny, nx = self.shape
+        y0, y1, x0, x1 = ty * th, min((ty + 1) * th, ny), tx * tw, min((tx + 1) * tw, nx)
+
+        def load():
+            return np.asarray(self.reader[y0:y1, x0:x1])
+
+        # another rank on this node may already have read the tile
+        node_cache = get_node_cache()
+        if node_cache is not None:
+            data = node_cache.get_or_load((self.key, ty, tx), (y1 - y0, x1 - x0), self.dtype, load)
+        else:
+            data = load()
+
+        self.cache.put((self.key, ty, tx), data)
+        return data
+
+    def __getitem__(self, inds):
+        (y0, y1, x0, x1), local = _normalise_index(inds, self.shape)
+        th, tw = self.tile_shape
+
+        out = np.empty((y1 - y0, x1 - x0), dtype=self.dtype)
+        if out.size == 0:
+            return out[local]
+
+        tiles = [(ty, tx) for ty in range(y0 // th, (y1 - 1) // th + 1) for tx in range(x0 // tw, (x1 - 1) // tw + 1)]
+        data = {tile: self.cache.get((self.key,) + tile) for tile in tiles}
+        missing = [tile for tile, tile_data in data.items() if tile_data is None]
+
+        if missing:
+            # read the first tile in this thread, which also initialises any lazily-loaded state of the reader
+            data[missing[0]] = self._read_tile(missing[0])
+            executor = _get_executor() if self.parallel else None
+            if executor is not None and len(missing) > 2:
+                for tile, tile_data in zip(missing[1:], executor.map(self._read_tile, missing[1:])):
+                    data[tile] = tile_data
+            else:
+                for tile in missing[1:]:
+                    data[tile] = self._read_tile(tile)
+
+        # copy the overlapping part of each tile into the output
+        for (ty, tx), tile_data in data.items():
+            ty0, tx0 = ty * th, tx * tw
+            ya, yb = max(y0, ty0), min(y1, ty0 + th)
+            xa, xb = max(x0, tx0), min(x1, tx0 + tw)
+            out[ya - y0: yb - y0, xa - x0: xb - x0] = tile_data[ya - ty0: yb - ty0, xa - tx0: xb - tx0]
+
+        return out[local]
+
+
+# The tiles used to read uncompressed images through the node cache
+NODE_CACHE_TILE_SHAPE = (256, 256)
+
+
+def tiled_reader(reader, shape, dtype, key, tile_shape=None, parallel=True, node_tile_shape=None):
+    """
+    Returns a TiledReader for reader if the image is tile-compressed (tile_shape is given), or if a node cache is in
+    use, in which case uncompressed images are read in tiles of node_tile_shape (e.g. the HDF5 chunk shape, defaulting
+    to NODE_CACHE_TILE_SHAPE). Otherwise returns reader.
+    """
+    if tile_shape is None:
+        if get_node_cache() is None:
+            return reader
+        tile_shape = node_tile_shape or NODE_CACHE_TILE_SHAPE
+    return TiledReader(reader, shape, tile_shape, dtype, key, parallel=parallel)
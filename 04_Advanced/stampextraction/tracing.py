@@ -0,0 +1,210 @@
+#
+# Copyright (C) 2012-2025 Euclid Science Ground Segment
+#
+# This library is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3.0 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""
+:file: python/SHE_PPT/she_io/tracing.py
+
+:date: 2025-09-15
+
+"""
+
+import logging
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Identifies where the data read through a detector array comes from: the file, the HDU (its index for FITS
+# files, the dataset name for HDF5 files) and the plane of the detector (sci, rms, flg, wgt, bkg or seg)
+DataSource = namedtuple("DataSource", ["file", "hdu", "plane"])
+
+TRACE_DTYPE = np.dtype(
+    [
+        ("t_start", np.int64),  # ns since the tracer was enabled
+        ("duration", np.int64),  # ns
+        ("file", "U256"),
+        ("hdu", "U64"),
+        ("plane", "U8"),
+        ("y0", np.int64),
+        ("y1", np.int64),
+        ("x0", np.int64),
+        ("x1", np.int64),
+        ("ny", np.int64),
+        ("nx", np.int64),
+        ("nbytes", np.int64),
+    ]
+)
+
+
+def _slice_box(inds, shape):
+    """
+    Returns the (y0, y1, x0, x1) box selected by inds, or -1s if inds is not a plain 2D slice (e.g. fancy indexing)
+    """
+    if not isinstance(inds, tuple) or len(inds) != 2 or len(shape) != 2:
+        return -1, -1, -1, -1
+    box = []
+    for ind, n in zip(inds, shape):
+        if not isinstance(ind, slice) or ind.step not in (None, 1):
+            return -1, -1, -1, -1
+        start, stop, _ = ind.indices(n)
+        box.extend((start, stop))
+    return tuple(box)
+
+
+class IOTracer:
+    """
+    Records every read made through the detector arrays of the VisExposure backends: which file, HDU and plane
+    were read, the requested pixel box, the shape and size of the returned data and how long the read took.
+
+    The trace can be saved with save() and replayed against local files with replay().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._records = []
+        self._t0 = 0
+
+    def enable(self):
+        self._t0 = time.perf_counter_ns()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self._records = []
+
+    def read(self, reader, source, shape, inds):
+        """Returns reader[inds], recording the read if the tracer is enabled"""
+        if not self.enabled:
+            return reader[inds]
+
+        t0 = time.perf_counter_ns()
+        data = reader[inds]
+        t1 = time.perf_counter_ns()
+
+        ny, nx = ((1, 1) + data.shape)[-2:]
+        self._records.append(
+            (t0 - self._t0, t1 - t0, str(source.file), str(source.hdu), source.plane)
+            + _slice_box(inds, shape)
+            + (ny, nx, data.nbytes)
+        )
+        return data
+
+    def __len__(self):
+        return len(self._records)
+
+    def to_array(self):
+        """Returns the trace as a structured array (see TRACE_DTYPE)"""
+        return np.array(self._records, dtype=TRACE_DTYPE)
+
+    def summary(self):
+        """Returns the number of reads and bytes read, per (file, hdu)"""
+        summary = {}
+        for rec in self._records:
+            key = (rec[2], rec[3])
+            n, nbytes = summary.get(key, (0, 0))
+            summary[key] = (n + 1, nbytes + rec[-1])
+        return summary
+
+    def save(self, path):
+        """Saves the trace as a .npy file"""
+        np.save(path, self.to_array(), allow_pickle=False)
+
+
+TRACER = IOTracer()
+
+
+def load_trace(path):
+    return np.load(path, allow_pickle=False)
+
+
+class _DefaultOpener:
+    """
+    Opens the data of a traced (file, hdu) for replay, based on the file extension. Each file is opened once, however
+    many of its HDUs are read, and close() closes all of them
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    def __call__(self, file, hdu):
+        if os.path.splitext(file)[1] in (".h5", ".hdf5"):
+            return self._open(file)[hdu]
+        else:
+            return self._open(file)[int(hdu)]
+
+    def _open(self, file):
+        if file not in self._files:
+            if os.path.splitext(file)[1] in (".h5", ".hdf5"):
+                import h5py
+
+                self._files[file] = h5py.File(file, "r")
+            else:
+                import fitsio
+
+                self._files[file] = fitsio.FITS(file)
+        return self._files[file]
+
+    def close(self):
+        while self._files:
+            _, f = self._files.popitem()
+            f.close()
+
+
+def replay(trace, opener=None, file_map=None):
+    """
+    Replays a trace, re-issuing each read, and returns the duration (ns) of every read.
+
+    Inputs:
+      - trace: a trace array (see TRACE_DTYPE) or the path to a saved trace
+      - opener: a function opener(file, hdu) returning an object that can be sliced like the original data.
+        This allows a different layout (e.g. an HDF5 copy of FITS data) or a caching policy to be benchmarked
+        against the same access pattern. Defaults to fitsio for FITS files and h5py for HDF5 files, opening each
+        file once and closing them all when the replay is done
+      - file_map: optional dict mapping the traced file names to local copies
+    """
+    if isinstance(trace, (str, os.PathLike)):
+        trace = load_trace(trace)
+    default_opener = _DefaultOpener() if opener is None else None
+    opener = opener or default_opener
+    file_map = file_map or {}
+
+    handles = {}
+    durations = np.zeros(len(trace), dtype=np.int64)
+    try:
+        for i, rec in enumerate(trace):
+            if rec["y0"] < 0:
+                logger.warning("Skipping read %d, which does not select a plain 2D box", i)
+                continue
+            key = (file_map.get(rec["file"], rec["file"]), rec["hdu"])
+            if key not in handles:
+                handles[key] = opener(*key)
+
+            t0 = time.perf_counter_ns()
+            handles[key][rec["y0"]:rec["y1"], rec["x0"]:rec["x1"]]
+            durations[i] = time.perf_counter_ns() - t0
+    finally:
+        handles.clear()
+        if default_opener is not None:
+            default_opener.close()
+
+    return durations
@@ -28,7 +28,10 @@ import os
 import json
 import gc
 from itertools import repeat
+from collections import OrderedDict
+from contextlib import contextmanager
 import re
+import threading
 
 from abc import ABC, abstractmethod
 
@@ -43,6 +46,9 @@ import fitsio
 import h5py
 
 from stampextraction.profiling import io_stats
+from stampextraction.tracing import DataSource
+from stampextraction.detector_array import DetectorArray
+from stampextraction.tiles import tiled_reader
 
 import logging as log
 
@@ -112,12 +118,12 @@ class Detector:
 
     header: fits.header
     wcs: WCS
-    sci: np.ndarray
-    rms: np.ndarray
-    flg: np.ndarray
-    wgt: np.ndarray
-    bkg: np.ndarray
-    seg: np.ndarray
+    sci: DetectorArray
+    rms: DetectorArray
+    flg: DetectorArray
+    wgt: DetectorArray
+    bkg: DetectorArray
+    seg: DetectorArray
     dpd: "DpdVisCalibratedFrame"  # noqa: F821
     name: str
     number: int
@@ -153,23 +159,190 @@ class Detector:
         return True
 
 
+def radec_to_unit_vectors(ra, dec):
+    """Converts RA/Dec (degrees) to an (n, 3) array of unit vectors"""
+    ra = np.radians(np.atleast_1d(np.asarray(ra, dtype=np.float64)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec, dtype=np.float64)))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def _detector_sample_points(nx, ny):
+    """The (0-based) pixel coordinates of the centre of a detector, then of its corners and edge mid-points"""
+    xc, yc = (nx - 1) / 2, (ny - 1) / 2
+    x0, x1, y0, y1 = -0.5, nx - 0.5, -0.5, ny - 0.5
+    xs = np.array([xc, x0, xc, x1, x0, x1, x0, xc, x1])
+    ys = np.array([yc, y0, y0, y0, yc, yc, y1, y1, y1])
+    return xs, ys
+
+
+@dataclass
+class DetectorCaps:
+    """
+    Spherical caps bounding the detectors of an exposure, used to cheaply rule out (object, detector) pairs
+    before any exact WCS test. All angles are in radians.
+    """
+
+    centres: np.ndarray  # (n_detectors, 3) unit vectors of the detector centres
+    radii: np.ndarray  # angular radius of each cap
+    pixel_scales: np.ndarray  # approximate size of a pixel of each detector
+
+    @classmethod
+    def from_wcs_list(cls, wcs_list):
+        centres, radii, pixel_scales = [], [], []
+        for w in wcs_list:
+            nx, ny = w.pixel_shape
+            xs, ys = _detector_sample_points(nx, ny)
+            ra, dec = w.all_pix2world(xs, ys, 0)
+            vecs = radec_to_unit_vectors(ra, dec)
+            angles = np.arccos(np.clip(vecs[1:] @ vecs[0], -1, 1))
+
+            centres.append(vecs[0])
+            pixel_scales.append(angles.max() / np.hypot(nx / 2, ny / 2))
+            # allow for distortions between the sampled edge points
+            radii.append(angles.max() * 1.01 + 2 * pixel_scales[-1])
+
+        return cls(np.array(centres), np.array(radii), np.array(pixel_scales))
+
+    @classmethod
+    def from_headers(cls, headers):
+        """
+        Builds the caps from a few keywords of the detectors' headers, without constructing any WCS objects. Only
+        TAN projections (optionally with SIP distortions, which are bounded from their coefficients) are supported:
+        None is returned for any other header.
+        """
+        centres, radii, pixel_scales = [], [], []
+        for hdr in headers:
+            ctypes = (str(hdr.get("CTYPE1", "")).strip(), str(hdr.get("CTYPE2", "")).strip())
+            if ctypes not in (("RA---TAN", "DEC--TAN"), ("RA---TAN-SIP", "DEC--TAN-SIP")):
+                return None
+            if hdr.get("LONPOLE", 180) != 180 or any(str(key).startswith("PV") for key in hdr.keys()):
+                return None
+            if str(hdr.get("CUNIT1", "deg")).strip() != "deg" or str(hdr.get("CUNIT2", "deg")).strip() != "deg":
+                return None
+
+            nx = hdr.get("ZNAXIS1", hdr.get("NAXIS1"))
+            ny = hdr.get("ZNAXIS2", hdr.get("NAXIS2"))
+            if nx is None or ny is None:
+                return None
+
+            if "CD1_1" in hdr:
+                cd = np.array([[hdr.get(f"CD{i}_{j}", 0.0) for j in (1, 2)] for i in (1, 2)])
+            else:
+                cd = np.array(
+                    [[hdr.get(f"CDELT{i}", 1.0) * hdr.get(f"PC{i}_{j}", float(i == j)) for j in (1, 2)] for i in (1, 2)]
+                )
+
+            # pixel offsets from the reference pixel (FITS pixels are 1-based)
+            xs, ys = _detector_sample_points(nx, ny)
+            u = xs + 1 - hdr["CRPIX1"]
+            v = ys + 1 - hdr["CRPIX2"]
+
+            # bound the SIP distortion over the detector: |sum A_p_q u^p v^q| <= sum |A_p_q| |u|max^p |v|max^q
+            distortion = 0.0
+            if ctypes[0].endswith("-SIP"):
+                u_max, v_max = np.abs(u).max(), np.abs(v).max()
+                bounds = []
+                for poly in ("A", "B"):
+                    order = hdr.get(f"{poly}_ORDER", 0)
+                    bounds.append(
+                        sum(
+                            abs(hdr.get(f"{poly}_{p}_{q}", 0.0)) * u_max**p * v_max**q
+                            for p in range(order + 1)
+                            for q in range(order + 1 - p)
+                        )
+                    )
+                distortion = np.hypot(*bounds)
+
+            # gnomonic projection about the reference point, in the tangent plane's east/north basis
+            xi, eta = np.radians(cd @ np.array([u, v]))
+            ra0, dec0 = np.radians(hdr["CRVAL1"]), np.radians(hdr["CRVAL2"])
+            ref = radec_to_unit_vectors(hdr["CRVAL1"], hdr["CRVAL2"])[0]
+            east = np.array([-np.sin(ra0), np.cos(ra0), 0.0])
+            north = np.array([-np.sin(dec0) * np.cos(ra0), -np.sin(dec0) * np.sin(ra0), np.cos(dec0)])
+            vecs = ref + xi[:, None] * east + eta[:, None] * north
+            vecs /= np.linalg.norm(vecs, axis=1)[:, None]
+            angles = np.arccos(np.clip(vecs[1:] @ vecs[0], -1, 1))
+
+            centres.append(vecs[0])
+            pixel_scales.append(np.radians(np.sqrt(abs(np.linalg.det(cd)))))
+            # the cap around the corners contains the whole (undistorted) detector, so only the distortion and
+            # rounding need allowing for
+            radii.append(angles.max() * 1.01 + (distortion + 2) * pixel_scales[-1])
+
+        return cls(np.array(centres), np.array(radii), np.array(pixel_scales))
+
+    def candidates(self, ra, dec, margin_pixels=0):
+        """
+        Returns an (n_objects, n_detectors) boolean array, True where the object may lie on the detector (and
+        False where it certainly doesn't). margin_pixels enlarges the caps, e.g. to allow for negative pixel buffers
+        """
+        cos_radii = np.cos(np.minimum(self.radii + margin_pixels * self.pixel_scales, np.pi))
+        return radec_to_unit_vectors(ra, dec) @ self.centres.T >= cos_radii
+
+
+class _LazyList:
+    """
+    A read-only list whose items are only made (by make_item(index)) the first time they are accessed. Items are
+    made while holding lock, so each is made once even if it is accessed from several threads
+    """
+
+    def __init__(self, n, make_item, lock):
+        self._items = [None] * n
+        self._made = [False] * n
+        self._make_item = make_item
+        self._lock = lock
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if not self._made[index]:
+            with self._lock:
+                if not self._made[index]:
+                    self._items[index] = self._make_item(range(len(self))[index])
+                    self._made[index] = True
+        return self._items[index]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def n_made(self):
+        """The number of items that have been made"""
+        return sum(self._made)
+
+
 class VisExposure(ABC):
     """
     Abstract class allowing access to a VIS exposure's data. The class exposes the following methods:
 
     - get_wcs_list - returns the list of WCS objects for the detectors associated with this exposure
     - get_header_list - returns the list of headers for the detectors associated with this exposure
+      (the headers and WCSs in these lists are only built when first accessed)
+    - get_detector_caps - returns the spherical caps bounding each detector, for fast position pre-filtering
     - get_detector - returns a Detector object for the requested detector. Can be indexed by the detector
                      number (0-36) or its id (e.g. "5-5")
     - delete_detector - dereferences a detector object to e.g. free up memory/resources
+    - to_dask - returns a plane of all the detectors as a (lazy) Dask array
 
     The class can also be indexed to get a detector object - e.g exposure["5-5"] or exposure[22]
     Similarly, the detector object can be dereferenced by del(exposure["5-5"]) or del(exposure[22])
 
     This class is supposed to be agnostic to the method of accessing the data (e.g. astropy.io.fits,
     fitsio, others...) so a subclass must be created that implements data access via the chosen method.
+
+    Subclasses that support it can be given an ExposureHandlePool, which limits the number of files open
+    across many exposures. Their files may then be closed at any time, and are reopened when next needed.
+
+    The headers, WCSs, caps and detector objects are made under a per-exposure lock, so they can be requested
+    from several threads with any subclass. thread_safe is True for subclasses whose detectors' data can then be
+    read from several threads at once.
     """
 
+    thread_safe = False
+
     def __init__(self):
         self._wcs_list = None
         self._header_list = None
@@ -177,6 +350,12 @@ class VisExposure(ABC):
         self._detectors = {}
         self.n_detectors = None
         self.dpd = None
+        self.pool = None
+        self._is_open = False
+        self._caps = None
+        self._caps_checked = False
+        # reentrant, as making a detector makes its header and WCS
+        self._create_lock = threading.RLock()
 
     def get_wcs_list(self):
         if not self._wcs_list:
@@ -188,11 +367,31 @@ class VisExposure(ABC):
             self._get_wcs_and_header_list()
         return self._header_list
 
+    def get_detector_caps(self):
+        """Returns the DetectorCaps of this exposure, or None if its WCSs are not celestial (e.g. LINEAR test data)"""
+        if not self._caps_checked:
+            with self._create_lock:
+                self._make_detector_caps()
+        return self._caps
+
+    def _make_detector_caps(self):
+        if not self._caps_checked:
+            # where possible, build the caps from the raw headers so that no WCS objects need to be built
+            raw_headers = [self._get_raw_header(det_num) for det_num in range(len(self))]
+            self._caps = DetectorCaps.from_headers(raw_headers)
+            if self._caps is None:
+                wcs_list = self.get_wcs_list()
+                if all(w.has_celestial for w in wcs_list):
+                    self._caps = DetectorCaps.from_wcs_list(wcs_list)
+            self._caps_checked = True
+
     def get_detector(self, det_name):
         if not self._header_list:
             self._get_wcs_and_header_list()
         if det_name not in self._detectors:
-            self._create_detector(det_name)
+            with self._create_lock, self._opened():
+                if det_name not in self._detectors:
+                    self._create_detector(det_name)
 
         return self._detectors[det_name]
 
@@ -248,7 +447,90 @@ class VisExposure(ABC):
         return self.dpd
 
     @abstractmethod
+    def get_open_args(self):
+        """Returns the keyword arguments needed to open this exposure again, e.g. in another process"""
+        # OVERRIDE ME
+        pass
+
+    def to_dask(self, plane="sci", chunk_bytes=None):
+        """
+        Returns a plane (e.g. "sci") of all the detectors as a Dask array of shape (n_detectors, ny, nx), with
+        chunks aligned to the tiles/chunks of the files. Nothing is read until the array is computed. Needs dask.
+        """
+        from stampextraction.dask_backend import exposure_to_dask
+
+        return exposure_to_dask(self, plane, chunk_bytes=chunk_bytes)
+
+    @property
+    def n_files(self):
+        """The number of files this exposure keeps open"""
+        return 1
+
+    def close(self):
+        """Closes the exposure's files. Cached headers, WCSs and detectors are kept, and the files reopened if needed"""
+        if self.pool is not None:
+            self.pool.release(self)
+        elif self._is_open:
+            self._close_files()
+
+    def _ensure_open(self):
+        """Makes sure the exposure's files are open, (re)opening them through the handle pool if there is one"""
+        if self.pool is not None:
+            self.pool.acquire(self)
+        elif not self._is_open:
+            self._open_files()
+
+    @contextmanager
+    def _opened(self):
+        """Keeps the exposure's files open for the duration of the block, pinning them in the handle pool if any"""
+        if self.pool is None:
+            self._ensure_open()
+            yield
+            return
+        self.pool.acquire(self, pin=True)
+        try:
+            yield
+        finally:
+            self.pool.unpin(self)
+
+    def _open_files(self):
+        # OVERRIDE ME to support reopening the files
+        self._is_open = True
+
+    def _close_files(self):
+        # OVERRIDE ME to support closing the files
+        self._is_open = False
+
+    def _read_hdu(self, hdus, det_num, inds):
+        # reads inds of the HDU det_num of the list attribute hdus, for the _ExposurePlane readers (used by the FITS
+        # backends). OVERRIDE ME if the HDUs can't be sliced directly (as with astropy.io.fits)
+        return getattr(self, hdus)[det_num][inds]
+
     def _get_wcs_and_header_list(self):
+        # the headers and WCSs are made lazily, so only the detectors that are used are paid for
+        with self._create_lock:
+            if self._header_list is not None:
+                return
+            if self._detector_list is None:
+                self._detector_list = self._get_detector_list()
+            n_detectors = len(self._detector_list)
+            self._wcs_list = _LazyList(
+                n_detectors, lambda det_num: WCS(self._header_list[det_num]), self._create_lock
+            )
+            # set last, as other threads take the header list being set to mean both lists are ready
+            self._header_list = _LazyList(n_detectors, self._get_header, self._create_lock)
+
+    def _get_raw_header(self, det_num):
+        # OVERRIDE ME with a cheaper way to look up a few keywords (any mapping with get, keys and in will do)
+        return self.get_header_list()[det_num]
+
+    @abstractmethod
+    def _get_detector_list(self):
+        # OVERRIDE ME
+        pass
+
+    @abstractmethod
+    def _get_header(self, det_num):
         # OVERRIDE ME
         pass
 
@@ -258,12 +540,138 @@ class VisExposure(ABC):
         pass
 
 
+class ExposureHandlePool:
+    """
+    Limits the number of files kept open by a set of exposures.
+
+    Exposures created with pool=pool open their files through the pool. When opening an exposure would take the
+    number of open files over max_open_files, the least recently used exposures are closed. A closed exposure keeps
+    its headers, WCSs and detector objects, and is reopened transparently the next time its data is read, so a job
+    that sweeps through many exposures (ideally in a sorted order) reopens each of them as rarely as possible.
+
+    The pool can be used from several threads (e.g. the threads of a parallel tiled reader). An exposure is pinned
+    while one of its reads is in progress, and pinned exposures are never closed: if all the open exposures are
+    pinned, the pool goes over max_open_files until the reads finish, and release() of a pinned exposure closes it
+    when its last read finishes.
+    """
+
+    def __init__(self, max_open_files=256):
+        if max_open_files < 1:
+            raise ValueError(f"max_open_files must be at least 1, not {max_open_files}")
+        self.max_open_files = max_open_files
+        self.n_open_files = 0
+        self.n_opens = 0
+        self.n_evictions = 0
+        self._open = OrderedDict()
+        self._pins = {}
+        self._pending_release = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, exposure, pin=False):
+        """
+        Makes sure the exposure's files are open, closing the least recently used exposures if needed. If pin is
+        True the exposure can't be closed until unpin is called.
+        """
+        with self._lock:
+            if pin:
+                self._pins[exposure] = self._pins.get(exposure, 0) + 1
+            if exposure in self._open:
+                self._open.move_to_end(exposure)
+                return
+
+            n_files = exposure.n_files
+            for lru in list(self._open):
+                if self.n_open_files + n_files <= self.max_open_files:
+                    break
+                if lru in self._pins:
+                    continue
+                del self._open[lru]
+                self._close(lru)
+                self.n_evictions += 1
+
+            try:
+                exposure._open_files()
+            except Exception:
+                if pin:
+                    self._unpin(exposure)
+                raise
+            self._open[exposure] = n_files
+            self.n_open_files += n_files
+            self.n_opens += 1
+
+    def unpin(self, exposure):
+        """Undoes one acquire(exposure, pin=True), the exposure can be closed again once all its pins are undone"""
+        with self._lock:
+            self._unpin(exposure)
+
+    def release(self, exposure):
+        """Closes the exposure's files, if open (once its reads in progress have finished, if it is pinned)"""
+        with self._lock:
+            if exposure in self._pins:
+                self._pending_release.add(exposure)
+            elif exposure in self._open:
+                del self._open[exposure]
+                self._close(exposure)
+
+    def close_all(self):
+        """Closes the files of all the exposures that are not pinned, and the pinned ones when their reads finish"""
+        with self._lock:
+            for exposure in list(self._open):
+                if exposure in self._pins:
+                    self._pending_release.add(exposure)
+                else:
+                    del self._open[exposure]
+                    self._close(exposure)
+
+    def _unpin(self, exposure):
+        self._pins[exposure] -= 1
+        if self._pins[exposure] == 0:
+            del self._pins[exposure]
+            if exposure in self._pending_release:
+                self._pending_release.discard(exposure)
+                if exposure in self._open:
+                    del self._open[exposure]
+                    self._close(exposure)
+
+    def _close(self, exposure):
+        exposure._close_files()
+        self.n_open_files -= exposure.n_files
+
+    def __len__(self):
+        return len(self._open)
+
+
+class _ExposurePlane:
+    """Reads one HDU of an exposure, reopening the exposure's files first if they have been closed"""
+
+    __slots__ = ("exposure", "hdus", "det_num")
+
+    def __init__(self, exposure, hdus, det_num):
+        self.exposure = exposure
+        self.hdus = hdus
+        self.det_num = det_num
+
+    def __getitem__(self, inds):
+        # the exposure is pinned so that no other thread's acquire closes its files during the read
+        with self.exposure._opened():
+            return self.exposure._read_hdu(self.hdus, self.det_num, inds)
+
+
 class VisExposureAstropyFITS(VisExposure):
     """Implementation of the VisExposure class using astropy.io.fits"""
 
     #@io_stats
     def __init__(
-        self, det_file, bkg_file=None, wgt_file=None, seg_file=None, load_rms=True, load_flg=True, memmap=True, dpd=None
+        self,
+        det_file,
+        bkg_file=None,
+        wgt_file=None,
+        seg_file=None,
+        load_rms=True,
+        load_flg=True,
+        memmap=True,
+        dpd=None,
+        pool=None,
     ):
         super().__init__()
 
@@ -281,19 +689,47 @@ class VisExposureAstropyFITS(VisExposure):
 
         self.dpd = dpd
 
-        # open the files
+        self._det_file = det_file
+        self._bkg_file = bkg_file
+        self._wgt_file = wgt_file
+        self._seg_file = seg_file
+        self._load_rms = load_rms
+        self._load_flg = load_flg
+        self._memmap = memmap
 
-        self._det_hdul = fits.open(det_file, memmap=memmap)
+        # open the files
+        self.pool = pool
+        self._ensure_open()
         self.primary_header = self._det_hdul[0].header
 
-        if bkg_file:
-            self._bkg_hdul = fits.open(bkg_file, memmap=memmap)
+    def get_open_args(self):
+        return dict(
+            det_file=self._det_file,
+            bkg_file=self._bkg_file,
+            wgt_file=self._wgt_file,
+            seg_file=self._seg_file,
+            load_rms=self._load_rms,
+            load_flg=self._load_flg,
+            memmap=self._memmap,
+        )
+
+    @property
+    def n_files(self):
+        n_files = sum(1 for f in (self._det_file, self._bkg_file, self._wgt_file, self._seg_file) if f)
+        # a memory map holds a second descriptor for its file
+        return 2 * n_files if self._memmap else n_files
+
+    def _open_files(self):
+        self._det_hdul = fits.open(self._det_file, memmap=self._memmap)
+
+        if self._bkg_file:
+            self._bkg_hdul = fits.open(self._bkg_file, memmap=self._memmap)
 
-        if wgt_file:
-            self._wgt_hdul = fits.open(wgt_file, memmap=memmap)
+        if self._wgt_file:
+            self._wgt_hdul = fits.open(self._wgt_file, memmap=self._memmap)
 
-        if seg_file:
-            self._seg_hdul = fits.open(seg_file, memmap=memmap)
+        if self._seg_file:
+            self._seg_hdul = fits.open(self._seg_file, memmap=self._memmap)
 
         # parse the HDUs into lists
 
@@ -307,10 +743,10 @@ class VisExposureAstropyFITS(VisExposure):
 
         self.sci_hdus = [hdu for hdu in self._det_hdul[offset::3]]
 
-        if load_rms:
+        if self._load_rms:
             self.rms_hdus = [hdu for hdu in self._det_hdul[(offset + 1)::3]]
 
-        if load_flg:
+        if self._load_flg:
             self.flg_hdus = [hdu for hdu in self._det_hdul[(offset + 2)::3]]
 
         if self._bkg_hdul:
@@ -325,43 +761,69 @@ class VisExposureAstropyFITS(VisExposure):
             offset = len(self._seg_hdul) - self.n_detectors
             self.seg_hdus = [hdu for hdu in self._seg_hdul[offset:]]
 
-    #@io_stats
-    def _get_wcs_and_header_list(self):
-        self._header_list = [_correct_header(hdu.header) for hdu in self.sci_hdus]
-        self._wcs_list = [WCS(hdr) for hdr in self._header_list]
-        self._detector_list = [get_detector_name_from_header(hdr) for hdr in self._header_list]
+        self._is_open = True
 
-    #@io_stats
-    def _create_detector(self, det_name):
-        # Make a new class that inherits from np.ndarray.
-        # Cutout2D converts all input data to np.ndarray (dtype=float64) unless it is already
-        # an instance of this ndarray. This means we cast the HDUs to different dtypes.
-        # This class disguises the hdu as an ndarray, allowing it to be used directly by Cutout2D.
-        class CCDData(np.ndarray):
-            def __new__(cls, hdu):
-                shape = tuple(hdu.shape)
-                dtype = hdu.dtype
+    def _close_files(self):
+        for hdul in (self._det_hdul, self._bkg_hdul, self._wgt_hdul, self._seg_hdul):
+            if hdul is not None:
+                # memory-mapped files are only closed once no HDU references their data
+                for hdu in hdul:
+                    if "data" in hdu.__dict__:
+                        del hdu.data
+                hdul.close()
 
-                obj = super().__new__(cls, shape, dtype=dtype, buffer=None, offset=0, strides=None, order=None)
-                obj.hdu = hdu
+        self._det_hdul = self._bkg_hdul = self._wgt_hdul = self._seg_hdul = None
+        self.sci_hdus, self.rms_hdus, self.flg_hdus = [], [], []
+        self.bkg_hdus, self.wgt_hdus, self.seg_hdus = [], [], []
 
-                return obj
+        self._is_open = False
 
-            # When indexing this object, we want to index the hdu
-            def __getitem__(self, inds):
-                return self.hdu[inds]
+    def _read_hdu(self, hdus, det_num, inds):
+        hdu = getattr(self, hdus)[det_num]
+        if isinstance(hdu, fits.CompImageHDU):
+            # .data would decompress the whole image, the section only the tiles overlapping inds
+            return hdu.section[inds]
+        return hdu.data[inds]
 
+    def _get_detector_list(self):
+        with self._opened():
+            return [get_detector_name_from_header(hdu.header) for hdu in self.sci_hdus]
+
+    def _get_raw_header(self, det_num):
+        with self._opened():
+            return self.sci_hdus[det_num].header
+
+    def _get_header(self, det_num):
+        return _correct_header(self._get_raw_header(det_num))
+
+    #@io_stats
+    def _create_detector(self, det_name):
         det_num, det_id = self._get_det_num_and_id(det_name)
 
+        def ccd_data(hdus, hdul, plane):
+            if not getattr(self, hdus):
+                return None
+            hdu = getattr(self, hdus)[det_num]
+            source = DataSource(hdul.filename(), hdul.index_of(hdu), plane)
+            reader = _ExposurePlane(self, hdus, det_num)
+            if isinstance(hdu, fits.CompImageHDU):
+                # tile-compressed images can't be memory-mapped, so read them tile by tile through the tile cache
+                dtype = hdu.section[0:1, 0:1].dtype
+                reader = tiled_reader(reader, hdu.shape, dtype, source, tile_shape=hdu.tile_shape)
+                return DetectorArray(reader, hdu.shape, dtype, source)
+            data = hdu.data
+            reader = tiled_reader(reader, data.shape, data.dtype, source)
+            return DetectorArray(reader, data.shape, data.dtype, source)
+
         # get the data references for the detector object (where available)
         wcs = self._wcs_list[det_num]
         header = self._header_list[det_num]
-        sci = CCDData(self.sci_hdus[det_num].data)
-        flg = CCDData(self.flg_hdus[det_num].data) if self.flg_hdus else None
-        rms = CCDData(self.rms_hdus[det_num].data) if self.rms_hdus else None
-        wgt = CCDData(self.wgt_hdus[det_num].data) if self.wgt_hdus else None
-        bkg = CCDData(self.bkg_hdus[det_num].data) if self.bkg_hdus else None
-        seg = CCDData(self.seg_hdus[det_num].data) if self.seg_hdus else None
+        sci = ccd_data("sci_hdus", self._det_hdul, "sci")
+        flg = ccd_data("flg_hdus", self._det_hdul, "flg")
+        rms = ccd_data("rms_hdus", self._det_hdul, "rms")
+        wgt = ccd_data("wgt_hdus", self._wgt_hdul, "wgt")
+        bkg = ccd_data("bkg_hdus", self._bkg_hdul, "bkg")
+        seg = ccd_data("seg_hdus", self._seg_hdul, "seg")
 
         # create the detector object and add it to this class's detector's dictionary
         det = Detector(
@@ -386,7 +848,18 @@ class VisExposureFitsIO(VisExposure):
     """Implementation of the VisExposure class using fitsio"""
 
     #@io_stats
-    def __init__(self, det_file, bkg_file=None, wgt_file=None, seg_file=None, load_rms=True, load_flg=True, dpd=None):
+    def __init__(
+        self,
+        det_file,
+        bkg_file=None,
+        wgt_file=None,
+        seg_file=None,
+        load_rms=True,
+        load_flg=True,
+        dpd=None,
+        pool=None,
+        verify_headers=False,
+    ):
         super().__init__()
 
         self._det_hdul = None
@@ -403,26 +876,53 @@ class VisExposureFitsIO(VisExposure):
 
         self.dpd = dpd
 
+        self._det_file = det_file
+        self._bkg_file = bkg_file
+        self._wgt_file = wgt_file
+        self._seg_file = seg_file
+        self._load_rms = load_rms
+        self._load_flg = load_flg
+        self._verify_headers = verify_headers
+        self._header_strings = None
+
         # open the files
+        self.pool = pool
+        self._ensure_open()
+        self.primary_header = self._det_hdul[0].read_header()
+
+    def get_open_args(self):
+        return dict(
+            det_file=self._det_file,
+            bkg_file=self._bkg_file,
+            wgt_file=self._wgt_file,
+            seg_file=self._seg_file,
+            load_rms=self._load_rms,
+            load_flg=self._load_flg,
+            verify_headers=self._verify_headers,
+        )
 
+    @property
+    def n_files(self):
+        return sum(1 for f in (self._det_file, self._bkg_file, self._wgt_file, self._seg_file) if f)
+
+    def _open_files(self):
         self._det_hdul = fitsio.FITS(
-            det_file,
+            self._det_file,
         )
-        self.primary_header = self._det_hdul[0].read_header()
 
-        if bkg_file:
+        if self._bkg_file:
             self._bkg_hdul = fitsio.FITS(
-                bkg_file,
+                self._bkg_file,
             )
 
-        if wgt_file:
+        if self._wgt_file:
             self._wgt_hdul = fitsio.FITS(
-                wgt_file,
+                self._wgt_file,
             )
 
-        if seg_file:
+        if self._seg_file:
             self._seg_hdul = fitsio.FITS(
-                seg_file,
+                self._seg_file,
             )
 
         # parse the HDUs into lists
@@ -437,10 +937,10 @@ class VisExposureFitsIO(VisExposure):
 
         self.sci_hdus = [hdu for hdu in self._det_hdul[offset::3]]
 
-        if load_rms:
+        if self._load_rms:
             self.rms_hdus = [hdu for hdu in self._det_hdul[(offset + 1)::3]]
 
-        if load_flg:
+        if self._load_flg:
             self.flg_hdus = [hdu for hdu in self._det_hdul[(offset + 2)::3]]
 
         if self._bkg_hdul:
@@ -455,43 +955,63 @@ class VisExposureFitsIO(VisExposure):
             offset = len(self._seg_hdul) - self.n_detectors
             self.seg_hdus = [hdu for hdu in self._seg_hdul[offset:]]
 
-    #@io_stats
-    def _get_wcs_and_header_list(self):
-        self._header_list = [_fitsio_to_astropy_header(hdu.read_header()) for hdu in self.sci_hdus]
-        self._wcs_list = [WCS(hdr) for hdr in self._header_list]
-        self._detector_list = [get_detector_name_from_header(hdr) for hdr in self._header_list]
+        self._is_open = True
 
-    #@io_stats
-    def _create_detector(self, det_name):
-        # Make a new class that inherits from np.ndarray.
-        # Cutout2D converts all input data to np.ndarray unless it is already an instance
-        # of this class. Numpy doesn't convert the fitsio.ImageHDU properly, breaking Cutout2D.
-        # This class disguises the hdu as an ndarray, allowing it to be used directly.
-        class CCDData(np.ndarray):
-            def __new__(cls, hdu):
-                shape = tuple(hdu.get_dims())
-                dtype = hdu._get_image_numpy_dtype()
+    def _close_files(self):
+        for hdul in (self._det_hdul, self._bkg_hdul, self._wgt_hdul, self._seg_hdul):
+            if hdul is not None:
+                hdul.close()
+
+        self._det_hdul = self._bkg_hdul = self._wgt_hdul = self._seg_hdul = None
+        self.sci_hdus, self.rms_hdus, self.flg_hdus = [], [], []
+        self.bkg_hdus, self.wgt_hdus, self.seg_hdus = [], [], []
 
-                obj = super().__new__(cls, shape, dtype=dtype, buffer=None, offset=0, strides=None, order=None)
-                obj.hdu = hdu
+        self._is_open = False
 
-                return obj
+    def _get_detector_list(self):
+        return [get_detector_name_from_header(self._get_raw_header(det_num)) for det_num in range(self.n_detectors)]
 
-            # When indexing this object, we want to index the hdu
-            def __getitem__(self, inds):
-                return self.hdu[inds]
+    def _get_header_string(self, det_num):
+        if self._header_strings is None:
+            with self._opened():
+                self._header_strings = _read_header_strings(self.sci_hdus)
+        return self._header_strings[det_num]
 
+    def _get_raw_header(self, det_num):
+        return _parse_header_keywords(self._get_header_string(det_num))
+
+    def _get_header(self, det_num):
+        return _uncompressed_header(_header_from_string(self._get_header_string(det_num), self._verify_headers))
+
+    #@io_stats
+    def _create_detector(self, det_name):
         det_num, det_id = self._get_det_num_and_id(det_name)
 
+        def ccd_data(hdus, plane):
+            if not getattr(self, hdus):
+                return None
+            hdu = getattr(self, hdus)[det_num]
+            source = DataSource(hdu._filename, hdu.get_extnum(), plane)
+            dtype = hdu._get_image_numpy_dtype()
+            tile_shape = None
+            if hdu.is_compressed():
+                # read tile-compressed images tile by tile through the tile cache
+                hdr = hdu.read_header()
+                tile_shape = (hdr.get("ZTILE2", 1), hdr["ZTILE1"])
+            # cfitsio can't read from the same file in several threads, so tiles are read serially
+            reader = _ExposurePlane(self, hdus, det_num)
+            reader = tiled_reader(reader, hdu.get_dims(), dtype, source, tile_shape=tile_shape, parallel=False)
+            return DetectorArray(reader, hdu.get_dims(), dtype, source)
+
         # get the data references for the detector object (where available)
         wcs = self._wcs_list[det_num]
         header = self._header_list[det_num]
-        sci = CCDData(self.sci_hdus[det_num])
-        flg = CCDData(self.flg_hdus[det_num]) if self.flg_hdus else None
-        rms = CCDData(self.rms_hdus[det_num]) if self.rms_hdus else None
-        wgt = CCDData(self.wgt_hdus[det_num]) if self.wgt_hdus else None
-        bkg = CCDData(self.bkg_hdus[det_num]) if self.bkg_hdus else None
-        seg = CCDData(self.seg_hdus[det_num]) if self.seg_hdus else None
+        sci = ccd_data("sci_hdus", "sci")
+        flg = ccd_data("flg_hdus", "flg")
+        rms = ccd_data("rms_hdus", "rms")
+        wgt = ccd_data("wgt_hdus", "wgt")
+        bkg = ccd_data("bkg_hdus", "bkg")
+        seg = ccd_data("seg_hdus", "seg")
 
         # create the detector object and add it to this class's detector's dictionary
         det = Detector(
@@ -515,6 +1035,9 @@ class VisExposureFitsIO(VisExposure):
 class VisExposureHDF5(VisExposure):
     """Implementation of the VisExposure class using HDF5"""
 
+    # h5py serialises access to the file itself
+    thread_safe = True
+
     #@io_stats
     def __init__(self, exposure_file, chunk_cache_mb=8, dpd=None):
         super().__init__()
@@ -523,6 +1046,8 @@ class VisExposureHDF5(VisExposure):
         # NOTE This is the cache per dataset, so if we were to open all datasets per exposure
         # this would be: 6 dataset per CCD x 36 CCDs x 8MB cache = 1728 MB
         self.file = h5py.File(exposure_file, "r", rdcc_nbytes=(1024 * 1024 * chunk_cache_mb))
+        self._exposure_file = exposure_file
+        self._chunk_cache_mb = chunk_cache_mb
 
         det_list_json = self.file.attrs["det_list"]
         self._detector_list = json.loads(det_list_json)
@@ -533,13 +1058,24 @@ class VisExposureHDF5(VisExposure):
 
         self.dpd = dpd
 
-    #@io_stats
-    def _get_wcs_and_header_list(self):
-        headers_json = self.file.attrs["header_list"]
-        headers_str_list = json.loads(headers_json)
+        self._header_strings = None
 
-        self._header_list = [_correct_header(fits.Header.fromstring(hdr_str)) for hdr_str in headers_str_list]
-        self._wcs_list = [WCS(header) for header in self._header_list]
+    def _get_header_string(self, det_num):
+        if self._header_strings is None:
+            self._header_strings = json.loads(self.file.attrs["header_list"])
+        return self._header_strings[det_num]
+
+    def get_open_args(self):
+        return dict(exposure_file=self._exposure_file, chunk_cache_mb=self._chunk_cache_mb)
+
+    def _get_detector_list(self):
+        return self._detector_list
+
+    def _get_raw_header(self, det_num):
+        return _parse_header_keywords(self._get_header_string(det_num))
+
+    def _get_header(self, det_num):
+        return _header_from_string(self._get_header_string(det_num))
 
     #@io_stats
     def _create_detector(self, det_name):
@@ -550,32 +1086,20 @@ class VisExposureHDF5(VisExposure):
         except Exception as e:
             raise e
 
-        # Make a new class that inherits from np.ndarray for the dataset
-        # Cutout2D converts all input data to np.ndarray unless it is already an instance
-        # of this class. This means it reads the whole dataset in and converts it. This
-        # class wraps it into an np.ndarray, preventing this conversion.
-        class CCDData(np.ndarray):
-            def __new__(cls, dataset):
-                shape = dataset.shape
-                dtype = dataset.dtype
-
-                obj = super().__new__(cls, shape, dtype=dtype, buffer=None, offset=0, strides=None, order=None)
-                obj.dataset = dataset
-
-                return obj
-
-            # When indexing this object, we want to index the dataset
-            def __getitem__(self, inds):
-                return self.dataset[inds]
+        def ccd_data(plane):
+            dataset = detector_group[plane]
+            source = DataSource(dataset.file.filename, dataset.name, plane)
+            reader = tiled_reader(dataset, dataset.shape, dataset.dtype, source, node_tile_shape=dataset.chunks)
+            return DetectorArray(reader, dataset.shape, dataset.dtype, source)
 
         wcs = self._wcs_list[det_num]
         header = self._header_list[det_num]
-        sci = CCDData(detector_group["sci"])
-        flg = CCDData(detector_group["flg"])
-        rms = CCDData(detector_group["rms"])
-        bkg = CCDData(detector_group["bkg"])
-        wgt = CCDData(detector_group["wgt"])
-        seg = CCDData(detector_group["seg"])
+        sci = ccd_data("sci")
+        flg = ccd_data("flg")
+        rms = ccd_data("rms")
+        bkg = ccd_data("bkg")
+        wgt = ccd_data("wgt")
+        seg = ccd_data("seg")
 
         # create the detector object and add it to this class's detector's dictionary
         det = Detector(
@@ -596,28 +1120,123 @@ class VisExposureHDF5(VisExposure):
         self._detectors[det_num] = det
 
 
+# keywords needed to name a detector and locate it on the sky
+_LOOKUP_KEYWORD_RE = re.compile(
+    r"^(Z?NAXIS\d?|CTYPE\d|CUNIT\d|CRVAL\d|CRPIX\d|CDELT\d|CD\d_\d|PC\d_\d|PV\d_\d+|"
+    r"LONPOLE|LATPOLE|[AB]_ORDER|[AB]_\d_\d|CCDID|QUADID)$"
+)
+
+# a card with a string value, which is quoted with any quotes in it doubled
+_STRING_CARD_RE = re.compile(r"^[^=]{8}= *'((?:[^']|'')*)'")
+
+
+def _parse_header_keywords(header_str, keyword_re=_LOOKUP_KEYWORD_RE):
+    """Parses only the values of the keywords matching keyword_re from a header string into a dict"""
+    keywords = {}
+    for i in range(0, len(header_str), 80):
+        card = header_str[i:i + 80]
+        keyword = card[:8].strip()
+        if card[8:10] != "= " or not keyword_re.match(keyword):
+            continue
+        match = _STRING_CARD_RE.match(card)
+        if match:
+            keywords[keyword] = match.group(1).replace("''", "'").rstrip()
+            continue
+        value = card[10:].split("/", 1)[0].strip()
+        if not value:
+            # an undefined value, which astropy treats as the keyword having no value
+            continue
+        if value in ("T", "F"):
+            keywords[keyword] = value == "T"
+        else:
+            try:
+                keywords[keyword] = int(value)
+            except ValueError:
+                try:
+                    keywords[keyword] = float(value.replace("D", "E"))
+                except ValueError:
+                    # anything else (e.g. a complex value) is left to astropy
+                    keywords[keyword] = fits.Card.fromstring(card).value
+    return keywords
+
+
+def _correct_header_string(header_str):
+    """Corrects strings in a header string that may be shorter than 8 chars. Only the cards needing it are rebuilt"""
+    cards = [header_str[i:i + 80] for i in range(0, len(header_str), 80)]
+    for i, card in enumerate(cards):
+        match = _STRING_CARD_RE.match(card)
+        if match and len(match.group(1).rstrip()) < 8:
+            card = fits.Card.fromstring(card)
+            card.value = "%-8s" % card.value
+            cards[i] = card.image
+    return "".join(cards)
+
+
 def _correct_header(hdr):
     """Corrects strings in headers that may be shorter than 8 chars"""
-    cards = []
-    for c in hdr.cards:
-        if isinstance(c.value, str):
-            if len(c.value) < 8:
-                c.value = "%-8s" % c.value
-        card = fits.Card(keyword=c.keyword, value=c.value, comment=c.comment)
-        cards.append(card)
-    new_hdr = fits.Header(cards)
-    return new_hdr
-
-
-def _fitsio_to_astropy_header(hdr):
-    """Converts a fitsio header to an astropy.fits.Header"""
-    cards = []
-    for record in hdr.records():
-        keyword = record["name"]
-        value = record["value"]
-        comment = record["comment"]
-
-        card = fits.Card(keyword, value, comment)
-        card.verify()
-        cards.append(card)
-    return fits.Header(cards)
+    return _header_from_string(hdr.tostring())
+
+
+def _header_from_string(header_str, verify=False):
+    """
+    Makes an astropy Header from a header string, correcting short strings. astropy only parses the cards when
+    their values are accessed, so e.g. building a WCS only parses the WCS keywords. Verifying the cards (which
+    parses them all) is optional
+    """
+    hdr = fits.Header.fromstring(_correct_header_string(header_str))
+    if verify:
+        for card in hdr.cards:
+            card.verify()
+    return hdr
+
+
+# files whose header blocks can be read at their offsets (.fz files are tile-compressed, not compressed as a whole)
+_PLAIN_FITS_EXTENSIONS = (".fits", ".fit", ".fts", ".fz")
+
+
+def _read_header_strings(hdus):
+    """
+    Reads the headers of fitsio HDUs as strings. The header blocks are read straight from plain FITS files where
+    possible, which is much faster than having fitsio parse them record by record. Headers of other files (e.g.
+    gzip or bzip2 compressed) are read through fitsio
+    """
+    header_strings = []
+    files = {}
+    try:
+        for hdu in hdus:
+            # the offsets are only exposed through fitsio's private attributes, so fall back if they change
+            try:
+                filename = hdu._filename
+                header_start, data_start = hdu._info["header_start"], hdu._info["data_start"]
+            except (AttributeError, KeyError):
+                filename = None
+            plain = filename is not None and filename.lower().endswith(_PLAIN_FITS_EXTENSIONS)
+            if not plain or not os.path.isfile(filename):
+                header_strings.append(_fitsio_header_string(hdu.read_header()))
+                continue
+            if filename not in files:
+                files[filename] = open(filename, "rb")
+            f = files[filename]
+            f.seek(header_start)
+            header_strings.append(f.read(data_start - header_start).decode("ascii"))
+    finally:
+        for f in files.values():
+            f.close()
+    return header_strings
+
+
+def _fitsio_header_string(hdr):
+    """Joins the card images of a fitsio header into a header string"""
+    return "".join(record["card_string"].ljust(80) for record in hdr.records())
+
+
+def _uncompressed_header(hdr):
+    """
+    fitsio returns the binary table header of tile-compressed images. Restores the image's BITPIX and NAXISn
+    keywords so that e.g. the WCS has the right pixel shape
+    """
+    if not hdr.get("ZIMAGE", False):
+        return hdr
+    for key in ("BITPIX", "NAXIS", "NAXIS1", "NAXIS2"):
+        hdr[key] = hdr["Z" + key]
+    return hdr